@@ -6,7 +6,7 @@ from cdk_nag import AwsSolutionsChecks, NagSuppressions, NagPackSuppression
 
 import yaml
 
-from infrastructure.llama_cpp_stack import LlamaCppStack
+from infrastructure.llama_cpp_stack import LlamaCppStack, LlamaCppImageStack, LlamaCppModelStack, LAUNCH_PROFILE_ENV, DRAFT_ENV
 
 ### Set environment
 environment=cdk.Environment(
@@ -19,34 +19,77 @@ app = cdk.App()
 
 ## Read config
 with open(app.node.try_get_context('config_file'), 'r') as f:
-    config = yaml.safe_load(f)['project']
-
-project_name = config['name']
-model_hugging_face_name = config['model']['hf_name']
-model_bucket_key_full_name = config['model']['full_name']
-platform = config['image']['platform'].lower()
-image_tag = config['image']['image_tag']
-sagemaker_model_name = config['inference']['sagemaker_model_name']
-sagemaker_instance_type = config['inference']['instance_type']
-
-### Validate input
-if platform not in ["arm", "amd"]:
-    raise ValueError(f"[ERROR] Value {platform} of the \"image.platform\" parameter does not match one of the suported values: ['arm', 'amd']") 
-if platform not in ["arm"] and "g" in sagemaker_instance_type.split(".")[1] and sagemaker_instance_type.split(".")[1] not in ["g5"]:
-    print("[WARNING] Platfrom for the image is not set to ARM, however, instance type potentially belongs to the AWS Graviton family.")
-
-# stack
-llamaCppStack = LlamaCppStack(app,
-    f"{project_name}-LlamaCppStack",
-    env=environment,
-    project_name=project_name,
-    model_bucket_key_full_name=model_bucket_key_full_name,
-    model_hugging_face_name=model_hugging_face_name,
-    image_tag=image_tag,
-    image_platform=platform,
-    model_name=sagemaker_model_name,
-    model_instance_type=sagemaker_instance_type
-)
+    config_file = yaml.safe_load(f)
+
+# shared stacks of multimodel_cdk.py: one image build per platform and one download per model
+if 'image_build' in config_file:
+    config = config_file['image_build']
+    llamaCppStack = LlamaCppImageStack(app,
+        f"{config['name']}-LlamaCppImageStack",
+        env=environment,
+        project_name=config['name'],
+        image_tag=config['image_tag'],
+        image_platform=config['platform'].lower()
+    )
+elif 'model_download' in config_file:
+    config = config_file['model_download']
+    llamaCppStack = LlamaCppModelStack(app,
+        f"{config['name']}-LlamaCppModelStack",
+        env=environment,
+        project_name=config['name'],
+        model_bucket_key_full_name=config['model']['full_name'],
+        model_hugging_face_name=config['model']['hf_name'],
+        draft=config['model'].get('draft')
+    )
+else:
+    config = config_file['project']
+
+    project_name = config['name']
+    model_hugging_face_name = config['model']['hf_name']
+    model_bucket_key_full_name = config['model']['full_name']
+    platform = config['image']['platform'].lower()
+    image_tag = config['image']['image_tag']
+    sagemaker_model_name = config['inference']['sagemaker_model_name']
+    sagemaker_instance_type = config['inference']['instance_type']
+    launch_profile = config.get('launch_profiles', {}).get(sagemaker_instance_type, {})
+    draft = config['model'].get('draft')
+    embeddings = config['model'].get('embeddings', False)
+    chat_template = config['model'].get('chat_template')
+
+    ### Validate input
+    if platform not in ["arm", "amd"]:
+        raise ValueError(f"[ERROR] Value {platform} of the \"image.platform\" parameter does not match one of the suported values: ['arm', 'amd']") 
+    if platform not in ["arm"] and "g" in sagemaker_instance_type.split(".")[1] and sagemaker_instance_type.split(".")[1] not in ["g5"]:
+        print("[WARNING] Platfrom for the image is not set to ARM, however, instance type potentially belongs to the AWS Graviton family.")
+    unknown_settings = set(launch_profile) - set(LAUNCH_PROFILE_ENV)
+    if unknown_settings:
+        raise ValueError(f"[ERROR] Launch profile for {sagemaker_instance_type} has unsupported settings {sorted(unknown_settings)}, supported are: {sorted(LAUNCH_PROFILE_ENV)}")
+    if draft is not None:
+        if not draft.get('full_name'):
+            raise ValueError("[ERROR] \"model.draft\" needs the \"full_name\" of the draft model file")
+        unknown_settings = set(draft) - set(DRAFT_ENV) - {'hf_name', 'full_name'}
+        if unknown_settings:
+            raise ValueError(f"[ERROR] Draft model has unsupported settings {sorted(unknown_settings)}, supported are: {sorted(['hf_name', 'full_name', *DRAFT_ENV])}")
+    if not launch_profile:
+        print(f"[WARNING] No launch profile for {sagemaker_instance_type} in \"launch_profiles\", llama.cpp starts with the server.sh defaults. Run tune.py on that instance type to generate one.")
+
+    # stack
+    llamaCppStack = LlamaCppStack(app,
+        f"{project_name}-LlamaCppStack",
+        env=environment,
+        project_name=project_name,
+        model_bucket_key_full_name=model_bucket_key_full_name,
+        model_hugging_face_name=model_hugging_face_name,
+        image_tag=image_tag,
+        image_platform=platform,
+        model_name=sagemaker_model_name,
+        model_instance_type=sagemaker_instance_type,
+        launch_profile=launch_profile,
+        draft=draft,
+        embeddings=embeddings,
+        chat_template=chat_template,
+        shared=config.get('shared')
+    )
 
 # tags
 tags = {
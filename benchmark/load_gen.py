@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import time
+import httpx
+
+parser = argparse.ArgumentParser(description="Load generator for the gateway /invocations endpoint, writes a JSON report of the run.")
+parser.add_argument("--url", type=str, help="Base URL of the gateway(default: http://127.0.0.1:8080)", default="http://127.0.0.1:8080")
+parser.add_argument("--path", type=str, help="Path requests are sent to(default: /invocations)", default="/invocations")
+parser.add_argument("--requests", type=str, help="JSON Lines file of request payloads to replay in order, instead of synthetic prompts(default: NULL)", default="")
+parser.add_argument("--num-requests", type=int, help="Requests to send, replayed files are repeated as needed(default: 200)", default=200)
+parser.add_argument("--warmup", type=int, help="Requests sent before measuring(default: 4)", default=4)
+parser.add_argument("--concurrency", type=int, help="Requests kept in flight in closed-loop mode(default: 8)", default=8)
+parser.add_argument("--rate", type=float, help="Open-loop mode with Poisson arrivals at this many requests per second, 0 uses --concurrency(default: 0)", default=0.0)
+parser.add_argument("--stream", action="store_true", help="Send streaming requests, synthetic prompts only")
+parser.add_argument("--embeddings", action="store_true", help="Send embedding requests with the synthetic prompts as input")
+parser.add_argument("--prompt-words", type=int, help="Mean words of a synthetic prompt(default: 200)", default=200)
+parser.add_argument("--prompt-distribution", type=str, choices=["fixed", "uniform", "exponential"], help="Distribution of synthetic prompt lengths(default: uniform)", default="uniform")
+parser.add_argument("--shared-prefix-words", type=int, help="Words of a system prompt shared by all synthetic prompts(default: 0)", default=0)
+parser.add_argument("--max-tokens", type=int, help="max_tokens of synthetic requests(default: 64)", default=64)
+parser.add_argument("--seed", type=int, help="Random seed of synthetic prompts and arrivals(default: 0)", default=0)
+parser.add_argument("--gateway-pid", type=int, help="Gateway process whose CPU time is measured, 0 looks for uvicorn main:asgi_app(default: 0)", default=0)
+parser.add_argument("--label", type=str, help="Name of the run in the report(default: NULL)", default="")
+parser.add_argument("--output", type=str, help="File the JSON report is written to(default: benchmark-report.json)", default="benchmark-report.json")
+parser.add_argument("--compare", type=str, help="Earlier JSON report to compare this run with(default: NULL)", default="")
+
+WORDS = ("the", "model", "answer", "question", "token", "server", "request", "latency", "memory", "context",
+    "stream", "cache", "prompt", "system", "user", "assistant", "vector", "layer", "weight", "output")
+
+def synthetic_requests(args, rng):
+    prefix = " ".join(rng.choice(WORDS) for _ in range(args.shared_prefix_words))
+    while True:
+        if (args.prompt_distribution == "fixed"):
+            n = args.prompt_words
+        elif (args.prompt_distribution == "uniform"):
+            n = rng.randint(args.prompt_words // 2, args.prompt_words * 3 // 2)
+        else:
+            n = int(rng.expovariate(1 / max(args.prompt_words, 1)))
+        prompt = " ".join(rng.choice(WORDS) for _ in range(max(n, 1)))
+        prompt = f"{prefix} {prompt}" if (prefix) else prompt
+        if (args.embeddings):
+            yield {"input": prompt}
+        else:
+            yield {"prompt": prompt, "max_tokens": args.max_tokens, "stream": args.stream}
+
+def replayed_requests(path):
+    with open(path) as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    if (not items):
+        raise SystemExit(f"{path} has no requests")
+    while True:
+        yield from items
+
+def chunk_text(chunk):
+    choice = (chunk.get("choices") or [{}])[0]
+    return choice.get("text") or (choice.get("delta") or {}).get("content") or ""
+
+async def send(client, path, payload):
+    record = {"start": time.monotonic(), "ttft": None, "tokens": 0, "status": None, "error": None, "timings": None}
+    try:
+        if (payload.get("stream")):
+            async with client.stream("POST", path, json=payload) as response:
+                record["status"] = response.status_code
+                async for line in response.aiter_lines():
+                    if (not line.startswith("data: ") or line == "data: [DONE]"):
+                        continue
+                    chunk = json.loads(line[6:])
+                    #the last chunk carries the server.cpp speed and draft model acceptance
+                    record["timings"] = chunk.get("timings") or record["timings"]
+                    if (chunk_text(chunk)):
+                        if (record["ttft"] is None):
+                            record["ttft"] = time.monotonic() - record["start"]
+                        #merged stream events count as one token
+                        record["tokens"] += 1
+        else:
+            response = await client.post(path, json=payload)
+            record["status"] = response.status_code
+            if (response.status_code == 200):
+                data = response.json()
+                record["tokens"] = data.get("usage", {}).get("completion_tokens", 0)
+                record["timings"] = data.get("timings")
+    except (httpx.HTTPError, ValueError) as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["e2e"] = time.monotonic() - record["start"]
+    return record
+
+async def closed_loop(client, path, payloads, n, concurrency):
+    records = []
+    remaining = n
+
+    async def worker():
+        nonlocal remaining
+        while (remaining > 0):
+            remaining -= 1
+            records.append(await send(client, path, next(payloads)))
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return records
+
+async def open_loop(client, path, payloads, n, rate, rng):
+    #arrivals do not wait for earlier requests, so queueing in the gateway shows up in the latencies
+    tasks = []
+    next_arrival = time.monotonic()
+    for _ in range(n):
+        await asyncio.sleep(max(0.0, next_arrival - time.monotonic()))
+        tasks.append(asyncio.create_task(send(client, path, next(payloads))))
+        next_arrival += rng.expovariate(rate)
+    return await asyncio.gather(*tasks)
+
+def find_gateway():
+    for pid in os.listdir("/proc"):
+        if (not pid.isdigit()):
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                if (b"main:asgi_app" in f.read()):
+                    return int(pid)
+        except OSError:
+            continue
+    return 0
+
+def process_cpu(pid):
+    #user and system seconds of the gateway and its worker processes, not of server.cpp started by it
+    ticks = os.sysconf("SC_CLK_TCK")
+    children = {}
+    stats = {}
+    for entry in os.listdir("/proc"):
+        if (not entry.isdigit()):
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        comm = stat[stat.index("(") + 1:stat.rindex(")")]
+        fields = stat[stat.rindex(")") + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(entry))
+        stats[int(entry)] = (comm, int(fields[11]) + int(fields[12]))
+    total, todo = 0, [pid]
+    while (todo):
+        current = todo.pop()
+        if (current not in stats or stats[current][0] in ("llama-server", "server.sh")):
+            continue
+        total += stats[current][1]
+        todo += children.get(current, [])
+    return total / ticks
+
+def percentiles(values):
+    if (not values):
+        return None
+    values = sorted(values)
+    #nearest rank
+    pick = lambda q: values[max(0, math.ceil(q * len(values)) - 1)]
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "mean": sum(values) / len(values), "max": values[-1]}
+
+def build_report(args, records, duration, cpu):
+    ok = [record for record in records if (record["status"] == 200 and record["error"] is None)]
+    status_codes = {}
+    for record in records:
+        key = str(record["status"]) if (record["error"] is None) else "error"
+        status_codes[key] = status_codes.get(key, 0) + 1
+    tokens = sum(record["tokens"] for record in ok)
+    decode = [record["tokens"] / (record["e2e"] - (record["ttft"] or 0)) for record in ok if (record["tokens"] and record["e2e"] > (record["ttft"] or 0))]
+    timings = [record["timings"] for record in ok if (record["timings"])]
+    drafted = sum(timing.get("draft_tokens", 0) for timing in timings)
+    accepted = sum(timing.get("draft_tokens_accepted", 0) for timing in timings)
+    return {
+        "label": args.label,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() - duration)),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "requests": len(records),
+        "succeeded": len(ok),
+        "status_codes": status_codes,
+        "errors": sorted({record["error"] for record in records if record["error"]})[:10],
+        "duration_s": duration,
+        "requests_per_s": len(ok) / duration if (duration) else 0.0,
+        "output_tokens_per_s": tokens / duration if (duration) else 0.0,
+        "ttft_s": percentiles([record["ttft"] for record in ok if (record["ttft"] is not None)]),
+        "e2e_s": percentiles([record["e2e"] for record in ok]),
+        "tokens_per_s_per_request": percentiles(decode),
+        "server_generation_tokens_per_s": percentiles([timing["generation_tokens_per_second"] for timing in timings if (timing.get("generation_tokens_per_second"))]),
+        "draft_acceptance_rate": accepted / drafted if (drafted) else None,
+        "gateway_cpu_s": cpu,
+        "gateway_cpu_ms_per_request": cpu * 1000 / len(records) if (cpu is not None and records) else None
+    }
+
+def compare(report, baseline):
+    rows = [("requests_per_s",), ("output_tokens_per_s",), ("gateway_cpu_ms_per_request",), ("draft_acceptance_rate",)]
+    for metric in ("ttft_s", "e2e_s", "tokens_per_s_per_request", "server_generation_tokens_per_s"):
+        rows += [(metric, q) for q in ("p50", "p95", "p99")]
+    print(f"{'metric':36} {'baseline':>12} {'current':>12} {'change':>8}")
+    for row in rows:
+        old, new = baseline, report
+        for key in row:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if (old is None or new is None):
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if (old) else "n/a"
+        print(f"{'.'.join(row):36} {old:12.4f} {new:12.4f} {change:>8}")
+
+async def main(args):
+    rng = random.Random(args.seed)
+    payloads = replayed_requests(args.requests) if (args.requests) else synthetic_requests(args, rng)
+    pid = args.gateway_pid or find_gateway()
+    limits = httpx.Limits(max_connections=None if (args.rate > 0) else args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=httpx.Timeout(None, connect=10.0)) as client:
+        if (args.warmup > 0):
+            await closed_loop(client, args.path, payloads, args.warmup, min(args.warmup, args.concurrency))
+        cpu_before = process_cpu(pid) if (pid) else None
+        started = time.monotonic()
+        if (args.rate > 0):
+            records = await open_loop(client, args.path, payloads, args.num_requests, args.rate, rng)
+        else:
+            records = await closed_loop(client, args.path, payloads, args.num_requests, args.concurrency)
+        duration = time.monotonic() - started
+        cpu = process_cpu(pid) - cpu_before if (pid) else None
+
+    report = build_report(args, records, duration, cpu)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({key: report[key] for key in ("requests", "succeeded", "requests_per_s", "output_tokens_per_s", "ttft_s", "e2e_s", "gateway_cpu_ms_per_request", "draft_acceptance_rate")}, indent=2))
+    print(f"report written to {args.output}")
+    if (args.compare):
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+if __name__ == "__main__":
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+import uvicorn
+
+parser = argparse.ArgumentParser(description="Stand-in for server.cpp that answers like llama.cpp without loading a model.")
+parser.add_argument("--host", type=str, help="Set the ip address to listen.(default: 127.0.0.1)", default="127.0.0.1")
+parser.add_argument("--port", type=int, help="Set the port to listen.(default: 8081)", default=8081)
+parser.add_argument("--slots", type=int, help="Parallel slots, further requests wait for a free one(default: 4)", default=4)
+parser.add_argument("--prefill-ms", type=float, help="Milliseconds of prompt processing per uncached prompt token(default: 0.5)", default=0.5)
+parser.add_argument("--token-ms", type=float, help="Milliseconds per generated token(default: 20)", default=20.0)
+parser.add_argument("--draft-acceptance", type=float, help="Share of draft model tokens accepted, like server.cpp started with a draft model, 0 runs without one(default: 0)", default=0.0)
+parser.add_argument("--draft-max", type=int, help="Tokens drafted per step when --draft-acceptance is set(default: 16)", default=16)
+parser.add_argument("--embedding-dim", type=int, help="Length of the vectors returned by /v1/embeddings(default: 384)", default=384)
+parser.add_argument("--ctx-size", type=int, help="Context size shared by the slots, reported by /props(default: 8192)", default=8192)
+parser.add_argument("--n-predict", type=int, help="Tokens generated when a request does not set n_predict(default: 128)", default=128)
+
+args, unknown = parser.parse_known_args()
+
+#each slot remembers the tokens of its last prompt and answer, like the server.cpp prompt cache
+slot_cache = [[] for _ in range(args.slots)]
+free_slots = list(range(args.slots))
+slot_ready = asyncio.Condition()
+
+def tokenize(text):
+    #one token per word is close enough for timing
+    return [hash(word) & 0x7fffffff for word in text.split()]
+
+def common_prefix(a, b):
+    n = 0
+    for x, y in zip(a, b):
+        if (x != y):
+            break
+        n += 1
+    return n
+
+async def take_slot(requested):
+    async with slot_ready:
+        await slot_ready.wait_for(lambda: free_slots and (requested < 0 or requested in free_slots))
+        slot = requested if (requested >= 0) else free_slots[0]
+        free_slots.remove(slot)
+        return slot
+
+async def give_slot(slot):
+    async with slot_ready:
+        free_slots.append(slot)
+        slot_ready.notify_all()
+
+def token_ms():
+    #accepted draft tokens are verified in one batch and cost a fraction of a generated token
+    return args.token_ms * (1 - 0.75 * args.draft_acceptance)
+
+def result(slot, prompt_tokens, cached, generated, prompt_ms, predicted_ms):
+    data = {
+        "stop": True,
+        "stopped_eos": False,
+        "stopped_word": False,
+        "stopped_limit": True,
+        "tokens_evaluated": len(prompt_tokens),
+        "tokens_predicted": generated,
+        "tokens_cached": len(prompt_tokens) + generated,
+        "truncated": False,
+        "id_slot": slot,
+        "slot_id": slot,
+        "timings": {
+            "prompt_n": len(prompt_tokens) - cached,
+            "prompt_ms": prompt_ms,
+            "prompt_per_second": (len(prompt_tokens) - cached) / prompt_ms * 1000 if (prompt_ms) else 0.0,
+            "predicted_n": generated,
+            "predicted_ms": predicted_ms,
+            "predicted_per_second": generated / predicted_ms * 1000 if (predicted_ms) else 0.0
+        }
+    }
+    if (args.draft_acceptance > 0):
+        drafted = -(-generated // args.draft_max) * args.draft_max
+        data["timings"]["draft_n"] = drafted
+        data["timings"]["draft_n_accepted"] = min(generated, round(drafted * args.draft_acceptance))
+    return data
+
+async def completion(request):
+    body = await request.json()
+    prompt = body.get("prompt", "")
+    prompt_tokens = tokenize(prompt) if (isinstance(prompt, str)) else list(prompt)
+    n_predict = body.get("n_predict", -1)
+    if (n_predict is None or n_predict < 0):
+        n_predict = args.n_predict
+    requested = body.get("id_slot", body.get("slot_id", -1))
+    if (requested is None or requested >= args.slots):
+        requested = -1
+    if (len(prompt_tokens) > args.ctx_size // args.slots):
+        #like server.cpp, a prompt longer than the context of a slot is refused before it streams
+        return JSONResponse({"error": {"code": 400, "message": "the request exceeds the available context size, try increasing it", "type": "exceed_context_size_error"}}, status_code=400)
+
+    async def run(emit):
+        slot = await take_slot(requested)
+        try:
+            return await generate_tokens(slot, emit)
+        finally:
+            await give_slot(slot)
+
+    async def generate_tokens(slot, emit):
+        started = time.monotonic()
+        cached = common_prefix(slot_cache[slot], prompt_tokens)
+        await asyncio.sleep((len(prompt_tokens) - cached) * args.prefill_ms / 1000)
+        prompt_ms = (time.monotonic() - started) * 1000
+        generated = []
+        for i in range(n_predict):
+            await asyncio.sleep(token_ms() / 1000)
+            generated.append(f" tok{i}")
+            if (i < n_predict - 1):
+                await emit({"content": generated[-1], "stop": False, "id_slot": slot, "slot_id": slot})
+        predicted_ms = (time.monotonic() - started) * 1000 - prompt_ms
+        slot_cache[slot] = prompt_tokens + tokenize("".join(generated))
+        data = result(slot, prompt_tokens, cached, n_predict, prompt_ms, predicted_ms)
+        data["content"] = generated[-1] if (generated) else ""
+        return data, "".join(generated)
+
+    if (not body.get("stream")):
+        async def ignore(chunk):
+            pass
+        #like server.cpp, stop generating and free the slot once the client is gone
+        task = asyncio.ensure_future(run(ignore))
+        while (not task.done()):
+            await asyncio.wait([task], timeout=0.05)
+            if (not task.done() and await request.is_disconnected()):
+                task.cancel()
+                return Response(status_code=499)
+        data, content = task.result()
+        return JSONResponse({**data, "content": content})
+
+    async def generate():
+        queue = asyncio.Queue()
+
+        async def emit(chunk):
+            await queue.put(chunk)
+
+        async def produce():
+            try:
+                data, _ = await run(emit)
+                await queue.put(data)
+            finally:
+                await queue.put(None)
+
+        task = asyncio.create_task(produce())
+        try:
+            while True:
+                chunk = await queue.get()
+                if (chunk is None):
+                    break
+                yield f"data: {json.dumps(chunk)}\n\n"
+        finally:
+            task.cancel()
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+def embedding(text):
+    #the same unit vector for the same text
+    rng = random.Random(text)
+    vector = [rng.gauss(0, 1) for _ in range(args.embedding_dim)]
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+async def embeddings(request):
+    body = await request.json()
+    texts = body["input"] if (isinstance(body["input"], list)) else [body["input"]]
+    n_tokens = sum(len(tokenize(text)) for text in texts)
+    slot = await take_slot(-1)
+    try:
+        await asyncio.sleep(n_tokens * args.prefill_ms / 1000)
+    finally:
+        await give_slot(slot)
+    return JSONResponse({
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": embedding(text)} for i, text in enumerate(texts)],
+        "model": "mock",
+        "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens}
+    })
+
+async def tokenize_route(request):
+    body = await request.json()
+    return JSONResponse({"tokens": tokenize(body.get("content", ""))})
+
+async def health(request):
+    return JSONResponse({"status": "ok"})
+
+async def props(request):
+    return JSONResponse({"total_slots": args.slots, "default_generation_settings": {"n_ctx": args.ctx_size // args.slots}})
+
+app = Starlette(routes=[
+    Route("/completion", completion, methods=["POST"]),
+    Route("/tokenize", tokenize_route, methods=["POST"]),
+    Route("/v1/embeddings", embeddings, methods=["POST"]),
+    Route("/health", health, methods=["GET"]),
+    Route("/props", props, methods=["GET"]),
+])
+
+if __name__ == "__main__":
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,4 @@
+from .client import AsyncClient, Backoff, Client, EndpointError
+from .sse import SSEParser, chunk_text, parse_events
+
+__all__ = ["AsyncClient", "Backoff", "Client", "EndpointError", "SSEParser", "chunk_text", "parse_events"]
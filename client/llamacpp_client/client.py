@@ -0,0 +1,391 @@
+import asyncio
+import concurrent.futures
+import json
+import random
+import time
+
+from .sse import SSEParser, parse_events
+
+#error codes of SageMaker Runtime and status codes of the container that are worth another attempt
+RETRY_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailable", "ServiceUnavailableException", "InternalFailure"}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+TARGET_MODEL_HEADER = "X-Amzn-SageMaker-Target-Model"
+
+
+class EndpointError(Exception):
+    def __init__(self, message, status_code=None, retryable=False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+
+
+class Backoff:
+    """Exponential backoff with full jitter, so throttled callers do not retry in lockstep."""
+
+    def __init__(self, max_retries=5, base_delay=0.25, max_delay=20.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def client_error(e):
+    #a botocore ClientError, a ModelError carries the status code the container answered with
+    response = e.response
+    code = response.get("Error", {}).get("Code")
+    status = response.get("OriginalStatusCode") or response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    message = response.get("OriginalMessage") or response.get("Error", {}).get("Message")
+    return EndpointError(f"{code}: {message}", status, code in RETRY_CODES or status in RETRY_STATUS)
+
+
+def http_error(status, body):
+    return EndpointError(f"HTTP {status}: {body.decode('utf-8', 'replace')[:500]}", status, status in RETRY_STATUS)
+
+
+def stream_error(event):
+    #errors the endpoint sends in place of a PayloadPart once the stream has started
+    name = next(iter(event))
+    return EndpointError(f"{name}: {event[name].get('Message')}", event[name].get("ErrorCode"))
+
+
+def body_of(payload, stream):
+    payload = dict(payload)
+    if (stream):
+        payload["stream"] = True
+    return json.dumps(payload).encode("utf-8")
+
+
+class SageMakerTransport:
+    def __init__(self, endpoint_name, region_name=None, concurrency=16, timeout=300, session=None):
+        import boto3
+        from botocore.config import Config
+        self.endpoint_name = endpoint_name
+        #retries are done by the client, with jitter, so botocore makes a single attempt
+        config = Config(max_pool_connections=concurrency, read_timeout=timeout, retries={"total_max_attempts": 1})
+        self.client = (session or boto3.Session()).client("sagemaker-runtime", region_name=region_name, config=config)
+
+    def params(self, body, target_model):
+        params = {"EndpointName": self.endpoint_name, "Body": body, "ContentType": "application/json"}
+        if (target_model):
+            params["TargetModel"] = target_model
+        return params
+
+    def invoke(self, body, target_model=None):
+        from botocore.exceptions import BotoCoreError, ClientError
+        try:
+            response = self.client.invoke_endpoint(**self.params(body, target_model))
+            return response["Body"].read()
+        except ClientError as e:
+            raise client_error(e) from e
+        except BotoCoreError as e:
+            raise EndpointError(str(e), retryable=True) from e
+
+    def open_stream(self, body, target_model=None):
+        from botocore.exceptions import BotoCoreError, ClientError
+        try:
+            response = self.client.invoke_endpoint_with_response_stream(**self.params(body, target_model))
+        except ClientError as e:
+            raise client_error(e) from e
+        except BotoCoreError as e:
+            raise EndpointError(str(e), retryable=True) from e
+        return self.payloads(response["Body"])
+
+    def payloads(self, stream):
+        try:
+            for event in stream:
+                if ("PayloadPart" not in event):
+                    raise stream_error(event)
+                yield event["PayloadPart"]["Bytes"]
+        finally:
+            stream.close()
+
+    def close(self):
+        self.client.close()
+
+
+class HTTPTransport:
+    """Calls /invocations of a container directly, such as one started with docker run or the mock server."""
+
+    def __init__(self, url, concurrency=16, timeout=300):
+        import httpx
+        self.httpx = httpx
+        self.url = url.rstrip("/") + "/invocations"
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        self.client = httpx.Client(limits=limits, timeout=timeout)
+
+    def headers(self, target_model):
+        headers = {"Content-Type": "application/json"}
+        if (target_model):
+            headers[TARGET_MODEL_HEADER] = target_model
+        return headers
+
+    def invoke(self, body, target_model=None):
+        try:
+            response = self.client.post(self.url, content=body, headers=self.headers(target_model))
+        except self.httpx.TransportError as e:
+            raise EndpointError(str(e), retryable=True) from e
+        if (response.status_code >= 400):
+            raise http_error(response.status_code, response.content)
+        return response.content
+
+    def open_stream(self, body, target_model=None):
+        request = self.client.build_request("POST", self.url, content=body, headers=self.headers(target_model))
+        try:
+            response = self.client.send(request, stream=True)
+        except self.httpx.TransportError as e:
+            raise EndpointError(str(e), retryable=True) from e
+        if (response.status_code >= 400):
+            content = response.read()
+            response.close()
+            raise http_error(response.status_code, content)
+        return self.payloads(response)
+
+    def payloads(self, response):
+        try:
+            yield from response.iter_raw()
+        except self.httpx.TransportError as e:
+            raise EndpointError(str(e)) from e
+        finally:
+            response.close()
+
+    def close(self):
+        self.client.close()
+
+
+class AioSageMakerTransport:
+    def __init__(self, endpoint_name, region_name=None, concurrency=16, timeout=300, session=None):
+        try:
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+        except ImportError:
+            raise ImportError("AsyncClient needs aiobotocore for SageMaker endpoints, install llamacpp-sagemaker-client[async]")
+        self.endpoint_name = endpoint_name
+        config = AioConfig(max_pool_connections=concurrency, read_timeout=timeout, retries={"total_max_attempts": 1})
+        self.context = (session or get_session()).create_client("sagemaker-runtime", region_name=region_name, config=config)
+        self.client = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        #the client is created once, on first use inside the event loop, and shared by all calls
+        if (self.client is None):
+            async with self.lock:
+                if (self.client is None):
+                    self.client = await self.context.__aenter__()
+        return self.client
+
+    params = SageMakerTransport.params
+
+    async def invoke(self, body, target_model=None):
+        from botocore.exceptions import BotoCoreError, ClientError
+        client = await self.connect()
+        try:
+            response = await client.invoke_endpoint(**self.params(body, target_model))
+            async with response["Body"] as stream:
+                return await stream.read()
+        except ClientError as e:
+            raise client_error(e) from e
+        except BotoCoreError as e:
+            raise EndpointError(str(e), retryable=True) from e
+
+    async def open_stream(self, body, target_model=None):
+        from botocore.exceptions import BotoCoreError, ClientError
+        client = await self.connect()
+        try:
+            response = await client.invoke_endpoint_with_response_stream(**self.params(body, target_model))
+        except ClientError as e:
+            raise client_error(e) from e
+        except BotoCoreError as e:
+            raise EndpointError(str(e), retryable=True) from e
+        return self.payloads(response["Body"])
+
+    async def payloads(self, stream):
+        try:
+            async for event in stream:
+                if ("PayloadPart" not in event):
+                    raise stream_error(event)
+                yield event["PayloadPart"]["Bytes"]
+        finally:
+            stream.close()
+
+    async def close(self):
+        if (self.client is not None):
+            await self.context.__aexit__(None, None, None)
+            self.client = None
+
+
+class AsyncHTTPTransport(HTTPTransport):
+    def __init__(self, url, concurrency=16, timeout=300):
+        import httpx
+        self.httpx = httpx
+        self.url = url.rstrip("/") + "/invocations"
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        self.client = httpx.AsyncClient(limits=limits, timeout=timeout)
+
+    async def invoke(self, body, target_model=None):
+        try:
+            response = await self.client.post(self.url, content=body, headers=self.headers(target_model))
+        except self.httpx.TransportError as e:
+            raise EndpointError(str(e), retryable=True) from e
+        if (response.status_code >= 400):
+            raise http_error(response.status_code, response.content)
+        return response.content
+
+    async def open_stream(self, body, target_model=None):
+        request = self.client.build_request("POST", self.url, content=body, headers=self.headers(target_model))
+        try:
+            response = await self.client.send(request, stream=True)
+        except self.httpx.TransportError as e:
+            raise EndpointError(str(e), retryable=True) from e
+        if (response.status_code >= 400):
+            content = await response.aread()
+            await response.aclose()
+            raise http_error(response.status_code, content)
+        return self.payloads(response)
+
+    async def payloads(self, response):
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        except self.httpx.TransportError as e:
+            raise EndpointError(str(e)) from e
+        finally:
+            await response.aclose()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class Client:
+    """Thread-safe client of a llama.cpp endpoint.
+
+    Give endpoint_name for a SageMaker endpoint, or url for a container
+    reached directly. Connections are pooled up to concurrency, throttled
+    and unavailable responses are retried with backoff. A stream is only
+    retried while it is being opened, never after its first event.
+    """
+
+    def __init__(self, endpoint_name=None, url=None, region_name=None, concurrency=16, timeout=300, backoff=None, session=None):
+        if (bool(endpoint_name) == bool(url)):
+            raise ValueError("give either endpoint_name or url")
+        self.concurrency = concurrency
+        self.backoff = backoff or Backoff()
+        self.retries = 0
+        if (url):
+            self.transport = HTTPTransport(url, concurrency, timeout)
+        else:
+            self.transport = SageMakerTransport(endpoint_name, region_name, concurrency, timeout, session)
+
+    def retrying(self, call, *args):
+        attempt = 0
+        while True:
+            try:
+                return call(*args)
+            except EndpointError as e:
+                if (not e.retryable or attempt >= self.backoff.max_retries):
+                    raise
+                time.sleep(self.backoff.delay(attempt))
+                attempt += 1
+                self.retries += 1
+
+    def invoke(self, payload, target_model=None):
+        #the JSON response of a request, payload is the body server.cpp or the OpenAI API takes
+        return json.loads(self.retrying(self.transport.invoke, body_of(payload, False), target_model))
+
+    def stream(self, payload, target_model=None):
+        #the JSON chunks of a streamed request
+        payloads = self.retrying(self.transport.open_stream, body_of(payload, True), target_model)
+        parser = SSEParser()
+        for chunk in payloads:
+            yield from parse_events(parser.feed(chunk))
+        yield from parse_events(parser.flush())
+
+    def invoke_many(self, payloads, target_model=None, concurrency=None, return_exceptions=True):
+        #responses in the order of payloads, with at most concurrency requests in flight
+        def call(payload):
+            try:
+                return self.invoke(payload, target_model)
+            except EndpointError as e:
+                if (not return_exceptions):
+                    raise
+                return e
+
+        with concurrent.futures.ThreadPoolExecutor(concurrency or self.concurrency) as executor:
+            return list(executor.map(call, payloads))
+
+    def close(self):
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncClient:
+    """asyncio client of a llama.cpp endpoint, the counterpart of Client.
+
+    SageMaker endpoints need aiobotocore. One client is shared by all tasks
+    of an event loop, use it with async with or call aclose().
+    """
+
+    def __init__(self, endpoint_name=None, url=None, region_name=None, concurrency=16, timeout=300, backoff=None, session=None):
+        if (bool(endpoint_name) == bool(url)):
+            raise ValueError("give either endpoint_name or url")
+        self.concurrency = concurrency
+        self.backoff = backoff or Backoff()
+        self.retries = 0
+        if (url):
+            self.transport = AsyncHTTPTransport(url, concurrency, timeout)
+        else:
+            self.transport = AioSageMakerTransport(endpoint_name, region_name, concurrency, timeout, session)
+
+    async def retrying(self, call, *args):
+        attempt = 0
+        while True:
+            try:
+                return await call(*args)
+            except EndpointError as e:
+                if (not e.retryable or attempt >= self.backoff.max_retries):
+                    raise
+                await asyncio.sleep(self.backoff.delay(attempt))
+                attempt += 1
+                self.retries += 1
+
+    async def invoke(self, payload, target_model=None):
+        return json.loads(await self.retrying(self.transport.invoke, body_of(payload, False), target_model))
+
+    async def stream(self, payload, target_model=None):
+        payloads = await self.retrying(self.transport.open_stream, body_of(payload, True), target_model)
+        parser = SSEParser()
+        async for chunk in payloads:
+            for event in parse_events(parser.feed(chunk)):
+                yield event
+        for event in parse_events(parser.flush()):
+            yield event
+
+    async def invoke_many(self, payloads, target_model=None, concurrency=None, return_exceptions=True):
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def call(payload):
+            async with semaphore:
+                try:
+                    return await self.invoke(payload, target_model)
+                except EndpointError as e:
+                    #like Client.invoke_many, bugs and cancellation are raised, not returned
+                    if (not return_exceptions):
+                        raise
+                    return e
+
+        return await asyncio.gather(*[call(payload) for payload in payloads])
+
+    async def aclose(self):
+        await self.transport.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
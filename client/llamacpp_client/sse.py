@@ -0,0 +1,61 @@
+import json
+
+
+class SSEParser:
+    """Incremental parser of a server-sent event stream.
+
+    The bytes are fed in the pieces they arrive in. A SageMaker PayloadPart
+    or HTTP chunk can end in the middle of an event, or even of a UTF-8
+    character, and it can hold several events, so a line is only parsed once
+    its line ending has arrived. feed() returns the data of every event the
+    piece completed, flush() the one left at the end of the stream.
+    """
+
+    def __init__(self):
+        self.buffer = b""
+        self.data = []
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        lines = self.buffer.splitlines(keepends=True)
+        #the last line is incomplete without a line ending, and a \r at the end may still be followed by \n
+        if (lines and (not lines[-1].endswith((b"\n", b"\r")) or lines[-1].endswith(b"\r"))):
+            self.buffer = lines.pop()
+        else:
+            self.buffer = b""
+        events = []
+        for line in lines:
+            self.line(line.rstrip(b"\r\n").decode("utf-8"), events)
+        return events
+
+    def flush(self):
+        events = []
+        if (self.buffer):
+            self.line(self.buffer.rstrip(b"\r\n").decode("utf-8"), events)
+            self.buffer = b""
+        self.line("", events)
+        return events
+
+    def line(self, line, events):
+        if (not line):
+            #a blank line ends the event
+            if (self.data):
+                events.append("\n".join(self.data))
+                self.data = []
+            return
+        if (line.startswith(":")):
+            return
+        field, _, value = line.partition(":")
+        if (field == "data"):
+            self.data.append(value[1:] if (value.startswith(" ")) else value)
+
+
+def parse_events(events):
+    #the JSON chunks of the events, the closing [DONE] of the OpenAI API is not one
+    return [json.loads(data) for data in events if (data != "[DONE]")]
+
+
+def chunk_text(chunk):
+    #the new text of a completion or chat completion chunk
+    choice = (chunk.get("choices") or [{}])[0]
+    return choice.get("text") or (choice.get("delta") or {}).get("content") or ""
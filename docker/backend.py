@@ -0,0 +1,222 @@
+import asyncio
+import time
+import httpx
+from scheduler import SlotScheduler, worker_share
+from prefix_index import PrefixIndex, prefix_hashes
+from coordinator import SharedScheduler, SharedPrefixIndex
+
+
+class Backend:
+    """One server.cpp process: its connection pool, slot scheduler and prefix index.
+
+    With a coordinator client the scheduler and prefix index live in the
+    coordinator and are shared with the other gateway workers. Without one,
+    each of workers gateway workers admits its share of the slots and queue.
+    """
+
+    def __init__(self, name, url, n_slots, max_queue, max_wait, max_connections=512, keepalive_expiry=30.0, pin_slots=False, prefix_block=256, fixed_slots=False, shared=None, workers=1):
+        self.name = name
+        self.url = url
+        self.pin_slots = pin_slots
+        self.prefix_block = prefix_block
+        self.fixed_slots = fixed_slots
+        self.workers = 1 if (shared is not None) else workers
+        self.client = httpx.AsyncClient(
+            base_url=url,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=keepalive_expiry),
+            timeout=httpx.Timeout(None, connect=10.0)
+        )
+        self.health = False
+        self.health_checked = 0.0
+        self.health_lock = asyncio.Lock()
+        #recent prompt and generation speed in tokens per second, None until server.cpp reported one
+        self.prompt_speed = None
+        self.generation_speed = None
+        #context tokens of one slot, None until server.cpp reported it
+        self.n_ctx = None
+        if (shared is not None):
+            self.prefix_index = SharedPrefixIndex(shared, url)
+            self.scheduler = SharedScheduler(shared, url, n_slots, max_queue, max_wait, pin=pin_slots, labels={"model": name, "instance": url.rsplit(":", 1)[1]})
+        else:
+            self.prefix_index = PrefixIndex()
+            self.scheduler = SlotScheduler(worker_share(n_slots, self.workers), worker_share(max_queue, self.workers), max_wait, index=self.prefix_index if (pin_slots) else None)
+
+    @property
+    def idle(self):
+        return self.scheduler.busy == 0 and self.scheduler.queue_depth == 0
+
+    @property
+    def outstanding(self):
+        return self.scheduler.busy + self.scheduler.queue_depth
+
+    @property
+    def members(self):
+        return [self]
+
+    def pick(self):
+        return self
+
+    async def refresh_slots(self, timeout=0):
+        #take the slot count and the context size of a slot from server.cpp /props once it answers
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                props = (await self.client.get("/props")).json()
+                if (props.get("total_slots")):
+                    if (not self.fixed_slots):
+                        self.scheduler.resize(worker_share(props["total_slots"], self.workers))
+                    self.n_ctx = props.get("default_generation_settings", {}).get("n_ctx")
+                    return
+            except (httpx.HTTPError, ValueError):
+                pass
+            if (time.monotonic() >= deadline):
+                return
+            await asyncio.sleep(1)
+
+    async def wait_healthy(self, timeout):
+        deadline = time.monotonic() + timeout
+        while (time.monotonic() < deadline):
+            try:
+                if ((await self.client.get("/health")).status_code == 200):
+                    return True
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+        return False
+
+    async def drain(self, timeout):
+        #wait until no request of any worker uses this process
+        deadline = time.monotonic() + timeout
+        while True:
+            if (isinstance(self.scheduler, SharedScheduler)):
+                await self.scheduler.sync()
+            if (self.idle or time.monotonic() >= deadline):
+                return self.idle
+            await asyncio.sleep(0.5)
+
+    async def healthy(self, max_age=1.0):
+        #one /health request per max_age seconds however often the gateway is pinged
+        async with self.health_lock:
+            if (time.monotonic() - self.health_checked >= max_age):
+                try:
+                    self.health = (await self.client.get("/health", timeout=2.0)).status_code == 200
+                except httpx.HTTPError:
+                    self.health = False
+                self.health_checked = time.monotonic()
+            return self.health
+
+    def failed(self):
+        #a failed request takes the backend out of rotation until its next health check passes
+        self.health = False
+        self.health_checked = time.monotonic()
+
+    def prompt_prefix(self, prompt):
+        if (not self.pin_slots or not isinstance(prompt, str)):
+            return None
+        return prefix_hashes(prompt, self.prefix_block)
+
+    def record_prefix(self, slot, prompt, data):
+        if (data.get("tokens_evaluated") is not None and data.get("timings") is not None):
+            self.prefix_index.record(data["tokens_evaluated"], data["timings"].get("prompt_n", data["tokens_evaluated"]))
+        if (self.pin_slots and isinstance(prompt, str) and data.get("content") is not None):
+            #the slot now caches the prompt followed by the generated text
+            self.prefix_index.update(slot, prefix_hashes(prompt + data["content"], self.prefix_block))
+
+    def record_timings(self, data, weight=0.2):
+        timings = data.get("timings") or {}
+        if (timings.get("prompt_per_second") and timings.get("prompt_n", 0) >= 8):
+            self.prompt_speed = timings["prompt_per_second"] if (self.prompt_speed is None) else (1 - weight) * self.prompt_speed + weight * timings["prompt_per_second"]
+        if (timings.get("predicted_per_second") and timings.get("predicted_n", 0) >= 2):
+            self.generation_speed = timings["predicted_per_second"] if (self.generation_speed is None) else (1 - weight) * self.generation_speed + weight * timings["predicted_per_second"]
+
+    def tokens_within(self, seconds, prompt, margin=0.9):
+        #tokens server.cpp can generate in seconds after processing prompt, at its recent speed
+        if (not self.generation_speed):
+            return None
+        #about 4 bytes per token until the prompt is tokenized, an upper bound with a prefix cache hit
+        prompt_tokens = len(prompt) if (isinstance(prompt, list)) else len(prompt.encode("utf-8")) / 4
+        prefill = prompt_tokens / self.prompt_speed if (self.prompt_speed) else 0.0
+        return max(1, int((seconds - prefill) * self.generation_speed * margin))
+
+    def pin(self, postData, slot):
+        if (self.pin_slots):
+            postData["slot_id"] = slot
+            postData["id_slot"] = slot
+
+    def headers(self):
+        return {
+            "X-Queue-Depth": str(self.scheduler.queue_depth),
+            "X-Slots-Busy": str(self.scheduler.busy),
+            "X-Slots-Total": str(self.scheduler.n_slots)
+        }
+
+    def stats(self):
+        return {"scheduler": self.scheduler.stats(), "prefix_cache": self.prefix_index.stats()}
+
+    async def aclose(self):
+        if (isinstance(self.scheduler, SharedScheduler)):
+            self.scheduler.client.unregister(self.url)
+        await self.client.aclose()
+
+
+class BackendPool:
+    """Several server.cpp processes serving the same model, e.g. one per NUMA node.
+
+    Requests go to the healthy process with the fewest outstanding requests.
+    When no process is known to be healthy all of them are tried, so a stale
+    health check never blocks traffic completely.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self.name = backends[0].name
+        self.url = backends[0].url
+        self.next = 0
+        self.picks = [0] * len(backends)
+
+    @property
+    def members(self):
+        return self.backends
+
+    @property
+    def idle(self):
+        return all(backend.idle for backend in self.backends)
+
+    def pick(self):
+        candidates = [i for i, backend in enumerate(self.backends) if backend.health] or range(len(self.backends))
+        #ties go round robin, so an idle pool still spreads its requests
+        self.next = (self.next + 1) % len(self.backends)
+        best = min(candidates, key=lambda i: (self.backends[i].outstanding, (i - self.next) % len(self.backends)))
+        self.picks[best] += 1
+        return self.backends[best]
+
+    async def refresh_slots(self, timeout=0):
+        await asyncio.gather(*[backend.refresh_slots(timeout) for backend in self.backends])
+
+    async def wait_healthy(self, timeout):
+        return all(await asyncio.gather(*[backend.wait_healthy(timeout) for backend in self.backends]))
+
+    async def drain(self, timeout):
+        return all(await asyncio.gather(*[backend.drain(timeout) for backend in self.backends]))
+
+    async def healthy(self, max_age=1.0):
+        return any(await asyncio.gather(*[backend.healthy(max_age) for backend in self.backends]))
+
+    def headers(self):
+        return {
+            "X-Queue-Depth": str(sum(backend.scheduler.queue_depth for backend in self.backends)),
+            "X-Slots-Busy": str(sum(backend.scheduler.busy for backend in self.backends)),
+            "X-Slots-Total": str(sum(backend.scheduler.n_slots for backend in self.backends))
+        }
+
+    def stats(self):
+        return {
+            "instances": [
+                {"url": backend.url, "healthy": backend.health, "outstanding": backend.outstanding, "picked": picks, **backend.stats()}
+                for backend, picks in zip(self.backends, self.picks)
+            ]
+        }
+
+    async def aclose(self):
+        for backend in self.backends:
+            await backend.aclose()
@@ -0,0 +1,71 @@
+import collections
+import time
+
+
+class LRUCache:
+    """Least-recently-used cache bounded by entry count, total size and age.
+
+    A limit of 0 disables that bound. Sizes are whatever unit the caller
+    passes to put(), usually bytes.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0, ttl=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if (item is None):
+            self.misses += 1
+            return None
+        value, size, expires = item
+        if (expires and expires < time.monotonic()):
+            self.drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, size=1):
+        if (self.max_bytes and size > self.max_bytes):
+            return
+        self.drop(key)
+        self.entries[key] = (value, size, time.monotonic() + self.ttl if (self.ttl) else 0)
+        self.bytes += size
+        while ((self.max_entries and len(self.entries) > self.max_entries) or (self.max_bytes and self.bytes > self.max_bytes)):
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def drop(self, key):
+        item = self.entries.pop(key, None)
+        if (item is not None):
+            self.bytes -= item[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if (lookups) else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations
+        }
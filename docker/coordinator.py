@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+from cache import LRUCache
+from metrics import Metrics
+from prefix_index import PrefixIndex
+from scheduler import SlotScheduler, QueueFullError, QueueTimeoutError
+
+#responses and prefix lists can be long, the asyncio default of 64 KiB per line is not enough
+LINE_LIMIT = 64 * 1024 * 1024
+
+
+def encode(message):
+    return json.dumps(message, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+class Connection:
+    """One gateway worker connected to the coordinator, with the slots it holds."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        #request id -> (backend, slot) of every slot handed to this worker and not released yet
+        self.held = {}
+        self.tasks = {}
+
+    def send(self, message):
+        if (not self.writer.is_closing()):
+            self.writer.write(encode(message))
+
+
+class Coordinator:
+    """State shared by all gateway workers of a container.
+
+    Workers connect to a Unix socket and exchange JSON lines with it. The
+    coordinator runs the slot scheduler and prefix index of every server.cpp
+    process, the response cache and the table of multi-model endpoint models,
+    so every worker sees the same free slots, queue, cached responses and
+    loaded models, and forwards events such as a model swap from one worker to
+    the others. The slots of a worker that disconnects are released.
+    """
+
+    def __init__(self, response_cache, metrics=None):
+        self.response_cache = response_cache
+        self.metrics = metrics
+        self.backends = {}
+        self.connections = set()
+        #models loaded by any worker, least recently used first, and the connection of the worker running each one
+        self.models = collections.OrderedDict()
+        self.model_owners = {}
+        self.started = time.time()
+
+    def state(self, key):
+        scheduler = self.backends[key][0]
+        return {"busy": scheduler.busy, "queue": scheduler.queue_depth, "slots": scheduler.n_slots}
+
+    async def serve(self, path):
+        if (os.path.exists(path)):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path=path, limit=LINE_LIMIT)
+        print(f"coordinator listening on {path}")
+        async with server:
+            if (self.metrics is not None):
+                asyncio.create_task(self.flush_metrics())
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        connection = Connection(writer)
+        self.connections.add(connection)
+        try:
+            while True:
+                line = await reader.readline()
+                if (not line):
+                    break
+                try:
+                    self.dispatch(connection, json.loads(line))
+                except (KeyError, TypeError, ValueError) as e:
+                    print(f"coordinator: ignoring malformed message {line[:200]!r}: {type(e).__name__}: {e}")
+                await writer.drain()
+        except ConnectionError as e:
+            print(f"coordinator: dropping worker connection after {type(e).__name__}: {e}")
+        finally:
+            self.connections.discard(connection)
+            for task in list(connection.tasks.values()):
+                task.cancel()
+            for key, slot in connection.held.values():
+                if (key in self.backends):
+                    self.backends[key][0].release(slot)
+            connection.held.clear()
+            #models the worker was still loading never become available, the loaded ones keep serving
+            for name in [name for name, owner in self.model_owners.items() if (owner is connection and self.models[name].get("loading"))]:
+                del self.models[name]
+                del self.model_owners[name]
+            writer.close()
+
+    def dispatch(self, connection, message):
+        op = message["op"]
+        key = message.get("backend")
+        reply = {}
+        if (key is not None and key not in self.backends and op != "register"):
+            #a coordinator restarted since the worker registered, the worker registers again when it reconnects
+            if ("id" in message):
+                connection.send({"id": message["id"], "error": f"unknown backend {key}"})
+            return
+        if (op == "acquire"):
+            self.touch_model(key)
+            connection.tasks[message["id"]] = asyncio.create_task(self.acquire(connection, message))
+            return
+        if (op == "register"):
+            #every worker registers the server.cpp processes it knows, the first registration creates the scheduler
+            if (key not in self.backends):
+                index = PrefixIndex() if (message.get("pin")) else None
+                self.backends[key] = (SlotScheduler(message["slots"], message["max_queue"], message["max_wait"], index=index), message.get("labels") or {})
+        elif (op == "release"):
+            for request, held in list(connection.held.items()):
+                if (held == (key, message["slot"])):
+                    del connection.held[request]
+                    self.backends[key][0].release(message["slot"])
+                    break
+        elif (op == "cancel"):
+            #the worker gave up waiting, either the wait is cancelled or the slot it was just given is freed
+            task = connection.tasks.pop(message["request"], None)
+            if (task is not None):
+                task.cancel()
+            held = connection.held.pop(message["request"], None)
+            if (held is not None and held[0] in self.backends):
+                self.backends[held[0]][0].release(held[1])
+        elif (op == "resize"):
+            self.backends[key][0].resize(message["slots"])
+        elif (op == "state"):
+            pass
+        elif (op == "prefix"):
+            index = self.backends[key][0].index
+            if (index is not None):
+                index.update(message["slot"], message["hashes"])
+        elif (op == "forget"):
+            index = self.backends[key][0].index
+            if (index is not None):
+                index.forget(message.get("slot"))
+        elif (op == "cache_get"):
+            reply["value"] = self.response_cache.get(message["key"])
+        elif (op == "cache_put"):
+            self.response_cache.put(message["key"], message["value"], size=message["size"])
+        elif (op == "cache_clear"):
+            self.response_cache.clear()
+        elif (op == "publish"):
+            self.publish(connection, message["event"])
+        elif (op == "model_reserve"):
+            reply = self.reserve_model(connection, message)
+        elif (op == "model_loaded"):
+            #also sent again after a reconnect, so a restarted coordinator learns the models back
+            model = message["model"]
+            self.models[model["name"]] = model
+            self.model_owners[model["name"]] = connection
+            self.publish(connection, {"type": "model_loaded", "model": model})
+        elif (op == "model_unload"):
+            #a model another worker is still loading can only be unloaded once it is loaded
+            loading = self.models.get(message["name"], {}).get("loading") and self.model_owners.get(message["name"]) is not connection
+            model = None if (loading) else self.remove_model(connection, message["name"])
+            if (model is None):
+                reply["error"] = "not_loaded"
+            else:
+                reply["model"] = model
+        elif (op == "models"):
+            reply["models"] = [model for model in self.models.values() if (not model.get("loading"))]
+        elif (op == "stats"):
+            reply = self.stats()
+        else:
+            reply["error"] = f"unknown op {op}"
+        if (key in self.backends):
+            reply.update(backend=key, state=self.state(key))
+        if ("id" in message):
+            connection.send({"id": message["id"], **reply})
+
+    def publish(self, connection, event):
+        for other in self.connections:
+            if (other is not connection):
+                other.send({"event": event})
+
+    def touch_model(self, key):
+        for name, model in self.models.items():
+            if (model.get("backend") == key):
+                self.models.move_to_end(name)
+                return
+
+    def model_idle(self, model):
+        scheduler = self.backends.get(model.get("backend"), (None,))[0]
+        return scheduler is None or (scheduler.busy == 0 and scheduler.queue_depth == 0)
+
+    def remove_model(self, connection, name):
+        #the worker running the model stops it when it gets the event, the caller when that worker is gone
+        model = self.models.pop(name, None)
+        owner = self.model_owners.pop(name, None)
+        if (model is None):
+            return None
+        self.backends.pop(model.get("backend"), None)
+        model = {**model, "orphaned": owner is not connection and owner not in self.connections}
+        self.publish(connection, {"type": "model_unloaded", "model": model})
+        return model
+
+    def reserve_model(self, connection, message):
+        #the memory budget is shared by the models of all workers, the least recently used idle ones make room
+        if (message["name"] in self.models):
+            return {"error": "exists"}
+        used = sum(model["size"] for model in self.models.values())
+        victims = []
+        for model in self.models.values():
+            if (used + message["size"] <= message["budget"]):
+                break
+            if (not model.get("loading") and self.model_idle(model)):
+                victims.append(model["name"])
+                used -= model["size"]
+        if (used + message["size"] > message["budget"]):
+            return {"error": "no_memory"}
+        self.models[message["name"]] = {"name": message["name"], "size": message["size"], "loading": True}
+        self.model_owners[message["name"]] = connection
+        return {"victims": [self.remove_model(connection, name) for name in victims]}
+
+    async def acquire(self, connection, message):
+        key = message["backend"]
+        reply = {"id": message["id"], "backend": key}
+        try:
+            slot = await self.backends[key][0].acquire(message.get("prefix"), message.get("timeout"))
+            connection.held[message["id"]] = (key, slot)
+            reply["slot"] = slot
+        except QueueFullError:
+            reply["error"] = "full"
+        except QueueTimeoutError:
+            reply["error"] = "timeout"
+        except asyncio.CancelledError:
+            return
+        finally:
+            connection.tasks.pop(message["id"], None)
+        #the backend is gone when its model was unloaded during the wait
+        connection.send({**reply, **({"state": self.state(key)} if (key in self.backends) else {})})
+
+    async def flush_metrics(self):
+        #the slot gauges of the whole container, the workers only write their own histograms and counters
+        while True:
+            for key, (scheduler, labels) in self.backends.items():
+                self.metrics.set("llama_slots_busy", labels, scheduler.busy)
+                self.metrics.set("llama_slots_total", labels, scheduler.n_slots)
+                self.metrics.set("llama_queue_depth", labels, scheduler.queue_depth)
+            try:
+                self.metrics.flush(force=True)
+            except OSError as e:
+                print(f"coordinator: writing metrics failed: {e}")
+            await asyncio.sleep(1)
+
+    def stats(self):
+        return {
+            "workers": len(self.connections),
+            "uptime": round(time.time() - self.started, 1),
+            "backends": {
+                key: {"labels": labels, "scheduler": scheduler.stats(), **({"prefix_cache": scheduler.index.stats()} if (scheduler.index is not None) else {})}
+                for key, (scheduler, labels) in self.backends.items()
+            },
+            "models": {name: {"size": model["size"], "loading": model.get("loading", False), "backend": model.get("backend")} for name, model in self.models.items()},
+            "response_cache": self.response_cache.stats()
+        }
+
+
+class CoordinatorClient:
+    """Connection of one gateway worker to the coordinator.
+
+    Calls are multiplexed over a single connection by request id. Backends
+    registered and models announced before a connection is lost are sent
+    again when the worker reconnects.
+    """
+
+    def __init__(self, path, on_event=None):
+        self.path = path
+        self.on_event = on_event
+        self.reader = None
+        self.writer = None
+        self.lock = None
+        self.next_id = 0
+        self.pending = {}
+        self.registrations = {}
+        self.schedulers = {}
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def connect(self, timeout=0):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+                break
+            except OSError:
+                if (time.monotonic() >= deadline):
+                    raise
+                await asyncio.sleep(0.2)
+        for message in self.registrations.values():
+            self.write(message)
+        asyncio.create_task(self.read(self.reader, self.writer))
+
+    async def read(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if (not line):
+                    break
+                message = json.loads(line)
+                if ("event" in message):
+                    if (self.on_event is not None):
+                        self.on_event(message["event"])
+                    continue
+                if ("state" in message and message.get("backend") in self.schedulers):
+                    self.schedulers[message["backend"]].update(message["state"])
+                future = self.pending.pop(message.get("id"), None)
+                if (future is not None and not future.done()):
+                    future.set_result(message)
+        except (ConnectionError, ValueError) as e:
+            print(f"coordinator connection lost: {type(e).__name__}: {e}")
+        finally:
+            if (self.writer is writer):
+                self.reader = self.writer = None
+            writer.close()
+            pending, self.pending = self.pending, {}
+            for future in pending.values():
+                if (not future.done()):
+                    future.set_exception(ConnectionError("coordinator connection lost"))
+
+    def write(self, message):
+        self.writer.write(encode(message))
+
+    async def ensure_connected(self):
+        if (self.lock is None):
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if (self.writer is None):
+                try:
+                    await self.connect(timeout=5)
+                except OSError as e:
+                    #e.g. the socket is missing while serve restarts the coordinator
+                    raise ConnectionError(f"coordinator unavailable: {e}") from e
+
+    async def request(self, op, **fields):
+        #returns the request id and the future of its reply, so a waiting call can be cancelled at the coordinator
+        if (self.writer is None):
+            await self.ensure_connected()
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        self.write({"id": self.next_id, "op": op, **fields})
+        return self.next_id, future
+
+    async def call(self, op, **fields):
+        _, future = await self.request(op, **fields)
+        return await future
+
+    def send(self, op, **fields):
+        #fire and forget, dropped while disconnected since the coordinator then has already released this worker's slots
+        if (self.writer is not None):
+            self.next_id += 1
+            self.write({"id": self.next_id, "op": op, **fields})
+
+    def register(self, key, scheduler, message):
+        self.schedulers[key] = scheduler
+        self.announce(key, {"op": "register", **message})
+
+    def announce(self, key, message):
+        #state the coordinator must hold as long as this worker runs, sent again after a reconnect
+        self.registrations[key] = message
+        if (self.writer is not None):
+            self.write(message)
+
+    def unregister(self, key):
+        #the backend was closed or the model unloaded, not sent again after a reconnect
+        self.registrations.pop(key, None)
+        self.schedulers.pop(key, None)
+
+
+class SharedScheduler:
+    """The SlotScheduler of one server.cpp process, run by the coordinator for all workers.
+
+    busy, queue_depth and n_slots are the values of the last reply of the
+    coordinator, the admission counters are those of this worker.
+    """
+
+    def __init__(self, client, key, n_slots, max_queue, max_wait, pin=False, labels=None):
+        self.client = client
+        self.key = key
+        self.n_slots = n_slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.busy = 0
+        self.queue_depth = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        client.register(key, self, {"backend": key, "slots": n_slots, "max_queue": max_queue, "max_wait": max_wait, "pin": pin, "labels": labels})
+
+    def update(self, state):
+        self.busy = state["busy"]
+        self.queue_depth = state["queue"]
+        self.n_slots = state["slots"]
+
+    async def acquire(self, prefix=None, timeout=None):
+        request, future = await self.client.request("acquire", backend=self.key, prefix=[block.hex() for block in prefix] if (prefix) else None, timeout=timeout)
+        try:
+            reply = await future
+        except asyncio.CancelledError:
+            self.client.send("cancel", request=request)
+            raise
+        if (reply.get("error") == "full"):
+            self.rejected += 1
+            raise QueueFullError()
+        if (reply.get("error") == "timeout"):
+            self.timed_out += 1
+            raise QueueTimeoutError()
+        if ("error" in reply):
+            raise ConnectionError(f"coordinator: {reply['error']}")
+        self.admitted += 1
+        return reply["slot"]
+
+    def release(self, slot):
+        self.client.send("release", backend=self.key, slot=slot)
+
+    def resize(self, n_slots):
+        if (n_slots <= 0):
+            return
+        self.client.registrations[self.key]["slots"] = n_slots
+        self.client.send("resize", backend=self.key, slots=n_slots)
+
+    async def sync(self):
+        await self.client.call("state", backend=self.key)
+
+    def stats(self):
+        return {
+            "slots_total": self.n_slots,
+            "slots_busy": self.busy,
+            "queue_depth": self.queue_depth,
+            "queue_max": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out
+        }
+
+
+class SharedPrefixIndex(PrefixIndex):
+    """Sends slot contents to the prefix index in the coordinator, keeps this worker's cache hit counts."""
+
+    def __init__(self, client, key):
+        super().__init__()
+        self.client = client
+        self.key = key
+
+    def update(self, slot, hashes):
+        self.client.send("prefix", backend=self.key, slot=slot, hashes=[block.hex() for block in hashes])
+
+    def forget(self, slot=None):
+        self.client.send("forget", backend=self.key, slot=slot)
+
+
+parser = argparse.ArgumentParser(description="Shares slot scheduling, prefix indexes, the response cache and the loaded models between the gateway workers.")
+parser.add_argument("--socket", type=str, help="Unix socket the workers connect to(default: /tmp/llama-coordinator.sock)", default=os.environ.get("LLAMA_COORDINATOR_SOCKET", "/tmp/llama-coordinator.sock"))
+parser.add_argument("--response-cache-mb", type=float, help="Memory for cached responses of deterministic requests in MiB, 0 disables the cache(default: 0)", default=float(os.environ.get("LLAMA_RESPONSE_CACHE_MB", 0)))
+parser.add_argument("--response-cache-ttl", type=float, help="Seconds a cached response stays valid, 0 keeps it until evicted(default: 3600)", default=float(os.environ.get("LLAMA_RESPONSE_CACHE_TTL", 3600)))
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    metrics_dir = os.environ.get("LLAMA_METRICS_DIR")
+    coordinator = Coordinator(
+        LRUCache(max_bytes=int(args.response_cache_mb * 1024 * 1024), ttl=args.response_cache_ttl),
+        Metrics(metrics_dir) if (metrics_dir) else None
+    )
+    asyncio.run(coordinator.serve(args.socket))
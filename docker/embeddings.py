@@ -0,0 +1,172 @@
+import array
+import asyncio
+import base64
+import collections
+import hashlib
+import json
+import sys
+import httpx
+
+
+class EmbeddingError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def pack(vector):
+    #little-endian float32, the layout of base64 embeddings in the OpenAI API
+    packed = array.array("f", vector)
+    if (sys.byteorder != "little"):
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack(packed):
+    vector = array.array("f")
+    vector.frombytes(packed)
+    if (sys.byteorder != "little"):
+        vector.byteswap()
+    return vector.tolist()
+
+
+def encode(packed, encoding_format):
+    return base64.b64encode(packed).decode("ascii") if (encoding_format == "base64") else unpack(packed)
+
+
+class EmbeddingBatcher:
+    """Merges the texts of concurrent embedding requests into few server.cpp requests.
+
+    Texts are collected per backend for window_ms, or until max_batch of them
+    are waiting, and sent as one /v1/embeddings request holding one slot.
+    While every slot is busy the texts keep collecting into larger batches.
+    Vectors are kept packed as float32 in an LRU cache keyed by the model and
+    the hash of the text, and a text already waiting for its vector is not
+    sent again.
+    """
+
+    def __init__(self, cache, window_ms=5, max_batch=32):
+        self.cache = cache
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.queues = {}
+        self.starting = {}
+        self.waiting = {}
+        self.tasks = set()
+        self.batches = 0
+        self.texts = 0
+
+    async def embed(self, backend, texts):
+        #(packed vector, prompt tokens) of every text, in order
+        loop = asyncio.get_running_loop()
+        futures = []
+        for text in texts:
+            key = (backend.name, hashlib.sha256(text.encode("utf-8")).digest())
+            future = self.waiting.get(key)
+            if (future is None):
+                future = loop.create_future()
+                cached = self.cache.get(key)
+                if (cached is not None):
+                    future.set_result(cached)
+                else:
+                    self.waiting[key] = future
+                    self.enqueue(loop, backend, key, text, future)
+            futures.append(future)
+        #a cancelled request must not cancel vectors other requests wait for
+        return await asyncio.gather(*[asyncio.shield(future) for future in futures])
+
+    def enqueue(self, loop, backend, key, text, future):
+        queue = self.queues.setdefault(backend, collections.deque())
+        queue.append((key, text, future))
+        if (len(queue) == 1):
+            loop.call_later(self.window, self.flush, backend)
+        elif (len(queue) >= self.max_batch):
+            self.flush(backend)
+
+    def flush(self, backend):
+        #one more batch, unless the batches already waiting for a slot take all queued texts
+        queue = self.queues.get(backend)
+        starting = self.starting.get(backend, 0)
+        if (not queue or len(queue) <= starting * self.max_batch):
+            return
+        self.starting[backend] = starting + 1
+        task = asyncio.create_task(self.run(backend))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def take(self, backend):
+        queue = self.queues.get(backend)
+        batch = []
+        while (queue and len(batch) < self.max_batch):
+            batch.append(queue.popleft())
+        if (queue is not None and not queue):
+            #backends are replaced by model swaps, nothing may keep the old ones
+            del self.queues[backend]
+        return batch
+
+    def fail(self, batch, error):
+        for key, _, future in batch:
+            self.waiting.pop(key, None)
+            if (not future.done()):
+                future.set_exception(error)
+                #nobody may be left waiting for it
+                future.exception()
+
+    async def run(self, backend):
+        #texts are taken once a slot is free, so they collect while server.cpp is busy
+        member = backend.pick()
+        try:
+            slot = await member.scheduler.acquire()
+        except Exception as e:
+            self.fail(self.take(backend), e)
+            return
+        finally:
+            self.starting[backend] -= 1
+            if (self.starting[backend] == 0):
+                del self.starting[backend]
+        try:
+            while True:
+                batch = self.take(backend)
+                if (not batch):
+                    return
+                try:
+                    results = await self.request(member, [text for _, text, _ in batch])
+                except Exception as e:
+                    self.fail(batch, e)
+                    return
+                for (key, _, future), result in zip(batch, results):
+                    self.waiting.pop(key, None)
+                    if (self.cache.max_bytes > 0):
+                        self.cache.put(key, result, size=len(result[0]) + 64)
+                    if (not future.done()):
+                        future.set_result(result)
+        finally:
+            member.scheduler.release(slot)
+            self.flush(backend)
+
+    async def request(self, member, texts):
+        try:
+            response = await member.client.post("/v1/embeddings", content=json.dumps({"input": texts}))
+        except httpx.TransportError:
+            member.failed()
+            raise
+        if (response.status_code >= 400):
+            raise EmbeddingError(response.status_code, f"server.cpp answered {response.status_code}: {response.text}")
+        data = response.json()
+        vectors = [item["embedding"] for item in sorted(data["data"], key=lambda item: item["index"])]
+        if (len(vectors) != len(texts)):
+            raise EmbeddingError(502, f"server.cpp returned {len(vectors)} embeddings for {len(texts)} texts")
+        #server.cpp only reports the tokens of the whole batch, they are split by text length
+        total = data.get("usage", {}).get("prompt_tokens", 0)
+        length = sum(len(text) for text in texts) or 1
+        self.batches += 1
+        self.texts += len(texts)
+        return [(pack(vector), round(total * len(text) / length)) for vector, text in zip(vectors, texts)]
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "texts": self.texts,
+            "mean_batch_size": self.texts / self.batches if (self.batches) else 0.0,
+            "cache": self.cache.stats()
+        }
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+import argparse
+import mmap
+import os
+import struct
+import sys
+
+
+class GGUFError(Exception):
+    pass
+
+
+#value types of the GGUF key/value section
+SCALARS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+STRING, ARRAY = 8, 9
+#arrays longer than this, such as the vocabulary, are skipped and only read on demand
+MAX_ARRAY = 1024
+
+#llama_ftype values of general.file_type
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1", 10: "Q2_K",
+    11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M", 16: "Q5_K_S", 17: "Q5_K_M",
+    18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S", 22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S",
+    25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M", 28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16"
+}
+
+
+class SkippedArray:
+    def __init__(self, type, count, offset):
+        self.type = type
+        self.count = count
+        self.offset = offset
+
+
+class Reader:
+    def __init__(self, buf):
+        self.buf = buf
+        self.offset = 0
+
+    def scalar(self, type):
+        fmt = SCALARS.get(type)
+        if (fmt is None):
+            raise GGUFError(f"unknown value type {type}")
+        value = struct.unpack_from(fmt, self.buf, self.offset)[0]
+        self.offset += struct.calcsize(fmt)
+        return value
+
+    def string(self):
+        length = self.scalar(10)
+        value = bytes(self.buf[self.offset:self.offset + length]).decode("utf-8", "replace")
+        self.offset += length
+        return value
+
+    def skip(self, type):
+        if (type == STRING):
+            self.offset += 8 + self.scalar(10)
+        elif (type == ARRAY):
+            item_type, count = self.scalar(4), self.scalar(10)
+            for _ in range(count):
+                self.skip(item_type)
+        else:
+            self.offset += struct.calcsize(SCALARS[type])
+
+    def value(self, type):
+        if (type == STRING):
+            return self.string()
+        if (type != ARRAY):
+            return self.scalar(type)
+        item_type, count = self.scalar(4), self.scalar(10)
+        if (count > MAX_ARRAY):
+            array = SkippedArray(item_type, count, self.offset)
+            if (item_type in SCALARS):
+                self.offset += count * struct.calcsize(SCALARS[item_type])
+            else:
+                for _ in range(count):
+                    self.skip(item_type)
+            return array
+        return [self.value(item_type) for _ in range(count)]
+
+    def item(self, array, index):
+        #one element of a skipped array, strings have to be walked to
+        self.offset = array.offset
+        for _ in range(index):
+            self.skip(array.type)
+        return self.value(array.type)
+
+
+class GGUFInfo:
+    """Metadata of a GGUF model file."""
+
+    def __init__(self, path, version, metadata, eos_token=None, bos_token=None):
+        self.path = path
+        self.version = version
+        self.metadata = metadata
+        self.eos_token = eos_token
+        self.bos_token = bos_token
+
+    def get(self, key, default=None):
+        return self.metadata.get(key, default)
+
+    def arch(self, key, default=None):
+        return self.metadata.get(f"{self.architecture}.{key}", default)
+
+    @property
+    def architecture(self):
+        return self.metadata.get("general.architecture")
+
+    @property
+    def name(self):
+        return self.metadata.get("general.name")
+
+    @property
+    def context_length(self):
+        return self.arch("context_length")
+
+    @property
+    def chat_template(self):
+        return self.metadata.get("tokenizer.chat_template")
+
+    @property
+    def quantization(self):
+        file_type = self.metadata.get("general.file_type")
+        return FILE_TYPES.get(file_type, str(file_type)) if (file_type is not None) else None
+
+    def kv_bytes_per_token(self, type_size=2):
+        #K and V of every layer, f16 unless server.cpp quantizes the cache
+        layers, embedding = self.arch("block_count"), self.arch("embedding_length")
+        heads = self.arch("attention.head_count")
+        heads_kv = self.arch("attention.head_count_kv", heads)
+        if (not layers or not heads or not embedding):
+            return None
+        #some architectures list the head counts per layer
+        if (isinstance(heads, list)):
+            heads = max(heads)
+        kv_heads = sum(heads_kv) if (isinstance(heads_kv, list)) else heads_kv * layers
+        key_length = self.arch("attention.key_length", embedding // heads)
+        value_length = self.arch("attention.value_length", key_length)
+        return kv_heads * (key_length + value_length) * type_size
+
+    def describe(self):
+        return {
+            "architecture": self.architecture,
+            "name": self.name,
+            "context_length": self.context_length,
+            "quantization": self.quantization,
+            "eos_token": self.eos_token,
+            "bos_token": self.bos_token,
+            "kv_bytes_per_token": self.kv_bytes_per_token(),
+            "chat_template": self.chat_template
+        }
+
+
+def read_metadata(path):
+    #the file is memory-mapped, only the pages of the header are ever read from disk
+    with open(path, "rb") as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise GGUFError(f"{path} is empty")
+    try:
+        view = memoryview(buf)
+        try:
+            return parse(path, view)
+        finally:
+            view.release()
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise GGUFError(f"{path} has a truncated or invalid GGUF header: {e}")
+    finally:
+        buf.close()
+
+
+def parse(path, buf):
+    if (bytes(buf[:4]) != b"GGUF"):
+        raise GGUFError(f"{path} is not a GGUF file")
+    reader = Reader(buf)
+    reader.offset = 4
+    version = reader.scalar(4)
+    if (version < 2):
+        raise GGUFError(f"{path} uses GGUF version {version}, only 2 and later are supported")
+    reader.scalar(10)
+    kv_count = reader.scalar(10)
+    metadata = {}
+    for _ in range(kv_count):
+        key = reader.string()
+        metadata[key] = reader.value(reader.scalar(4))
+
+    tokens = metadata.get("tokenizer.ggml.tokens")
+    special = {}
+    for name in ("eos", "bos"):
+        token_id = metadata.get(f"tokenizer.ggml.{name}_token_id")
+        if (token_id is None or tokens is None):
+            continue
+        if (isinstance(tokens, SkippedArray)):
+            if (token_id < tokens.count):
+                special[name] = reader.item(tokens, token_id)
+        elif (token_id < len(tokens)):
+            special[name] = tokens[token_id]
+    #the skipped arrays point into the mapping that is closed next
+    metadata = {key: value for key, value in metadata.items() if not isinstance(value, SkippedArray)}
+    return GGUFInfo(path, version, metadata, special.get("eos"), special.get("bos"))
+
+
+def pick_ctx_size(info, slots, memory_bytes=0, kv_memory_bytes=0, min_per_slot=512, max_per_slot=8192, memory_fraction=0.8, reserve_bytes=1 << 30, default=2048):
+    #every slot gets the trained context up to max_per_slot, as far as the KV cache fits next to the model
+    per_token = info.kv_bytes_per_token() if (info is not None) else None
+    trained = info.context_length if (info is not None) else None
+    if (not per_token or not trained):
+        return default
+    slots = max(1, slots)
+    ctx = min(trained, max_per_slot or trained) * slots
+    budget = kv_memory_bytes or (kv_budget(memory_bytes, os.path.getsize(info.path), memory_fraction, reserve_bytes) if (memory_bytes) else None)
+    if (budget is not None):
+        ctx = min(ctx, budget // per_token)
+    #every slot keeps a usable context even if the memory is short
+    ctx = max(ctx, min_per_slot * slots)
+    return int(ctx // (256 * slots) * 256 * slots)
+
+
+def kv_budget(memory_bytes, model_bytes, memory_fraction=0.8, reserve_bytes=1 << 30):
+    #llama.cpp commits the whole KV cache up front, so room is left for its compute buffers, the gateway and the page cache
+    return max(0, int(memory_bytes * memory_fraction) - reserve_bytes - model_bytes)
+
+
+#prompt formats of the chat template families, detected the way llama.cpp does by marker strings
+CHAT_FORMATS = {
+    "chatml": {
+        "system": ("<|im_start|>system\n", "<|im_end|>\n"),
+        "user": ("<|im_start|>user\n", "<|im_end|>\n"),
+        "assistant": ("<|im_start|>assistant\n", "<|im_end|>\n"),
+        "stop": ["<|im_end|>"]
+    },
+    "llama3": {
+        "system": ("<|start_header_id|>system<|end_header_id|>\n\n", "<|eot_id|>"),
+        "user": ("<|start_header_id|>user<|end_header_id|>\n\n", "<|eot_id|>"),
+        "assistant": ("<|start_header_id|>assistant<|end_header_id|>\n\n", "<|eot_id|>"),
+        "stop": ["<|eot_id|>"]
+    },
+    "gemma": {
+        #gemma has no system role, the rules are a user turn
+        "system": ("<start_of_turn>user\n", "<end_of_turn>\n"),
+        "user": ("<start_of_turn>user\n", "<end_of_turn>\n"),
+        "assistant": ("<start_of_turn>model\n", "<end_of_turn>\n"),
+        "stop": ["<end_of_turn>"]
+    },
+    "phi3": {
+        "system": ("<|system|>\n", "<|end|>\n"),
+        "user": ("<|user|>\n", "<|end|>\n"),
+        "assistant": ("<|assistant|>\n", "<|end|>\n"),
+        "stop": ["<|end|>"]
+    },
+    "zephyr": {
+        "system": ("<|system|>\n", "</s>\n"),
+        "user": ("<|user|>\n", "</s>\n"),
+        "assistant": ("<|assistant|>\n", "</s>\n"),
+        "stop": ["</s>"]
+    },
+    "llama2": {
+        #Llama 2 and Mistral, the system prompt is an instruction of its own
+        "system": ("[INST] ", " [/INST]"),
+        "user": ("[INST] ", " [/INST]"),
+        "assistant": ("", "</s>"),
+        "stop": ["</s>"]
+    }
+}
+MARKERS = [
+    ("<|im_start|>", "chatml"),
+    ("<|start_header_id|>", "llama3"),
+    ("<start_of_turn>", "gemma"),
+    ("<|end|>", "phi3"),
+    ("<|user|>", "zephyr"),
+    ("[INST]", "llama2")
+]
+
+
+def detect_chat_format(template):
+    if (not template):
+        return None
+    return next((name for marker, name in MARKERS if marker in template), None)
+
+
+def chat_format(name, eos_token=None):
+    #preamble, (prefix, suffix) of every role, the prompt that starts the answer and the stop strings
+    fmt = CHAT_FORMATS[name]
+    stop = list(fmt["stop"])
+    if (eos_token and eos_token not in stop):
+        stop.append(eos_token)
+    return {"name": name, "preamble": "", **fmt, "generation": fmt["assistant"][0], "stop": stop}
+
+
+def memory_mb():
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if (line.startswith("MemAvailable:")):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reads the metadata of a GGUF model, or the context size server.sh starts server.cpp with.")
+    parser.add_argument("model", type=str, help="GGUF model file")
+    parser.add_argument("--ctx-size", action="store_true", help="Print the context size for --slots slots instead of the metadata")
+    parser.add_argument("--slots", type=int, help="Parallel slots of server.cpp(default: 1)", default=1)
+    parser.add_argument("--memory-mb", type=float, help="Memory for the model and its KV cache in MiB(default: available host memory)", default=0)
+    parser.add_argument("--kv-memory-mb", type=float, help="Memory for the KV cache alone in MiB, overrides --memory-mb(default: 0)", default=0)
+    parser.add_argument("--max-ctx-per-slot", type=int, help="Largest context of a slot, 0 allows the trained context(default: 8192)", default=int(os.environ.get("LLAMA_MAX_CTX_PER_SLOT", 8192)))
+    parser.add_argument("--memory-fraction", type=float, help="Share of --memory-mb the model and its KV cache may use(default: 0.8)", default=float(os.environ.get("LLAMA_MEMORY_FRACTION", 0.8)))
+    parser.add_argument("--reserve-mb", type=float, help="Memory kept free of --memory-mb for compute buffers and the OS in MiB(default: 1024)", default=float(os.environ.get("LLAMA_MEMORY_RESERVE_MB", 1024)))
+    args = parser.parse_args()
+
+    try:
+        info = read_metadata(args.model)
+    except (OSError, GGUFError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    if (args.ctx_size):
+        print(pick_ctx_size(info, args.slots, int((args.memory_mb or memory_mb()) * 1024 * 1024), int(args.kv_memory_mb * 1024 * 1024),
+            max_per_slot=args.max_ctx_per_slot, memory_fraction=args.memory_fraction, reserve_bytes=int(args.reserve_mb * 1024 * 1024)))
+    else:
+        describe = info.describe()
+        describe["chat_format"] = detect_chat_format(info.chat_template)
+        for key, value in describe.items():
+            print(f"{key}: {value}")
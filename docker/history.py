@@ -0,0 +1,92 @@
+import asyncio
+
+
+class ChatTrimmer:
+    """Fits a chat history into a budget of prompt tokens.
+
+    System messages and the latest message are always kept. Older turns are
+    kept from the newest backwards while they fit, and the ones before are
+    dropped, or in collapse mode shortened to their first collapse_chars
+    characters as long as those still fit. Tokens are counted per rendered
+    message through count_tokens, which caches them, so the turns of an
+    ongoing conversation are only tokenized once.
+    """
+
+    def __init__(self, mode="drop", collapse_chars=200):
+        self.mode = mode
+        self.collapse_chars = collapse_chars
+        self.trimmed = 0
+        self.dropped = 0
+        self.collapsed = 0
+
+    def collapse(self, message):
+        content = str(message["content"])
+        if (len(content) <= self.collapse_chars):
+            return message
+        return {**message, "content": content[:self.collapse_chars].rstrip() + " ..."}
+
+    async def trim(self, messages, render, count_tokens, budget, overhead=""):
+        #the messages to render and what was trimmed, None when everything fits
+        if (budget <= 0 or len(messages) < 2):
+            return messages, None
+        rendered = [render(message) for message in messages]
+        #a token is at least one byte, so a prompt with fewer bytes than the budget fits without counting
+        if (len(overhead.encode("utf-8")) + sum(len(text.encode("utf-8")) for text in rendered) <= budget):
+            return messages, None
+        counts = await asyncio.gather(*[count_tokens(text) for text in [overhead] + rendered])
+        base, counts = counts[0], counts[1:]
+        total = base + sum(counts)
+        if (total <= budget):
+            return messages, None
+
+        turns = [i for i, message in enumerate(messages) if (message.get("role") != "system")]
+        keep = {i for i, message in enumerate(messages) if (message.get("role") == "system")}
+        if (turns):
+            keep.add(turns[-1])
+        used = base + sum(counts[i] for i in keep)
+        for i in reversed(turns[:-1]):
+            if (used + counts[i] > budget):
+                break
+            keep.add(i)
+            used += counts[i]
+        #the kept history starts with a user turn, as most chat templates expect
+        for i in turns[:-1]:
+            if (i not in keep):
+                continue
+            if (messages[i].get("role") != "assistant"):
+                break
+            keep.discard(i)
+            used -= counts[i]
+
+        dropped = [i for i in turns if (i not in keep)]
+        collapsed = {}
+        if (self.mode == "collapse"):
+            sizes = {}
+            for i in reversed(dropped):
+                message = self.collapse(messages[i])
+                tokens = counts[i] if (message is messages[i]) else await count_tokens(render(message))
+                if (used + tokens > budget):
+                    break
+                collapsed[i], sizes[i] = message, tokens
+                used += tokens
+            #collapsed turns must not start the history with an assistant turn either
+            for i in sorted(collapsed):
+                if (messages[i].get("role") != "assistant"):
+                    break
+                del collapsed[i]
+                used -= sizes[i]
+        result = [collapsed.get(i, message) for i, message in enumerate(messages) if (i in keep or i in collapsed)]
+
+        self.trimmed += 1
+        self.dropped += len(dropped) - len(collapsed)
+        self.collapsed += len(collapsed)
+        return result, {
+            "dropped_messages": len(dropped) - len(collapsed),
+            "collapsed_messages": len(collapsed),
+            "prompt_tokens_before": total,
+            "prompt_tokens_after": used,
+            "budget": budget
+        }
+
+    def stats(self):
+        return {"trimmed_requests": self.trimmed, "dropped_messages": self.dropped, "collapsed_messages": self.collapsed}
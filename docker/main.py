@@ -1,32 +1,135 @@
 #!/usr/bin/env python3
 import argparse
-from asgiref.wsgi import WsgiToAsgi
-from flask import Flask, jsonify, request, Response
-import urllib.parse
-import requests
+import asyncio
+import contextlib
+import fcntl
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+import httpx
 import time
 import json
-import boto3
+import hashlib
 import os
+import signal
 import subprocess
 import traceback
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+from scheduler import QueueFullError, QueueTimeoutError
+from backend import Backend, BackendPool
+from models import ModelManager, ModelError, find_gguf, find_draft, server_env, start_server, stop_process, stop_server_on_port, backend_port
+from cache import LRUCache
+from model_fetch import ModelFetcher
+from metrics import Metrics
+from coordinator import CoordinatorClient
+from embeddings import EmbeddingBatcher, EmbeddingError, encode
+from gguf import CHAT_FORMATS, GGUFError, chat_format, detect_chat_format, read_metadata
+from prewarm import prewarm, process_age
+from history import ChatTrimmer
+
+#seconds from the start of this worker until its modules are imported, boto3 is only imported by the first S3 download
+imports_seconds = process_age()
 
 
-app = Flask(__name__)
 slot_id = -1
 
+def read_profile(path):
+    #the launch profile written by tune.py, server.sh sources the same file
+    profile = {}
+    if (os.path.isfile(path)):
+        with open(path) as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if (sep and not key.startswith("#")):
+                    profile[key] = value
+    return profile
+
+launch_profile = read_profile(os.environ.get("LLAMA_PROFILE", "/app/profile.env"))
+
 parser = argparse.ArgumentParser(description="An example of using server.cpp with a similar API to OAI. It must be used together with server.cpp.")
 parser.add_argument("--chat-prompt", type=str, help="the top prompt in chat completions(default: 'A chat between a curious user and an artificial intelligence assistant. The assistant follows the given rules no matter what.\\n')", default='A chat between a curious user and an artificial intelligence assistant. The assistant follows the given rules no matter what.\\n')
 parser.add_argument("--user-name", type=str, help="USER name in chat completions(default: '\\nUSER: ')", default="\\nUSER: ")
 parser.add_argument("--ai-name", type=str, help="ASSISTANT name in chat completions(default: '\\nASSISTANT: ')", default="\\nASSISTANT: ")
 parser.add_argument("--system-name", type=str, help="SYSTEM name in chat completions(default: '\\nASSISTANT's RULE: ')", default="\\nASSISTANT's RULE: ")
 parser.add_argument("--stop", type=str, help="the end of response in chat completions(default: '</s>')", default="</s>")
+parser.add_argument("--chat-template", type=str, help="Prompt format of chat completions: auto detects it from the chat template in the GGUF metadata of the model and falls back to custom, custom uses --chat-prompt, --user-name, --ai-name, --system-name and --stop, or one of " + ", ".join(CHAT_FORMATS) + "(default: auto)", default=os.environ.get("LLAMA_CHAT_TEMPLATE", "auto"))
 parser.add_argument("--llama-api", type=str, help="Set the address of server.cpp in llama.cpp(default: http://127.0.0.1:8081)", default='http://127.0.0.1:8081')
 parser.add_argument("--api-key", type=str, help="Set the api key to allow only few user(default: NULL)", default="")
 parser.add_argument("--host", type=str, help="Set the ip address to listen.(default: 127.0.0.1)", default='127.0.0.1')
 parser.add_argument("--port", type=int, help="Set the port to listen.(default: 8080)", default=8080)
+parser.add_argument("--max-connections", type=int, help="Maximum pooled connections to server.cpp per worker(default: 512)", default=int(os.environ.get("LLAMA_MAX_CONNECTIONS", 512)))
+parser.add_argument("--keepalive-expiry", type=float, help="Seconds an idle pooled connection to server.cpp is kept open(default: 30)", default=30.0)
+parser.add_argument("--slots", type=int, help="Number of server.cpp parallel slots, 0 reads it from server.cpp /props(default: 0)", default=int(launch_profile.get("LLAMA_SLOTS", os.environ.get("LLAMA_SLOTS", 0))))
+parser.add_argument("--max-queue", type=int, help="Maximum requests waiting for a free slot before answering 429(default: 64)", default=int(os.environ.get("LLAMA_MAX_QUEUE", 64)))
+parser.add_argument("--slot-affinity", type=int, help="Route requests to the slot caching the longest prefix of their prompt, 0 disables(default: 1)", default=int(os.environ.get("LLAMA_SLOT_AFFINITY", 1)))
+parser.add_argument("--prefix-block", type=int, help="Prompt block size in bytes used to match cached prefixes(default: 256)", default=int(os.environ.get("LLAMA_PREFIX_BLOCK", 256)))
+parser.add_argument("--response-cache-mb", type=float, help="Memory for cached responses of deterministic requests in MiB, 0 disables the cache(default: 0)", default=float(os.environ.get("LLAMA_RESPONSE_CACHE_MB", 0)))
+parser.add_argument("--response-cache-ttl", type=float, help="Seconds a cached response stays valid, 0 keeps it until evicted(default: 3600)", default=float(os.environ.get("LLAMA_RESPONSE_CACHE_TTL", 3600)))
+parser.add_argument("--max-queue-wait", type=float, help="Seconds a request may wait for a free slot before answering 503, 0 waits forever(default: 30)", default=float(os.environ.get("LLAMA_MAX_QUEUE_WAIT", 30)))
+parser.add_argument("--token-cache-mb", type=float, help="Memory for cached prompt tokenizations in MiB, 0 disables the cache(default: 32)", default=float(os.environ.get("LLAMA_TOKEN_CACHE_MB", 32)))
+parser.add_argument("--stream-coalesce-ms", type=float, help="Merge streamed tokens arriving within this many milliseconds into one event, 0 sends every token(default: 0)", default=float(os.environ.get("LLAMA_STREAM_COALESCE_MS", 0)))
+parser.add_argument("--stream-coalesce-bytes", type=int, help="Send merged tokens once they reach this many bytes, 0 disables the limit(default: 0)", default=int(os.environ.get("LLAMA_STREAM_COALESCE_BYTES", 0)))
+parser.add_argument("--models-memory-mb", type=float, help="Memory budget for models loaded through the multi-model endpoint API in MiB(default: 85%% of the host memory)", default=float(os.environ.get("LLAMA_MODELS_MEMORY_MB", 0)))
+parser.add_argument("--model-overhead-mb", type=float, help="Memory counted per loaded model on top of its file size in MiB(default: 1024)", default=float(os.environ.get("LLAMA_MODEL_OVERHEAD_MB", 1024)))
+parser.add_argument("--model-base-port", type=int, help="First port for server.cpp processes of multi-model endpoint models, raised above the ports of the default and swap servers, ports in use are skipped(default: 8090)", default=int(os.environ.get("LLAMA_MODEL_BASE_PORT", 8090)))
+parser.add_argument("--model-load-timeout", type=float, help="Seconds to wait for a loaded model to become healthy(default: 600)", default=float(os.environ.get("LLAMA_MODEL_LOAD_TIMEOUT", 600)))
+parser.add_argument("--configure-swap", type=int, help="Swap models without downtime on configure by default, 1 enables(default: 0)", default=int(os.environ.get("LLAMA_CONFIGURE_SWAP", 0)))
+parser.add_argument("--swap-port", type=int, help="Port used by the new server.cpp during a blue/green model swap, swaps alternate between it and the --llama-api port(default: 8082)", default=int(os.environ.get("LLAMA_SWAP_PORT", 8082)))
+parser.add_argument("--swap-drain-timeout", type=float, help="Seconds the old server.cpp may finish in-flight requests after a model swap(default: 600)", default=float(os.environ.get("LLAMA_SWAP_DRAIN_TIMEOUT", 600)))
+parser.add_argument("--chat-trim", type=str, help="How the oldest chat turns that do not fit the prompt budget are trimmed: drop, collapse keeps them shortened while they fit, off sends the whole history(default: drop)", default=os.environ.get("LLAMA_CHAT_TRIM", "drop"))
+parser.add_argument("--chat-prompt-budget", type=int, help="Prompt tokens a chat history is trimmed to, 0 only trims it to the context of a slot(default: 0)", default=int(os.environ.get("LLAMA_CHAT_PROMPT_BUDGET", 0)))
+parser.add_argument("--chat-reserve-tokens", type=int, help="Context tokens of a slot kept free for the answer of a chat request without max_tokens(default: 512)", default=int(os.environ.get("LLAMA_CHAT_RESERVE_TOKENS", 512)))
+parser.add_argument("--chat-collapse-chars", type=int, help="Characters a collapsed chat turn is shortened to(default: 200)", default=int(os.environ.get("LLAMA_CHAT_COLLAPSE_CHARS", 200)))
+parser.add_argument("--chat-cache-mb", type=float, help="Memory for rendered chat prompt prefixes in MiB(default: 64)", default=float(os.environ.get("LLAMA_CHAT_CACHE_MB", 64)))
+parser.add_argument("--model-cache-dir", type=str, help="Directory caching models downloaded from S3(default: model-cache next to MODELPATH)", default=os.environ.get("LLAMA_MODEL_CACHE_DIR", ""))
+parser.add_argument("--model-cache-mb", type=float, help="Disk space for cached models in MiB, least recently used models are removed above it, -1 allows twice the size of the model fetched last, 0 keeps all(default: -1)", default=float(os.environ.get("LLAMA_MODEL_CACHE_MB", -1)))
+parser.add_argument("--fetch-part-mb", type=float, help="Size of the byte ranges a model is downloaded in, in MiB(default: 64)", default=float(os.environ.get("LLAMA_FETCH_PART_MB", 64)))
+parser.add_argument("--fetch-concurrency", type=int, help="Byte ranges of a model downloaded in parallel(default: 16)", default=int(os.environ.get("LLAMA_FETCH_CONCURRENCY", 16)))
+parser.add_argument("--model-s3-uri", type=str, help="S3 URI of the model to download and serve at startup(default: NULL)", default=os.environ.get("LLAMA_MODEL_S3_URI", ""))
+parser.add_argument("--draft-s3-uri", type=str, help="S3 URI of a draft model for speculative decoding, downloaded and served together with the model(default: NULL)", default=os.environ.get("LLAMA_DRAFT_S3_URI", ""))
+parser.add_argument("--model-dir", type=str, help="Directory searched for a .gguf model to serve at startup when no S3 URI is set(default: /opt/ml/model)", default=os.environ.get("SM_MODEL_DIR", "/opt/ml/model"))
+parser.add_argument("--health-cache", type=float, help="Seconds a server.cpp health check answers /ping(default: 1)", default=float(os.environ.get("LLAMA_HEALTH_CACHE", 1.0)))
+parser.add_argument("--metrics-emf", type=int, help="Print CloudWatch embedded metric format lines for every request, 1 enables(default: 0)", default=int(os.environ.get("LLAMA_METRICS_EMF", 0)))
+parser.add_argument("--metrics-namespace", type=str, help="CloudWatch namespace of the embedded metric format lines(default: LlamaCpp)", default=os.environ.get("LLAMA_METRICS_NAMESPACE", "LlamaCpp"))
+parser.add_argument("--instances", type=str, help="server.cpp processes started by server.sh on consecutive ports from the --llama-api port, 'numa' starts one per NUMA node(default: 1)", default=launch_profile.get("LLAMA_INSTANCES", os.environ.get("LLAMA_INSTANCES", "1")))
+parser.add_argument("--request-timeout", type=float, help="Seconds a request may take unless it sets its own timeout, n_predict is capped to fit and generation stops when it runs out, 0 disables(default: 0)", default=float(os.environ.get("LLAMA_REQUEST_TIMEOUT", 0)))
+parser.add_argument("--coordinator-socket", type=str, help="Unix socket of coordinator.py sharing slots, prefix indexes, the response cache and the loaded models between gateway workers(default: NULL)", default=os.environ.get("LLAMA_COORDINATOR_SOCKET", ""))
+parser.add_argument("--embedding-batch-ms", type=float, help="Milliseconds embedding requests are collected into one server.cpp request(default: 5)", default=float(os.environ.get("LLAMA_EMBEDDING_BATCH_MS", 5)))
+parser.add_argument("--embedding-batch-size", type=int, help="Texts sent to server.cpp in one embedding request(default: 32)", default=int(os.environ.get("LLAMA_EMBEDDING_BATCH_SIZE", 32)))
+parser.add_argument("--embedding-cache-mb", type=float, help="Memory for cached embedding vectors in MiB, 0 disables the cache(default: 64)", default=float(os.environ.get("LLAMA_EMBEDDING_CACHE_MB", 64)))
+parser.add_argument("--fast-start", type=int, help="Read the startup model into the page cache while server.cpp loads it and answer /ping only after a warmup completion, 1 enables(default: 0)", default=int(os.environ.get("LLAMA_FAST_START", 0)))
+parser.add_argument("--prewarm-threads", type=int, help="Threads reading the model into the page cache in fast start mode(default: 8)", default=int(os.environ.get("LLAMA_PREWARM_THREADS", 8)))
+parser.add_argument("--warmup-prompt", type=str, help="Prompt of the warmup completion in fast start mode(default: 'Hello')", default=os.environ.get("LLAMA_WARMUP_PROMPT", "Hello"))
+parser.add_argument("--warmup-tokens", type=int, help="Tokens generated by the warmup completion in fast start mode(default: 8)", default=int(os.environ.get("LLAMA_WARMUP_TOKENS", 8)))
+parser.add_argument("--health-interval", type=float, help="Seconds between health checks of each server.cpp process when there are several(default: 2)", default=float(os.environ.get("LLAMA_HEALTH_INTERVAL", 2.0)))
 
 args, unknown = parser.parse_known_args()
+if (args.chat_template not in ("auto", "custom", *CHAT_FORMATS)):
+    parser.error(f"unknown --chat-template {args.chat_template}")
+if (args.chat_trim not in ("drop", "collapse", "off")):
+    parser.error(f"unknown --chat-trim {args.chat_trim}")
+
+def host_memory_mb():
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if (line.startswith("MemTotal:")):
+                return int(line.split()[1]) / 1024
+    return 0
+
+def numa_nodes():
+    return max(1, len([name for name in os.listdir("/sys/devices/system/node") if name.startswith("node") and name[4:].isdigit()])) if (os.path.isdir("/sys/devices/system/node")) else 1
+
+#same rule as server.sh
+args.instances = numa_nodes() if (args.instances == "numa") else max(1, int(args.instances))
+
+if (args.models_memory_mb <= 0):
+    args.models_memory_mb = host_memory_mb() * 0.85
 
 def is_present(json, key):
     try:
@@ -37,31 +140,72 @@ def is_present(json, key):
         return False
     return True
 
-#convert chat to prompt
-def convert_chat(messages):
-    prompt = "" + args.chat_prompt.replace("\\n", "\n")
+#the prompt format of --chat-prompt, --user-name, --ai-name, --system-name and --stop
+custom_format = {
+    "name": "custom",
+    "preamble": args.chat_prompt.replace("\\n", "\n"),
+    "system": (args.system_name.replace("\\n", "\n"), ""),
+    "user": (args.user_name.replace("\\n", "\n"), ""),
+    "assistant": (args.ai_name.replace("\\n", "\n"), args.stop.replace("\\n", "\n")),
+    "generation": args.ai_name.replace("\\n", "\n").rstrip(),
+    "stop": [args.stop.replace("\\n", "\n")] if (args.stop != "") else []
+}
+#prompt formats of the model files, read from their GGUF metadata once
+chat_formats = {}
+#rendered conversation prefixes, keyed by a hash chain over the prompt format and the messages they contain
+chat_prefixes = LRUCache(max_bytes=int(args.chat_cache_mb * 1024 * 1024))
+
+def load_chat_format(path):
+    if (args.chat_template == "custom" or not path):
+        return custom_format
+    fmt = chat_formats.get(path)
+    if (fmt is None):
+        try:
+            info = read_metadata(path)
+            name = detect_chat_format(info.chat_template) if (args.chat_template == "auto") else args.chat_template
+            fmt = chat_format(name, info.eos_token) if (name) else custom_format
+            print(f"{path}: {info.architecture} {info.quantization}, trained context {info.context_length}, {fmt['name']} prompt format")
+        except (OSError, GGUFError) as e:
+            print(f"cannot read the metadata of {path}: {e}")
+            fmt = custom_format if (args.chat_template == "auto") else chat_format(args.chat_template)
+        chat_formats[path] = fmt
+    return fmt
 
-    system_n = args.system_name.replace("\\n", "\n")
-    user_n = args.user_name.replace("\\n", "\n")
-    ai_n = args.ai_name.replace("\\n", "\n")
-    stop = args.stop.replace("\\n", "\n")
+def backend_chat_format(backend):
+    #models of the multi-model endpoint have their own server.cpp, every other backend serves the default model
+    path = next((model.path for model in model_manager.models.values() if backend in model.backend.members), served_path)
+    return load_chat_format(path)
 
+def render_message(line, fmt):
+    if (line["role"] in ("system", "user", "assistant")):
+        prefix, suffix = fmt[line["role"]]
+        return f"{prefix}{line['content']}{suffix}"
+    return ""
 
+#convert chat to prompt, rendering only the turns that follow the longest already rendered prefix
+def convert_chat(messages, fmt=custom_format):
+    keys = []
+    key = fmt["name"].encode("utf-8")
     for line in messages:
-        if (line["role"] == "system"):
-            prompt += f"{system_n}{line['content']}"
-        if (line["role"] == "user"):
-            prompt += f"{user_n}{line['content']}"
-        if (line["role"] == "assistant"):
-            prompt += f"{ai_n}{line['content']}{stop}"
-    prompt += ai_n.rstrip()
+        key = hashlib.blake2b(key + line["role"].encode("utf-8") + b"\0" + str(line["content"]).encode("utf-8"), digest_size=16).digest()
+        keys.append(key)
 
-    return prompt
+    start, prefix = 0, fmt["preamble"]
+    for i in range(len(keys), 0, -1):
+        cached = chat_prefixes.get(keys[i - 1])
+        if (cached is not None):
+            start, prefix = i, cached
+            break
+    if (start < len(messages)):
+        prefix = "".join([prefix] + [render_message(line, fmt) for line in messages[start:]])
+        chat_prefixes.put(keys[-1], prefix, size=len(prefix))
 
-def make_postData(body, chat=False, stream=False):
+    return prefix + fmt["generation"]
+
+def make_postData(body, chat=False, stream=False, fmt=custom_format):
     postData = {}
     if (chat):
-        postData["prompt"] = convert_chat(body["messages"])
+        postData["prompt"] = convert_chat(body["messages"], fmt)
     else:
         postData["prompt"] = body["prompt"]
     if(is_present(body, "temperature")): postData["temperature"] = body["temperature"]
@@ -76,10 +220,7 @@ def make_postData(body, chat=False, stream=False):
     if(is_present(body, "mirostat_eta")): postData["mirostat_eta"] = body["mirostat_eta"]
     if(is_present(body, "seed")): postData["seed"] = body["seed"]
     if(is_present(body, "logit_bias")): postData["logit_bias"] = [[int(token), body["logit_bias"][token]] for token in body["logit_bias"].keys()]
-    if (args.stop != ""):
-        postData["stop"] = [args.stop]
-    else:
-        postData["stop"] = []
+    postData["stop"] = list(fmt["stop"])
     if(is_present(body, "stop")): postData["stop"] += body["stop"]
     postData["n_keep"] = -1
     postData["stream"] = stream
@@ -87,7 +228,19 @@ def make_postData(body, chat=False, stream=False):
     postData["slot_id"] = slot_id
     return postData
 
-def make_resData(data, chat=False, promptToken=[]):
+def make_timings(timings):
+    #generation speed and, with a draft model, the share of drafted tokens the model accepted
+    resTimings = {
+        "prompt_tokens_per_second": timings.get("prompt_per_second"),
+        "generation_tokens_per_second": timings.get("predicted_per_second")
+    }
+    if (timings.get("draft_n")):
+        resTimings["draft_tokens"] = timings["draft_n"]
+        resTimings["draft_tokens_accepted"] = timings.get("draft_n_accepted", 0)
+        resTimings["draft_acceptance_rate"] = round(resTimings["draft_tokens_accepted"] / timings["draft_n"], 4)
+    return resTimings
+
+def make_resData(data, chat=False, promptToken=[], trimmed=None):
     resData = {
         "id": "chatcmpl" if (chat) else "cmpl",
         "object": "chat.completion" if (chat) else "text_completion",
@@ -102,6 +255,10 @@ def make_resData(data, chat=False, promptToken=[]):
     }
     if (len(promptToken) != 0):
         resData["promptToken"] = promptToken
+    if (data.get("timings")):
+        resData["timings"] = make_timings(data["timings"])
+    if (trimmed is not None):
+        resData["trimmed"] = trimmed
     if (chat):
         #only one choice is supported
         resData["choices"] = [{
@@ -122,7 +279,7 @@ def make_resData(data, chat=False, promptToken=[]):
         }]
     return resData
 
-def make_resData_stream(data, chat=False, time_now = 0, start=False):
+def make_resData_stream(data, chat=False, time_now = 0, start=False, trimmed=None):
     resData = {
         "id": "chatcmpl" if (chat) else "cmpl",
         "object": "chat.completion.chunk" if (chat) else "text_completion.chunk",
@@ -140,6 +297,8 @@ def make_resData_stream(data, chat=False, time_now = 0, start=False):
             resData["choices"][0]["delta"] =  {
                 "role": "assistant"
             }
+            if (trimmed is not None):
+                resData["trimmed"] = trimmed
         else:
             resData["choices"][0]["delta"] =  {
                 "content": data["content"]
@@ -150,60 +309,1152 @@ def make_resData_stream(data, chat=False, time_now = 0, start=False):
         resData["choices"][0]["text"] = data["content"]
         if (data["stop"]):
             resData["choices"][0]["finish_reason"] = "stop" if (data["stopped_eos"] or data["stopped_word"]) else "length"
+    if (data.get("stop") and data.get("timings")):
+        resData["timings"] = make_timings(data["timings"])
 
     return resData
 
-def update_model(bucket, key):
+model_fetcher = ModelFetcher(
+    args.model_cache_dir or os.path.join(os.path.dirname(os.environ.get('MODELPATH', '/app/llm_model.bin')), "model-cache"),
+    part_size=int(args.fetch_part_mb * 1024 * 1024), concurrency=args.fetch_concurrency,
+    max_bytes=int(args.model_cache_mb * 1024 * 1024)
+)
+
+def draft_path(path):
+    return f"{path}.draft"
+
+def draft_for(path):
+    #the downloaded draft model of the model at path, if it has one
+    return draft_path(path) if (path and os.path.isfile(draft_path(path))) else None
+
+def download_model(bucket, key, path, draft=None):
+    #the draft model for speculative decoding is stored next to the model and replaced together with it
+    fetched = model_fetcher.fetch(bucket, key, path)
+    if (draft):
+        fetched["draft"] = model_fetcher.fetch(draft["bucket"], draft["key"], draft_path(path))
+        fetched["version"] = f"{fetched['version']}+{fetched['draft']['version']}"
+    elif (os.path.exists(draft_path(path))):
+        os.remove(draft_path(path))
+    return fetched
+
+#S3 version id or ETag of the model server.cpp serves
+served_version = None
+
+def stop_default_servers():
+    #only the server.cpp processes of the default model, multi-model servers and a swap still loading keep running
+    if (default_process is not None and default_process.returncode is None):
+        try:
+            os.kill(default_process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for member in get_backend().members:
+        stop_server_on_port(backend_port(member))
+
+def update_model(bucket, key, restart=False, draft=None):
+    global served_version
     try:
-        s3 = boto3.client('s3')
-        s3.download_file(bucket, key, os.environ.get('MODELPATH'))
-        subprocess.run(["/app/server.sh", os.environ.get('MODELPATH')])
-        return True
+        fetched = download_model(bucket, key, os.environ.get('MODELPATH'), draft)
+        fetched["restarted"] = restart or fetched["version"] != served_version
+        if (fetched["restarted"]):
+            stop_default_servers()
+            subprocess.run(["/app/server.sh", os.environ.get('MODELPATH')], env=server_env(draft_for(os.environ.get('MODELPATH'))))
+            served_version = fetched["version"]
+        else:
+            print(f"s3://{bucket}/{key} is already served")
+        return fetched
     except Exception as e:
         print(e)
         print(str(traceback.format_exc()))
+        return None
+
+#with several gateway workers the coordinator holds the slot schedulers, prefix indexes and response cache
+coordinator = CoordinatorClient(args.coordinator_socket) if (args.coordinator_socket) else None
+gateway_workers = max(1, int(os.environ.get("GATEWAY_WORKERS", 1)))
+#slot ids are only meaningful when a single process hands them out
+pin_slots = args.slot_affinity != 0 and (gateway_workers == 1 or coordinator is not None)
+background_tasks = set()
+
+def make_backend(name, url):
+    #one keep-alive connection pool and slot scheduler per server.cpp process, shared by all requests
+    n_slots = args.slots
+    if (n_slots <= 0):
+        #same split as server.sh until server.cpp reports its slot count
+        n_slots = max(1, (os.cpu_count() or 1) // int(os.environ.get("CPU_PER_SLOT", 4)))
+    return Backend(name, url, n_slots, args.max_queue, args.max_queue_wait,
+        max_connections=args.max_connections, keepalive_expiry=args.keepalive_expiry,
+        pin_slots=pin_slots, prefix_block=args.prefix_block, fixed_slots=args.slots > 0, shared=coordinator, workers=gateway_workers)
+
+def make_default_backend(port):
+    #server.sh starts the partitioned server.cpp processes on consecutive ports
+    host = args.llama_api.rsplit(":", 1)[0]
+    if (args.instances == 1):
+        return make_backend("default", f"{host}:{port}")
+    return BackendPool([make_backend("default", f"{host}:{port + i}") for i in range(args.instances)])
+
+default_backend = None
+
+def get_backend():
+    global default_backend
+    if (default_backend is None):
+        default_backend = make_default_backend(int(args.llama_api.rsplit(":", 1)[1]))
+    return default_backend
+
+def swap_base_port():
+    #a blue/green swap alternates between the --llama-api ports and as many ports from here
+    llama_port = int(args.llama_api.rsplit(":", 1)[1])
+    return max(args.swap_port, llama_port + args.instances)
+
+#models loaded through the SageMaker multi-model endpoint API, on ports above the default and swap servers
+model_manager = ModelManager(
+    int(args.models_memory_mb * 1024 * 1024), max(args.model_base_port, swap_base_port() + args.instances), int(args.model_overhead_mb * 1024 * 1024),
+    make_backend, load_timeout=args.model_load_timeout, launcher=os.environ.get("LLAMA_SERVER_SCRIPT", "/app/server.sh"),
+    lock_dir=os.environ.get("TMPDIR", "/tmp"), shared=coordinator
+)
+
+#the default server.cpp when the gateway started it itself, and the model file it serves
+default_process = None
+default_model_path = os.environ.get('MODELPATH')
+#the model file the default server.cpp serves, wherever it came from
+served_path = os.environ.get('MODELPATH')
+#progress of the last blue/green model swap, in a state file so every gateway worker reports it
+swap_state = {"state": "idle"}
+swap_state_file = os.path.join(os.environ.get("TMPDIR", "/tmp"), "llama-swap.json")
+#held by the worker running a swap, so a configure on another worker cannot start a second one
+swap_lock_file = os.path.join(os.environ.get("TMPDIR", "/tmp"), "llama-swap.lock")
+swap_lock = None
+#progress of loading the model found at startup
+provision_state = {"state": "idle"}
+provision_lock = None
+
+def progress(state_dict, label, started, state_file=None):
+    #the seconds spent in every state are kept under phases
+    current = {"state": None, "since": started}
+    def phase(state, **extra):
+        now = time.monotonic()
+        phases = state_dict.setdefault("phases", {})
+        if (current["state"] is not None):
+            phases[current["state"]] = round(now - current["since"], 3)
+        current.update(state=state, since=now)
+        state_dict.update(state=state, elapsed=round(now - started, 3), **extra)
+        if (state_file is not None):
+            write_state(state_file, state_dict)
+        print(f"{label}: {state}")
+    return phase
+
+def write_state(path, state_dict):
+    #replaced in one step, so other workers never read half a file
+    with open(f"{path}.{os.getpid()}", "w") as f:
+        json.dump(state_dict, f)
+    os.replace(f"{path}.{os.getpid()}", path)
+
+def lock_swap():
+    #the swap lock, or None while another worker holds it
+    lock = open(swap_lock_file, "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+def read_swap_state():
+    try:
+        with open(swap_state_file) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return dict(swap_state)
+    if (state["state"] not in ("idle", "done", "failed") and swap_lock is None):
+        #a swap in progress holds the lock, unless the worker running it exited
+        lock = lock_swap()
+        if (lock is not None):
+            lock.close()
+            state = {**state, "state": "failed", "error": "the gateway worker running the swap exited"}
+    return state
+
+async def prewarm_model(state_dict, *paths):
+    #runs while server.cpp loads the model, so both fault in the same pages from memory instead of disk
+    started, read = time.monotonic(), 0
+    for path in paths:
+        if (path):
+            try:
+                read += (await run_in_threadpool(prewarm, path, args.prewarm_threads))[0]
+            except OSError as e:
+                print(f"cannot prewarm {path}: {e}")
+    state_dict.setdefault("phases", {})["prewarm"] = round(time.monotonic() - started, 3)
+    state_dict["prewarm_bytes"] = read
+
+async def warmup(backend):
+    #one short completion per server.cpp, so the first request does not pay for page faults and buffer allocations
+    body = json.dumps({"prompt": args.warmup_prompt, "n_predict": args.warmup_tokens, "cache_prompt": False})
+    try:
+        responses = await asyncio.gather(*[member.client.post("/completion", content=body, timeout=args.model_load_timeout) for member in backend.members])
+    except httpx.HTTPError as e:
+        print(f"warmup completion failed: {e}")
+        return
+    for response in responses:
+        if (response.status_code >= 400):
+            print(f"warmup completion failed with {response.status_code}: {response.text}")
+
+#written once the startup model is warmed up, so every gateway worker answers /ping
+ready_file = os.environ.get("LLAMA_READY_FILE", os.path.join(os.environ.get("TMPDIR", "/tmp"), "llama-ready"))
+ready = False
+
+def is_ready():
+    global ready
+    ready = ready or os.path.exists(ready_file)
+    return ready
+
+def mark_ready(state_dict):
+    #how long this container took from its start to serving, per phase
+    phases = state_dict.setdefault("phases", {})
+    phases["imports"] = imports_seconds
+    container_age = process_age(1)
+    if (container_age is not None):
+        phases["ready"] = container_age
+    for name, seconds in phases.items():
+        metrics.set("llama_startup_phase_seconds", {"phase": name}, seconds)
+    metrics.flush(force=True)
+    if (metrics.emf):
+        metrics.emit_emf({"mode": "startup", "model": "default"}, {f"Startup{name.capitalize()}": round(seconds * 1000, 3) for name, seconds in phases.items() if (seconds is not None)})
+    print(f"startup phases: {json.dumps(phases)}")
+    with open(ready_file, "w") as f:
+        f.write(json.dumps(phases))
+
+def parse_s3_uri(uri):
+    bucket, _, key = uri.removeprefix("s3://").partition("/")
+    return {"bucket": bucket, "key": key}
+
+def model_source():
+    #an S3 URI from the environment, else the model SageMaker extracted from ModelDataUrl
+    if (args.model_s3_uri):
+        source = parse_s3_uri(args.model_s3_uri)
+        if (args.draft_s3_uri):
+            source["draft"] = parse_s3_uri(args.draft_s3_uri)
+        return source
+    try:
+        return {"path": find_gguf(args.model_dir), "draft": find_draft(args.model_dir)}
+    except ModelError:
+        return None
+
+startup_model = model_source()
+if (startup_model is not None and "path" in startup_model):
+    served_path = startup_model["path"]
+
+async def provision_model(source):
+    #start server.cpp with the startup model while the gateway already answers /ping with 503
+    global default_process, default_model_path, served_version, served_path, provision_lock
+    phase = progress(provision_state, "model provisioning", time.monotonic())
+    #with several gateway workers only the first one starts server.cpp, the others wait for it
+    lock = open(os.path.join(os.environ.get("TMPDIR", "/tmp"), "llama-provision.lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        phase("waiting")
+        #the slots and context size of the server.cpp another worker starts
+        await get_backend().refresh_slots(timeout=args.model_load_timeout)
+        return
+    provision_lock = lock
+    if (os.path.exists(ready_file)):
+        os.remove(ready_file)
+    backend = get_backend()
+    if (await backend.healthy(0)):
+        phase("done", reused=True)
+        mark_ready(provision_state)
+        return
+    try:
+        if ("path" in source):
+            path, draft = source["path"], source["draft"]
+        else:
+            phase("downloading", **source)
+            path = os.environ.get('MODELPATH')
+            fetched = await run_in_threadpool(download_model, source["bucket"], source["key"], path, source.get("draft"))
+            served_version = fetched["version"]
+            draft = draft_for(path)
+        phase("starting", model=path, draft=draft)
+        prewarming = asyncio.ensure_future(prewarm_model(provision_state, path, draft)) if (args.fast_start) else None
+        try:
+            default_process = await start_server(model_manager.launcher, path, backend_port(backend), backend, args.model_load_timeout, env=server_env(draft))
+        finally:
+            if (prewarming is not None):
+                await prewarming
+        if (args.fast_start):
+            phase("warmup")
+            await warmup(backend)
+    except Exception as e:
+        print(str(traceback.format_exc()))
+        phase("failed", error=str(e))
+        return
+    #a model under /opt/ml/model belongs to SageMaker and is never deleted by a swap
+    default_model_path = path if ("bucket" in source) else None
+    served_path = path
+    chat_formats.clear()
+    await run_in_threadpool(load_chat_format, path)
+    publish_default_model()
+    phase("done")
+    mark_ready(provision_state)
+
+async def swap_model(bucket, key, draft=None):
+    #load the new model next to the old one and move traffic over once it is healthy
+    global swap_lock
+    swap_state.clear()
+    phase = progress(swap_state, "model swap", time.monotonic(), swap_state_file)
+    try:
+        await run_swap(phase, bucket, key, draft)
+    finally:
+        swap_lock.close()
+        swap_lock = None
+
+async def run_swap(phase, bucket, key, draft=None):
+    global default_backend, default_process, default_model_path, served_version, served_path
+    old, old_process, old_path = get_backend(), default_process, default_model_path
+    #alternate between the two port ranges so the old server keeps serving while the new one loads
+    swap_port = swap_base_port()
+    port = swap_port if (backend_port(old) != swap_port) else int(args.llama_api.rsplit(":", 1)[1])
+    backend = None
+    try:
+        phase("downloading", bucket=bucket, key=key, draft=draft)
+        path = f"{os.environ.get('MODELPATH')}.{int(time.time())}"
+        fetched = await run_in_threadpool(download_model, bucket, key, path, draft)
+        phase("starting", port=port, fetch=fetched)
+        backend = make_default_backend(port)
+        #the prefix index of this port may still describe the slots of an earlier server.cpp
+        for member in backend.members:
+            member.prefix_index.forget()
+        prewarming = asyncio.ensure_future(prewarm_model(swap_state, path, draft_for(path))) if (args.fast_start) else None
+        try:
+            process = await start_server(model_manager.launcher, path, port, backend, args.model_load_timeout, env=server_env(draft_for(path)))
+        finally:
+            if (prewarming is not None):
+                await prewarming
+        await run_in_threadpool(load_chat_format, path)
+        if (args.fast_start):
+            phase("warmup")
+            await warmup(backend)
+    except Exception as e:
+        print(str(traceback.format_exc()))
+        if (backend is not None):
+            await backend.aclose()
+        phase("failed", error=str(e))
+        return
+
+    default_backend, default_process, default_model_path, served_path = backend, process, path, path
+    served_version = fetched["version"]
+    clear_response_cache()
+    token_cache.clear()
+    embedder.cache.clear()
+    publish_default_model()
+    phase("draining")
+    await old.drain(args.swap_drain_timeout)
+
+    phase("stopping")
+    if (old_process is not None):
+        await stop_process(old_process)
+    else:
+        for member in old.members:
+            stop_server_on_port(backend_port(member))
+    await old.aclose()
+    if (old_path and old_path != path):
+        for old_file in (old_path, draft_path(old_path)):
+            if (os.path.exists(old_file)):
+                os.remove(old_file)
+    phase("done", model=path)
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+def publish_default_model():
+    #tell the other gateway workers which server.cpp now serves the default model
+    if (coordinator is not None):
+        coordinator.send("publish", event={"type": "default_model", "port": backend_port(get_backend()), "path": default_model_path, "file": served_path, "version": served_version})
+
+async def close_when_drained(backend):
+    await backend.drain(args.swap_drain_timeout)
+    await backend.aclose()
+
+def on_coordinator_event(event):
+    global default_backend, default_model_path, served_version, served_path
+    #models another worker loaded or unloaded through the multi-model endpoint API
+    if (event.get("type") == "model_loaded"):
+        run_in_background(model_manager.adopt(event["model"]))
+        return
+    if (event.get("type") == "model_unloaded"):
+        run_in_background(model_manager.drop(event["model"]))
+        return
+    if (event.get("type") != "default_model"):
+        return
+    default_model_path, served_version, served_path = event["path"], event["version"], event.get("file")
+    chat_formats.clear()
+    token_cache.clear()
+    embedder.cache.clear()
+    if (backend_port(get_backend()) != event["port"]):
+        #another worker swapped the model, that worker also stops the old server.cpp
+        old = default_backend
+        default_backend = make_default_backend(event["port"])
+        run_in_background(default_backend.refresh_slots(timeout=args.model_load_timeout))
+        run_in_background(close_when_drained(old))
+
+if (coordinator is not None):
+    coordinator.on_event = on_coordinator_event
+
+#latency and throughput histograms, added up across the gateway workers through LLAMA_METRICS_DIR
+metrics = Metrics(os.environ.get("LLAMA_METRICS_DIR"), emf=args.metrics_emf != 0, namespace=args.metrics_namespace)
+
+async def flush_metrics():
+    while True:
+        #with a coordinator the slot gauges come from it, for all workers at once
+        if (coordinator is None):
+            for name, backend in [("default", member) for member in get_backend().members] + [(model.name, model.backend) for model in model_manager.models.values()]:
+                labels = {"model": name, "instance": str(backend_port(backend))}
+                metrics.set("llama_slots_busy", labels, backend.scheduler.busy)
+                metrics.set("llama_slots_total", labels, backend.scheduler.n_slots)
+                metrics.set("llama_queue_depth", labels, backend.scheduler.queue_depth)
+        metrics.flush()
+        await asyncio.sleep(1)
+
+async def monitor_backends():
+    #probe every process of a pool, so a failed one leaves the rotation and rejoins once it answers again
+    while True:
+        members = get_backend().members
+        if (len(members) > 1):
+            await asyncio.gather(*[member.healthy(0) for member in members])
+        await asyncio.sleep(args.health_interval)
+
+def busy_response(backend, status_code):
+    return Response(status_code=status_code, headers={**backend.headers(), "Retry-After": "1"})
+
+async def until_disconnected(receive):
+    #returns once the client is gone, the request body must have been read already
+    while ((await receive())["type"] != "http.disconnect"):
+        pass
+
+async def race(awaitable, disconnected=None, deadline=None):
+    #awaits awaitable unless the client disconnects or the deadline passes first, then cancels it
+    if (disconnected is None and deadline is None):
+        return await awaitable
+    task = asyncio.ensure_future(awaitable)
+    try:
+        await asyncio.wait([task] if (disconnected is None) else [task, disconnected], timeout=None if (deadline is None) else max(0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        if (not task.done()):
+            task.cancel()
+            #the cancelled work releases what it holds, e.g. its place in the slot queue
+            await asyncio.wait([task])
+    if (not task.cancelled()):
+        return task.result()
+    if (disconnected is not None and disconnected.done()):
+        raise ClientDisconnect()
+    raise asyncio.TimeoutError()
+
+def deadline_result(content, tokens_predicted):
+    #the result server.cpp would have sent had n_predict run out at the deadline
+    return {"content": content, "stop": True, "stopped_eos": False, "stopped_word": False, "stopped_limit": True, "stopped_deadline": True,
+        "truncated": False, "tokens_evaluated": None, "tokens_predicted": tokens_predicted}
+
+def fit_budget(backend, postData, deadline):
+    #lower n_predict to what server.cpp can generate before the deadline, returns whether it did
+    if (deadline is None):
+        return False
+    cap = backend.tokens_within(deadline - time.monotonic(), postData["prompt"])
+    requested = postData.get("n_predict", -1)
+    if (cap is None or (requested is not None and 0 <= requested <= cap)):
         return False
+    postData["n_predict"] = cap
+    return True
+
+async def admit(backend, prefix, timer, deadline=None, disconnected=None):
+    try:
+        slot = await race(backend.scheduler.acquire(prefix, None if (deadline is None) else deadline - time.monotonic()), disconnected)
+    except QueueFullError:
+        timer.rejected("queue_full")
+        raise
+    except QueueTimeoutError:
+        timer.rejected("queue_timeout")
+        raise
+    except ConnectionError:
+        #the coordinator is down or restarting, answered like a full queue so the client retries
+        timer.rejected("coordinator")
+        raise
+    except ClientDisconnect:
+        timer.cancelled("disconnect")
+        raise
+    timer.admitted(backend.scheduler)
+    return slot
+
+async def acquire_slot(backend, prefix, timer, deadline=None, disconnected=None):
+    try:
+        return await admit(backend, prefix, timer, deadline, disconnected), None
+    except QueueFullError:
+        return None, busy_response(backend, 429)
+    except (QueueTimeoutError, ConnectionError):
+        return None, busy_response(backend, 503)
+    except ClientDisconnect:
+        return None, Response(status_code=499)
+
+#opt-in cache of responses to deterministic requests
+response_cache = LRUCache(max_bytes=int(args.response_cache_mb * 1024 * 1024), ttl=args.response_cache_ttl)
+#fields that do not change the generated text
+NON_SEMANTIC_FIELDS = ("stream", "slot_id", "id_slot", "cache_prompt", "n_keep")
+
+def response_cache_key(backend, body, postData):
+    if (response_cache.max_bytes <= 0 or (is_present(body, "cache") and not body["cache"])):
+        return None
+    deterministic = postData.get("temperature", 1) == 0 or postData.get("seed", -1) != -1
+    if (not deterministic):
+        return None
+    canonical = {key: value for key, value in postData.items() if key not in NON_SEMANTIC_FIELDS}
+    canonical["model"] = backend.name
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+async def cached_response(key):
+    if (coordinator is not None):
+        try:
+            return (await coordinator.call("cache_get", key=key)).get("value")
+        except ConnectionError:
+            #a miss while the coordinator is unavailable
+            return None
+    return response_cache.get(key)
+
+def cache_response(key, data):
+    if (key is not None and is_present(data, "content") and is_present(data, "tokens_predicted") and not data.get("stopped_deadline")):
+        entry = {field: data[field] for field in ("content", "truncated", "stopped_eos", "stopped_word", "tokens_evaluated", "tokens_predicted") if field in data}
+        if (coordinator is not None):
+            coordinator.send("cache_put", key=key, value=entry, size=len(json.dumps(entry)))
+        else:
+            response_cache.put(key, entry, size=len(json.dumps(entry)))
+
+def clear_response_cache():
+    if (coordinator is not None):
+        coordinator.send("cache_clear")
+    response_cache.clear()
+
+def replay_stream(data, chat=False, done=False):
+    #the whole cached text as one chunk of the usual stream format
+    time_now = int(time.time())
+    if (chat):
+        yield 'data: {}\n\n'.format(json.dumps(make_resData_stream({}, chat=True, time_now=time_now, start=True)))
+    resData = make_resData_stream({**data, "stop": True}, chat=chat, time_now=time_now)
+    yield 'data: {}\n\n'.format(json.dumps(resData))
+    if (done):
+        yield 'data: [DONE]\n\n'
+
+class ChunkEncoder:
+    #stream chunks only differ in their text, so everything around it is serialized once per stream
+    def __init__(self, chat, time_now):
+        self.chat = chat
+        self.time_now = time_now
+        template = make_resData_stream({"content": "\0", "stop": False}, chat=chat, time_now=time_now)
+        self.head, self.tail = 'data: {}\n\n'.format(json.dumps(template)).encode("utf-8").split(b'"\\u0000"')
+
+    def text(self, content):
+        return self.head + json.dumps(content).encode("utf-8") + self.tail
+
+    def chunk(self, data, start=False, trimmed=None):
+        return 'data: {}\n\n'.format(json.dumps(make_resData_stream(data, chat=self.chat, time_now=self.time_now, start=start, trimmed=trimmed))).encode("utf-8")
+
+async def sse_events(response, deadline=None, disconnected=None):
+    #payloads of the data: lines of a server-sent event stream, until the client disconnects or the deadline passes
+    buffer = b""
+    chunks = response.aiter_bytes()
+    while True:
+        try:
+            raw = await race(chunks.__anext__(), disconnected, deadline)
+        except StopAsyncIteration:
+            break
+        buffer += raw
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if (line.startswith(b"data: ")):
+                yield line[6:]
+    if (buffer.startswith(b"data: ")):
+        yield buffer[6:]
+
+async def relay_stream(response, encoder, on_stop, coalesce_ms=0, coalesce_bytes=0, on_token=None, deadline=None, disconnected=None):
+    #the first token always goes out at once, later ones may be merged into fewer, larger events
+    coalesce = coalesce_ms > 0 or coalesce_bytes > 0
+    content = []
+    pending = []
+    pending_bytes = 0
+    last_flush = None
+    events = sse_events(response, deadline, disconnected)
+    while True:
+        try:
+            payload = await events.__anext__()
+        except StopAsyncIteration:
+            break
+        except asyncio.TimeoutError:
+            #out of time, end the stream the way server.cpp does when n_predict runs out
+            chunk = deadline_result("".join(content), len(content))
+            on_stop(chunk)
+            yield encoder.chunk({**chunk, "content": "".join(pending)})
+            return
+        chunk = loads(payload)
+        if (chunk["stop"]):
+            content.append(chunk["content"])
+            on_stop({**chunk, "content": "".join(content)})
+            if (pending):
+                chunk = {**chunk, "content": "".join(pending) + chunk["content"]}
+            yield encoder.chunk(chunk)
+            return
+        text = chunk["content"]
+        if (not text):
+            continue
+        if (on_token is not None):
+            on_token()
+        content.append(text)
+        if (not coalesce or last_flush is None):
+            yield encoder.text(text)
+            last_flush = time.monotonic()
+            continue
+        pending.append(text)
+        pending_bytes += len(text)
+        now = time.monotonic()
+        if ((coalesce_bytes > 0 and pending_bytes >= coalesce_bytes) or (coalesce_ms > 0 and (now - last_flush) * 1000 >= coalesce_ms)):
+            yield encoder.text("".join(pending))
+            pending, pending_bytes, last_flush = [], 0, now
+    if (pending):
+        yield encoder.text("".join(pending))
+
+async def collect_stream(response, deadline=None, disconnected=None):
+    #the result of a non-streaming request read as a stream, so the text generated before the deadline is kept
+    content = []
+    try:
+        async for payload in sse_events(response, deadline, disconnected):
+            chunk = loads(payload)
+            content.append(chunk["content"])
+            if (chunk["stop"]):
+                return {**chunk, "content": "".join(content)}
+    except asyncio.TimeoutError:
+        return deadline_result("".join(content), len(content))
+    raise httpx.RemoteProtocolError("server.cpp ended the stream without a result")
+
+#tokenizations of recent prompts, so repeated system prompts are not tokenized again
+token_cache = LRUCache(max_bytes=int(args.token_cache_mb * 1024 * 1024))
+
+async def tokenize_prompt(backend, prompt):
+    if (not isinstance(prompt, str)):
+        return prompt
+    tokens = token_cache.get((backend.name, prompt))
+    if (tokens is None):
+        tokens = (await backend.client.post("/tokenize", content=json.dumps({"content": prompt}))).json()["tokens"]
+        if (token_cache.max_bytes > 0):
+            token_cache.put((backend.name, prompt), tokens, size=len(prompt) + 8 * len(tokens))
+    return tokens
+
+#chat histories are trimmed to a prompt token budget, so prefill time stays bounded
+chat_trimmer = ChatTrimmer(args.chat_trim, args.chat_collapse_chars)
+
+def chat_budget(backend, body):
+    #the configured budget, and at most the context of a slot less the tokens kept for the answer
+    budget = body["max_prompt_tokens"] if (is_present(body, "max_prompt_tokens")) else args.chat_prompt_budget
+    n_ctx = min((member.n_ctx for member in backend.members if (member.n_ctx)), default=None)
+    if (n_ctx):
+        answer = body["max_tokens"] if (is_present(body, "max_tokens") and body["max_tokens"] > 0) else args.chat_reserve_tokens
+        budget = min(budget, n_ctx - answer) if (budget > 0) else n_ctx - answer
+    return budget
+
+async def fit_chat(backend, body, fmt):
+    #the request with its history trimmed to the budget, and what was trimmed
+    if (args.chat_trim == "off" or not isinstance(body.get("messages"), list)):
+        return body, None
+    member = backend.pick()
+
+    async def count_tokens(text):
+        return len(await tokenize_prompt(member, text)) if (text) else 0
+
+    try:
+        messages, trimmed = await chat_trimmer.trim(body["messages"], lambda line: render_message(line, fmt), count_tokens, chat_budget(backend, body), fmt["preamble"] + fmt["generation"])
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        print(f"cannot count the tokens of a chat history: {e}")
+        return body, None
+    return (body, None) if (trimmed is None) else ({**body, "messages": messages}, trimmed)
+
+#texts of concurrent embedding requests go to server.cpp together, vectors of repeated texts come from memory
+embedder = EmbeddingBatcher(LRUCache(max_bytes=int(args.embedding_cache_mb * 1024 * 1024)), window_ms=args.embedding_batch_ms, max_batch=args.embedding_batch_size)
+
+async def embed(backend, body):
+    texts = [body["input"]] if (isinstance(body["input"], str)) else body["input"]
+    if (not isinstance(texts, list) or not texts or not all(isinstance(text, str) for text in texts)):
+        return JSONResponse({"error": "input must be a string or a list of strings"}, status_code=400)
+    encoding_format = body["encoding_format"] if (is_present(body, "encoding_format")) else "float"
+    timer = metrics.request("embedding", backend.name)
+    try:
+        results = await embedder.embed(backend, texts)
+    except QueueFullError:
+        timer.rejected("queue_full")
+        return busy_response(backend, 429)
+    except QueueTimeoutError:
+        timer.rejected("queue_timeout")
+        return busy_response(backend, 503)
+    except ConnectionError:
+        timer.rejected("coordinator")
+        return busy_response(backend, 503)
+    except EmbeddingError as e:
+        timer.error(f"http_{e.status_code}")
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    except httpx.HTTPError as e:
+        timer.error(type(e).__name__)
+        raise
+    tokens = sum(result[1] for result in results)
+    timer.finished({"tokens_evaluated": tokens, "tokens_predicted": 0})
+    return JSONResponse({
+        "object": "list",
+        "data": [{"object": "embedding", "index": i, "embedding": encode(packed, encoding_format)} for i, (packed, _) in enumerate(results)],
+        "model": backend.name,
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+    }, headers=backend.headers())
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    if (coordinator is not None):
+        #serve starts the coordinator before the workers
+        await coordinator.connect(timeout=30)
+        await model_manager.sync()
+    if (startup_model is not None):
+        run_in_background(provision_model(startup_model))
+    else:
+        await get_backend().refresh_slots()
+    run_in_background(flush_metrics())
+    run_in_background(monitor_backends())
+    yield
+    await model_manager.close()
+    await get_backend().aclose()
+
+async def ping(request):
+    #without a startup model the model arrives later through configure
+    if (startup_model is None):
+        return Response(status_code=200)
+    if (args.fast_start and not is_ready()):
+        return Response(status_code=503)
+    return Response(status_code=200 if (await get_backend().healthy(args.health_cache)) else 503)
+
+async def metrics_endpoint(request):
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+async def complete(backend, postData, cache_key=None, timer=None, deadline=None, disconnected=None):
+    #server.cpp result for a non-streaming request, served from the response cache when possible
+    if (timer is None):
+        timer = metrics.request("non_stream", backend.name)
+    if (cache_key is not None):
+        cached = await cached_response(cache_key)
+        if (cached is not None):
+            timer.cache_hit()
+            return cached, True
+    slot = await admit(backend, backend.prompt_prefix(postData["prompt"]), timer, deadline, disconnected)
+    backend.pin(postData, slot)
+    if (fit_budget(backend, postData, deadline)):
+        #a shortened answer must not be served to requests without the deadline
+        cache_key = None
+    try:
+        if (deadline is None):
+            #cancelling the request closes the connection, which makes server.cpp stop generating
+            response = await race(backend.client.post("/completion", content=json.dumps(postData)), disconnected)
+            if (response.status_code >= 400):
+                timer.error(f"http_{response.status_code}")
+            data = response.json()
+        else:
+            async with backend.client.stream("POST", "/completion", content=json.dumps({**postData, "stream": True})) as response:
+                if (response.status_code >= 400):
+                    timer.error(f"http_{response.status_code}")
+                    data = loads(await response.aread())
+                else:
+                    data = await collect_stream(response, deadline, disconnected)
+        backend.record_prefix(slot, postData["prompt"], data)
+        backend.record_timings(data)
+        cache_response(cache_key, data)
+    except ClientDisconnect:
+        timer.cancelled("disconnect")
+        raise
+    except httpx.HTTPError as e:
+        timer.error(type(e).__name__)
+        if (isinstance(e, httpx.TransportError)):
+            backend.failed()
+        raise
+    finally:
+        backend.scheduler.release(slot)
+    if (data.get("stopped_deadline")):
+        timer.cancelled("deadline")
+        data["tokens_evaluated"] = len(await tokenize_prompt(backend, postData["prompt"]))
+    timer.finished(data)
+    return data, False
+
+def parse_jsonlines(raw):
+    items = []
+    for line in raw.splitlines():
+        if (line.strip()):
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(e)
+    return items
+
+def parse_body(request, raw):
+    #returns the payload and whether it was sent as JSON Lines
+    if ("jsonl" in request.headers.get("content-type", "")):
+        return parse_jsonlines(raw), True
+    try:
+        return json.loads(raw), False
+    except ValueError:
+        if (len(raw.strip().splitlines()) > 1):
+            return parse_jsonlines(raw), True
+        raise
+
+def batch_error(code, message):
+    return {"error": {"code": code, "message": message}}
+
+def request_deadline(body, started):
+    #the latency budget of a request in seconds, from its timeout field or --request-timeout
+    budget = body["timeout"] if (isinstance(body, dict) and is_present(body, "timeout")) else args.request_timeout
+    return started + budget if (budget > 0) else None
 
-@app.route('/ping', methods=['GET'])
-def ping():
-    return Response(status=200)
+async def complete_item(backend, item, limit, deadline=None):
+    if (isinstance(item, ValueError)):
+        return batch_error(400, f"invalid JSON: {item}")
+    if (not isinstance(item, dict) or not (is_present(item, "prompt") or is_present(item, "messages"))):
+        return batch_error(400, "every batch item needs a prompt or messages")
+    chat = is_present(item, "messages")
+    async with limit:
+        try:
+            fmt = backend_chat_format(backend)
+            item, trimmed = await fit_chat(backend, item, fmt) if (chat) else (item, None)
+            postData = make_postData(item, chat=chat, stream=False, fmt=fmt)
+            member = backend.pick()
+            data, cached = await complete(member, postData, response_cache_key(member, item, postData), deadline=deadline)
+            return make_resData(data, chat=chat, trimmed=trimmed)
+        except QueueFullError:
+            return batch_error(429, "request queue is full")
+        except QueueTimeoutError:
+            return batch_error(503, "timed out waiting for a free slot")
+        except ConnectionError:
+            return batch_error(503, "coordinator unavailable")
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            return batch_error(500, f"{type(e).__name__}: {e}")
 
-@app.route("/invocations", methods=['POST'])
-def completion():
+async def batch(backend, items, jsonlines, receive=None, deadline=None):
+    #keep every slot busy, but let a single batch occupy no more than all of them
+    limit = asyncio.Semaphore(sum(member.scheduler.n_slots for member in backend.members))
+    #budgets count from the arrival of the batch, a prompt list shares the budget of its request
+    started = time.monotonic()
+    tasks = [asyncio.create_task(complete_item(backend, item, limit, deadline or request_deadline(item, started))) for item in items]
+    if (not jsonlines):
+        disconnected = asyncio.ensure_future(until_disconnected(receive)) if (receive is not None) else None
+        try:
+            return JSONResponse(await race(asyncio.gather(*tasks), disconnected), headers=backend.headers())
+        except ClientDisconnect:
+            return Response(status_code=499)
+        finally:
+            if (disconnected is not None):
+                disconnected.cancel()
+
+    async def generate():
+        try:
+            #results go out in input order as soon as each one is ready
+            for task in tasks:
+                yield json.dumps(await task) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+    return StreamingResponse(generate(), media_type='application/jsonlines', headers=backend.headers())
+
+async def configure(config):
+    global default_backend, default_process, default_model_path, served_path, swap_lock
+    swap = config["swap"] if (is_present(config, "swap")) else args.configure_swap != 0
+    #the draft model is in the bucket of the model unless it names its own
+    draft = {"bucket": config["bucket"], **config["draft"]} if (is_present(config, "draft")) else None
+    if (swap):
+        lock = lock_swap() if (swap_lock is None) else None
+        if (lock is None):
+            return JSONResponse(read_swap_state(), status_code=409)
+        swap_lock = lock
+        swap_state.clear()
+        swap_state["state"] = "pending"
+        write_state(swap_state_file, swap_state)
+        run_in_background(swap_model(config["bucket"], config["key"], draft))
+        return JSONResponse(swap_state, status_code=202)
+
+    res = await run_in_threadpool(update_model, config["bucket"], config["key"], not await get_backend().healthy(0), draft)
+    if (res and res["restarted"]):
+        #server.sh restarted the server on the --llama-api port
+        if (default_backend is not None and default_backend.url != args.llama_api):
+            await default_backend.aclose()
+            default_backend = None
+        default_process, default_model_path = None, os.environ.get('MODELPATH')
+        #the new model was written over the old file
+        served_path = default_model_path
+        chat_formats.clear()
+        for member in get_backend().members:
+            member.prefix_index.forget()
+        clear_response_cache()
+        token_cache.clear()
+        embedder.cache.clear()
+        publish_default_model()
+        run_in_background(get_backend().refresh_slots(timeout=600))
+    return Response(status_code=200) if (res) else Response(status_code=500)
+
+async def select_backend(request, body, model_name=None):
+    #the model comes from the multi-model invoke path, the TargetModel header or the model field
+    target = model_name or request.headers.get("X-Amzn-SageMaker-Target-Model")
+    if (target is None and isinstance(body, dict) and isinstance(body.get("model"), str) and model_manager.models):
+        target = body["model"]
+    if (target is None):
+        return get_backend()
+    model = model_manager.find(target)
+    if (model is None and coordinator is not None):
+        #another worker may have loaded it just now
+        await sync_models()
+        model = model_manager.find(target)
+    if (model is None):
+        raise ModelError(404, f"model {target} is not loaded")
+    return model.backend
+
+async def sync_models():
+    try:
+        await model_manager.sync()
+    except ConnectionError as e:
+        raise ModelError(503, str(e)) from e
+
+async def completion(request):
     if (args.api_key != "" and request.headers["Authorization"].split()[1] != args.api_key):
-        return Response(status=403)
-    body = request.get_json()
+        return Response(status_code=403)
+    body, jsonlines = parse_body(request, await request.body())
+    jsonlines = jsonlines or "jsonl" in request.headers.get("accept", "")
+    try:
+        backend = await select_backend(request, body, request.path_params.get("model_name"))
+    except ModelError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    if (isinstance(body, list)):
+        return await batch(backend, body, jsonlines, request.receive)
+    if (is_present(body, "prompt") and isinstance(body["prompt"], list) and all(isinstance(prompt, str) for prompt in body["prompt"])):
+        return await batch(backend, [{**body, "prompt": prompt} for prompt in body["prompt"]], jsonlines, request.receive, request_deadline(body, time.monotonic()))
+    if (is_present(body, "configure")): 
+        return await configure(body["configure"])
+    if (is_present(body, "metrics")):
+        return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+    if (is_present(body, "stats")):
+        stats = {**get_backend().stats(), "swap": read_swap_state(), "provision": provision_state, "response_cache": response_cache.stats(), "token_cache": token_cache.stats(), "embeddings": embedder.stats(), "chat_trim": chat_trimmer.stats(), "chat_format": backend_chat_format(get_backend())["name"], "models": model_manager.stats(), "model_fetch": model_fetcher.stats()}
+        if (coordinator is not None):
+            stats["coordinator"] = await coordinator.call("stats")
+            stats["response_cache"] = stats["coordinator"].pop("response_cache")
+        return JSONResponse(stats)
+    if (is_present(body, "input")):
+        return await embed(backend, body)
+    return await generate_response(backend.pick(), body, chat=is_present(body, "messages"), request=request)
+
+async def chat_completion(request):
+    if (args.api_key != "" and request.headers["Authorization"].split()[1] != args.api_key):
+        return Response(status_code=403)
+    body = await request.json()
+    try:
+        backend = await select_backend(request, body)
+    except ModelError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    return await generate_response(backend.pick(), body, chat=True, done=True, request=request)
+
+async def embeddings(request):
+    if (args.api_key != "" and request.headers["Authorization"].split()[1] != args.api_key):
+        return Response(status_code=403)
+    body = await request.json()
+    try:
+        backend = await select_backend(request, body)
+    except ModelError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    return await embed(backend, body)
+
+async def list_models(request):
+    try:
+        await sync_models()
+    except ModelError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    return JSONResponse({"models": [model_manager.describe(model) for model in model_manager.models.values()]})
+
+async def load_model(request):
+    body = await request.json()
+    try:
+        await model_manager.load(body["model_name"], body["url"])
+    except ModelError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    except ConnectionError as e:
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": "1"})
+    return JSONResponse({"status": f"model {body['model_name']} loaded"})
+
+async def describe_model(request):
+    try:
+        await sync_models()
+    except ModelError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    model = model_manager.get(request.path_params["model_name"])
+    if (model is None):
+        return JSONResponse({"error": "model is not loaded"}, status_code=404)
+    return JSONResponse(model_manager.describe(model))
+
+async def unload_model(request):
+    try:
+        await model_manager.unload(request.path_params["model_name"])
+    except ModelError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.status_code)
+    except ConnectionError as e:
+        return JSONResponse({"error": str(e)}, status_code=503, headers={"Retry-After": "1"})
+    return JSONResponse({"status": "model unloaded"})
+
+async def generate_response(backend, body, chat=False, done=False, request=None):
     stream = False
     tokenize = False
-    if (is_present(body, "configure")): 
-        res = update_model(body["configure"]["bucket"], body["configure"]["key"])
-        return Response(status=200) if (res) else Response(status=500)
     if(is_present(body, "stream")): stream = body["stream"]
     if(is_present(body, "tokenize")): tokenize = body["tokenize"]
-    postData = make_postData(body, chat=False, stream=stream)
+    fmt = backend_chat_format(backend)
+    body, trimmed = await fit_chat(backend, body, fmt) if (chat) else (body, None)
+    postData = make_postData(body, chat=chat, stream=stream, fmt=fmt)
 
-    promptToken = []
-    if (tokenize):
-        tokenData = requests.request("POST", urllib.parse.urljoin(args.llama_api, "/tokenize"), data=json.dumps({"content": postData["prompt"]})).json()
-        promptToken = tokenData["tokens"]
+    if (tokenize and postData.get("n_predict", -1) == 0):
+        #tokenize-only requests never need a slot
+        promptToken = await tokenize_prompt(backend, postData["prompt"])
+        return JSONResponse({"promptToken": promptToken, "usage": {"prompt_tokens": len(promptToken)}})
 
+    cache_key = response_cache_key(backend, body, postData)
+    timer = metrics.request("stream" if (stream) else "non_stream", backend.name)
+    deadline = request_deadline(body, timer.start)
+    #a client that goes away cancels its request, wherever it is, and frees the slot
+    disconnected = asyncio.ensure_future(until_disconnected(request.receive)) if (request is not None) else None
     if (not stream):
-        data = requests.request("POST", urllib.parse.urljoin(args.llama_api, "/completion"), data=json.dumps(postData))
-        print(data.json())
-        resData = make_resData(data.json(), chat=False, promptToken=promptToken)
-        return jsonify(resData)
-    else:
-        def generate():
-            data = requests.request("POST", urllib.parse.urljoin(args.llama_api, "/completion"), data=json.dumps(postData), stream=True)
-            time_now = int(time.time())
-            for line in data.iter_lines():
-                if line:
-                    decoded_line = line.decode('utf-8')
-                    resData = make_resData_stream(json.loads(decoded_line[6:]), chat=False, time_now=time_now)
-                    yield 'data: {}\n'.format(json.dumps(resData))
-        return Response(generate(), mimetype='text/event-stream')
-
-asgi_app = WsgiToAsgi(app)
-
-#if __name__ == '__main__':
-#    app.run(args.host, port=args.port)
+        try:
+            if (tokenize):
+                #tokenize while the completion is already running
+                promptToken, (data, cached) = await asyncio.gather(tokenize_prompt(backend, postData["prompt"]), complete(backend, postData, cache_key, timer, deadline, disconnected))
+            else:
+                promptToken = []
+                data, cached = await complete(backend, postData, cache_key, timer, deadline, disconnected)
+        except QueueFullError:
+            return busy_response(backend, 429)
+        except (QueueTimeoutError, ConnectionError):
+            return busy_response(backend, 503)
+        except ClientDisconnect:
+            return Response(status_code=499)
+        finally:
+            if (disconnected is not None):
+                disconnected.cancel()
+        headers = backend.headers()
+        if (cache_key is not None):
+            headers["X-Cache"] = "hit" if (cached) else "miss"
+        resData = make_resData(data, chat=chat, promptToken=promptToken, trimmed=trimmed)
+        return JSONResponse(resData, headers=headers)
+
+    if (cache_key is not None):
+        cached = await cached_response(cache_key)
+        if (cached is not None):
+            timer.cache_hit()
+            if (disconnected is not None):
+                disconnected.cancel()
+            return StreamingResponse(replay_stream(cached, chat=chat, done=done), media_type='text/event-stream', headers={**backend.headers(), "X-Cache": "hit"})
+
+    slot, busy = await acquire_slot(backend, backend.prompt_prefix(postData["prompt"]), timer, deadline, disconnected)
+    if (busy is not None):
+        if (disconnected is not None):
+            disconnected.cancel()
+        return busy
+    headers = backend.headers()
+    if (fit_budget(backend, postData, deadline)):
+        cache_key = None
+    if (cache_key is not None):
+        headers["X-Cache"] = "miss"
+    backend.pin(postData, slot)
+
+    coalesce_ms = body["coalesce_ms"] if (is_present(body, "coalesce_ms")) else args.stream_coalesce_ms
+    coalesce_bytes = body["coalesce_bytes"] if (is_present(body, "coalesce_bytes")) else args.stream_coalesce_bytes
+
+    def on_stop(data):
+        if (data.get("stopped_deadline")):
+            timer.cancelled("deadline")
+        backend.record_prefix(slot, postData["prompt"], data)
+        backend.record_timings(data)
+        cache_response(cache_key, data)
+        timer.finished(data)
+
+    released = False
+
+    def release(_=None):
+        nonlocal released
+        if (not released):
+            released = True
+            backend.scheduler.release(slot)
+
+    try:
+        #the status of server.cpp decides between an event stream and an error response
+        upstream = await race(backend.client.send(backend.client.build_request("POST", "/completion", content=json.dumps(postData)), stream=True), disconnected)
+    except ClientDisconnect:
+        timer.cancelled("disconnect")
+        release()
+        disconnected.cancel()
+        return Response(status_code=499)
+    except httpx.HTTPError as e:
+        timer.error(type(e).__name__)
+        if (isinstance(e, httpx.TransportError)):
+            backend.failed()
+        release()
+        if (disconnected is not None):
+            disconnected.cancel()
+        raise
+    if (upstream.status_code >= 400):
+        try:
+            error = await upstream.aread()
+        finally:
+            await upstream.aclose()
+            release()
+            if (disconnected is not None):
+                disconnected.cancel()
+        timer.error(f"http_{upstream.status_code}")
+        timer.finished({})
+        try:
+            error = loads(error)
+        except ValueError:
+            error = {"error": error.decode(errors="replace")}
+        return JSONResponse(error, status_code=upstream.status_code, headers=backend.headers())
+
+    async def generate():
+        try:
+            try:
+                encoder = ChunkEncoder(chat, int(time.time()))
+                if (chat):
+                    yield encoder.chunk({}, start=True, trimmed=trimmed)
+                async for event in relay_stream(upstream, encoder, on_stop, coalesce_ms, coalesce_bytes, timer.token, deadline, disconnected):
+                    yield event
+            finally:
+                await upstream.aclose()
+            if (done):
+                yield b'data: [DONE]\n\n'
+        except ClientDisconnect:
+            #leaving the stream closes the connection to server.cpp, which stops generating
+            timer.cancelled("disconnect")
+        except httpx.HTTPError as e:
+            timer.error(type(e).__name__)
+            if (isinstance(e, httpx.TransportError)):
+                backend.failed()
+            raise
+        finally:
+            release()
+            if (disconnected is not None):
+                disconnected.remove_done_callback(release)
+                disconnected.cancel()
+
+    if (disconnected is not None):
+        #a response that never starts streaming never runs the finally of generate()
+        disconnected.add_done_callback(release)
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=headers)
+
+app = Starlette(routes=[
+    Route('/ping', ping, methods=['GET']),
+    Route('/metrics', metrics_endpoint, methods=['GET']),
+    Route('/invocations', completion, methods=['POST']),
+    Route('/v1/chat/completions', chat_completion, methods=['POST']),
+    Route('/v1/embeddings', embeddings, methods=['POST']),
+    #SageMaker multi-model endpoint API
+    Route('/models', list_models, methods=['GET']),
+    Route('/models', load_model, methods=['POST']),
+    Route('/models/{model_name:path}/invoke', completion, methods=['POST']),
+    Route('/models/{model_name:path}', describe_model, methods=['GET']),
+    Route('/models/{model_name:path}', unload_model, methods=['DELETE']),
+], lifespan=lifespan)
+
+asgi_app = app
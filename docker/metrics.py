@@ -0,0 +1,263 @@
+import bisect
+import glob
+import json
+import os
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+HISTOGRAMS = {
+    "llama_request_duration_seconds": ("Time from request arrival to the last token", LATENCY_BUCKETS),
+    "llama_queue_wait_seconds": ("Time spent waiting for a free slot", LATENCY_BUCKETS),
+    "llama_time_to_first_token_seconds": ("Time from request arrival to the first generated token", LATENCY_BUCKETS),
+    "llama_inter_token_latency_seconds": ("Time between generated tokens, the mean per request for non-streaming requests", LATENCY_BUCKETS),
+    "llama_prompt_tokens_per_second": ("Prompt processing speed reported by server.cpp", RATE_BUCKETS),
+    "llama_generation_tokens_per_second": ("Generation speed reported by server.cpp", RATE_BUCKETS),
+    "llama_slot_occupancy_ratio": ("Share of busy slots when a request is admitted", RATIO_BUCKETS)
+}
+COUNTERS = {
+    "llama_requests_total": "Requests that reached the slot scheduler or the response cache",
+    "llama_response_cache_hits_total": "Requests answered from the response cache",
+    "llama_prompt_tokens_total": "Prompt tokens of completed requests",
+    "llama_prompt_tokens_cached_total": "Prompt tokens server.cpp found in its slot cache",
+    "llama_generated_tokens_total": "Generated tokens of completed requests",
+    "llama_rejected_requests_total": "Requests rejected by the slot scheduler",
+    "llama_upstream_errors_total": "Failed requests to server.cpp",
+    "llama_cancelled_requests_total": "Requests stopped early because the client went away or their deadline passed",
+    "llama_draft_tokens_total": "Tokens proposed by the draft model of speculative decoding",
+    "llama_draft_tokens_accepted_total": "Draft model tokens accepted by the model"
+}
+GAUGES = {
+    "llama_slots_busy": "Slots in use as seen by a gateway worker",
+    "llama_slots_total": "Slots of server.cpp as seen by a gateway worker",
+    "llama_queue_depth": "Requests waiting for a slot in a gateway worker",
+    "llama_startup_phase_seconds": "Seconds of every phase of the last container start, ready is the time from the container start to serving"
+}
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if (not items):
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if (isinstance(value, float)) else str(value)
+
+
+class Metrics:
+    """Histograms and counters of one gateway worker.
+
+    With a directory, every worker writes its values to its own file there and
+    render() adds up the files of all workers, so any worker answers a scrape
+    for the whole container. Files of exited workers are kept, so counters
+    never go backwards, while their gauges are dropped.
+    """
+
+    def __init__(self, directory=None, emf=False, namespace="LlamaCpp"):
+        self.directory = directory
+        self.emf = emf
+        self.namespace = namespace
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.changed = False
+        if (directory):
+            os.makedirs(directory, exist_ok=True)
+
+    def observe(self, name, value, labels):
+        key = (name, label_key(labels))
+        histogram = self.histograms.get(key)
+        if (histogram is None):
+            histogram = self.histograms[key] = [[0] * (len(HISTOGRAMS[name][1]) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(HISTOGRAMS[name][1], value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+        self.changed = True
+
+    def inc(self, name, labels, value=1):
+        key = (name, label_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+        self.changed = True
+
+    def set(self, name, labels, value):
+        self.gauges[(name, label_key(labels))] = value
+
+    def request(self, mode, model):
+        return RequestTimer(self, mode, model)
+
+    def snapshot(self):
+        return {
+            "histograms": [[name, list(labels), *values] for (name, labels), values in self.histograms.items()],
+            "counters": [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+            "gauges": [[name, list(labels), value] for (name, labels), value in self.gauges.items()]
+        }
+
+    def flush(self, force=False):
+        #cheap when nothing happened, so it can run every second
+        if (not self.directory or not (self.changed or force)):
+            return
+        path = os.path.join(self.directory, f"worker-{os.getpid()}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(f"{path}.tmp", path)
+        self.changed = False
+
+    def snapshots(self):
+        if (not self.directory):
+            return [(os.getpid(), self.snapshot())]
+        self.flush(force=True)
+        result = []
+        for path in glob.glob(os.path.join(self.directory, "worker-*.json")):
+            try:
+                with open(path) as f:
+                    result.append((int(os.path.basename(path)[7:-5]), json.load(f)))
+            except (OSError, ValueError):
+                continue
+        return result
+
+    def render(self):
+        histograms, counters, gauges = {}, {}, {}
+        for pid, snapshot in self.snapshots():
+            for name, labels, buckets, total, count in snapshot["histograms"]:
+                key = (name, tuple(map(tuple, labels)))
+                merged = histograms.setdefault(key, [[0] * len(buckets), 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            if (pid == os.getpid() or pid_alive(pid)):
+                for name, labels, value in snapshot["gauges"]:
+                    gauges[(name, tuple(map(tuple, labels)) + (("worker", pid),))] = value
+
+        lines = []
+        for name, (help_text, bounds) in HISTOGRAMS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+            for (metric, labels), (buckets, total, count) in sorted(histograms.items()):
+                if (metric != name):
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(list(bounds) + ["+Inf"], buckets):
+                    cumulative += bucket
+                    lines.append(f"{name}_bucket{format_labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {format_value(total)}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for kind, table, values in (("counter", COUNTERS, counters), ("gauge", GAUGES, gauges)):
+            for name, help_text in table.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for (metric, labels), value in sorted(values.items()):
+                    if (metric == name):
+                        lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def emit_emf(self, labels, values):
+        #one CloudWatch embedded metric format line per request, CloudWatch aggregates across workers and instances
+        units = {"Tokens": "Count", "PerSecond": "Count/Second", "Rate": "None"}
+        metrics = [{"Name": name, "Unit": next((unit for suffix, unit in units.items() if name.endswith(suffix)), "Milliseconds")} for name in values]
+        print(json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{"Namespace": self.namespace, "Dimensions": [["Mode"], ["Mode", "Model"]], "Metrics": metrics}]
+            },
+            "Mode": labels["mode"],
+            "Model": labels["model"],
+            **values
+        }))
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RequestTimer:
+    """Records the metrics of one request as it moves through the gateway."""
+
+    def __init__(self, metrics, mode, model):
+        self.metrics = metrics
+        self.labels = {"mode": mode, "model": model}
+        self.start = time.monotonic()
+        self.queue_wait = None
+        self.first_token = None
+        self.last_token = None
+
+    def admitted(self, scheduler):
+        self.queue_wait = time.monotonic() - self.start
+        self.metrics.inc("llama_requests_total", self.labels)
+        self.metrics.observe("llama_queue_wait_seconds", self.queue_wait, self.labels)
+        self.metrics.observe("llama_slot_occupancy_ratio", scheduler.busy / max(scheduler.n_slots, 1), self.labels)
+
+    def rejected(self, reason):
+        self.metrics.inc("llama_rejected_requests_total", {**self.labels, "reason": reason})
+
+    def error(self, reason):
+        self.metrics.inc("llama_upstream_errors_total", {**self.labels, "reason": reason})
+
+    def cancelled(self, reason):
+        self.metrics.inc("llama_cancelled_requests_total", {**self.labels, "reason": reason})
+
+    def cache_hit(self):
+        self.metrics.inc("llama_requests_total", self.labels)
+        self.metrics.inc("llama_response_cache_hits_total", self.labels)
+
+    def token(self):
+        now = time.monotonic()
+        if (self.first_token is None):
+            self.first_token = now
+            self.metrics.observe("llama_time_to_first_token_seconds", now - self.start, self.labels)
+        else:
+            self.metrics.observe("llama_inter_token_latency_seconds", now - self.last_token, self.labels)
+        self.last_token = now
+
+    def finished(self, data):
+        #data is the last server.cpp result of the request, with its token counts and timings
+        duration = time.monotonic() - self.start
+        metrics, labels = self.metrics, self.labels
+        metrics.observe("llama_request_duration_seconds", duration, labels)
+        timings = data.get("timings") or {}
+        prompt_tokens = data.get("tokens_evaluated") or 0
+        generated_tokens = data.get("tokens_predicted") or 0
+        metrics.inc("llama_prompt_tokens_total", labels, prompt_tokens)
+        metrics.inc("llama_generated_tokens_total", labels, generated_tokens)
+        if (timings.get("prompt_n") is not None):
+            metrics.inc("llama_prompt_tokens_cached_total", labels, max(0, prompt_tokens - timings["prompt_n"]))
+        if (timings.get("prompt_per_second")):
+            metrics.observe("llama_prompt_tokens_per_second", timings["prompt_per_second"], labels)
+        if (timings.get("predicted_per_second")):
+            metrics.observe("llama_generation_tokens_per_second", timings["predicted_per_second"], labels)
+        if (timings.get("draft_n")):
+            metrics.inc("llama_draft_tokens_total", labels, timings["draft_n"])
+            metrics.inc("llama_draft_tokens_accepted_total", labels, timings.get("draft_n_accepted", 0))
+        if (self.first_token is None and timings.get("prompt_ms") is not None):
+            #without a stream the first token is only known from the server.cpp timings
+            self.first_token = self.start + (self.queue_wait or 0) + timings["prompt_ms"] / 1000
+            metrics.observe("llama_time_to_first_token_seconds", self.first_token - self.start, labels)
+            if (timings.get("predicted_n")):
+                metrics.observe("llama_inter_token_latency_seconds", timings["predicted_ms"] / timings["predicted_n"] / 1000, labels)
+
+        if (metrics.emf):
+            values = {"RequestDuration": round(duration * 1000, 3), "QueueWait": round((self.queue_wait or 0) * 1000, 3),
+                "PromptTokens": prompt_tokens, "GeneratedTokens": generated_tokens}
+            if (self.first_token is not None):
+                values["TimeToFirstToken"] = round((self.first_token - self.start) * 1000, 3)
+            if (timings.get("prompt_per_second")):
+                values["PromptTokensPerSecond"] = round(timings["prompt_per_second"], 3)
+            if (timings.get("predicted_per_second")):
+                values["GenerationTokensPerSecond"] = round(timings["predicted_per_second"], 3)
+            if (timings.get("draft_n")):
+                values["DraftAcceptanceRate"] = round(timings.get("draft_n_accepted", 0) / timings["draft_n"], 4)
+            metrics.emit_emf(labels, values)
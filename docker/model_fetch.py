@@ -0,0 +1,235 @@
+import concurrent.futures
+import hashlib
+import os
+import threading
+import time
+
+
+class FetchError(Exception):
+    pass
+
+
+def cache_name(bucket, key, head):
+    #the version id, or else the ETag, changes whenever the object does
+    version = head.get("VersionId") or head["ETag"].strip('"')
+    digest = hashlib.sha256(f"{bucket}/{key}\0{version}".encode("utf-8")).hexdigest()[:32]
+    return digest + os.path.splitext(key)[1]
+
+
+def place(source, dest):
+    #a hard link makes a cached model available instantly, a copy is still faster than S3
+    if (os.path.abspath(source) == os.path.abspath(dest)):
+        return
+    tmp = f"{dest}.tmp"
+    if (os.path.lexists(tmp)):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except OSError:
+        with open(source, "rb") as src, open(tmp, "wb") as dst:
+            while True:
+                chunk = src.read(16 * 1024 * 1024)
+                if (not chunk):
+                    break
+                dst.write(chunk)
+    os.replace(tmp, dest)
+
+
+class OrderedHash:
+    """Hashes the file in order while later parts are still downloading."""
+
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+        self.md5 = hashlib.md5()
+        self.offset = 0
+        self.done = {}
+        self.lock = threading.Lock()
+
+    def part_done(self, start, end):
+        #parts finish out of order, hash every contiguous part that is complete
+        with self.lock:
+            self.done[start] = end
+            while (self.offset in self.done):
+                end = self.done.pop(self.offset)
+                while (self.offset < end):
+                    chunk = os.pread(self.fd, min(8 * 1024 * 1024, end - self.offset), self.offset)
+                    self.md5.update(chunk)
+                    self.offset += len(chunk)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+class ModelFetcher:
+    """Downloads models from S3 with parallel ranged GETs into a local cache.
+
+    Cached files are named after the bucket, key and version id or ETag of the
+    object, so fetching an unchanged object again only links the cached file.
+    The download is checked against the object size and ETag while it streams
+    in. The least recently used files are removed once the cache grows over
+    max_bytes, by default twice the size of the model fetched last, and 0
+    keeps them all.
+    """
+
+    def __init__(self, cache_dir, s3=None, part_size=64 * 1024 * 1024, concurrency=16, max_bytes=-1, retries=3):
+        self.cache_dir = cache_dir
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self._s3 = s3
+        self.lock = threading.Lock()
+        self.last = None
+        self.fetches = 0
+        self.cache_hits = 0
+        self.bytes_downloaded = 0
+        self.evictions = 0
+
+    @property
+    def s3(self):
+        if (self._s3 is None):
+            import boto3
+            from botocore.config import Config
+            self._s3 = boto3.client("s3", config=Config(max_pool_connections=max(10, self.concurrency)))
+        return self._s3
+
+    def fetch(self, bucket, key, dest):
+        #only one fetch at a time, two fetches of the same object would both download it
+        with self.lock:
+            started = time.monotonic()
+            head = self.s3.head_object(Bucket=bucket, Key=key)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = os.path.join(self.cache_dir, cache_name(bucket, key, head))
+            cached = os.path.isfile(path) and os.path.getsize(path) == head["ContentLength"]
+            result = {"bucket": bucket, "key": key, "version": head.get("VersionId") or head["ETag"].strip('"'), "bytes": head["ContentLength"], "cached": cached}
+            if (cached):
+                os.utime(path)
+                self.cache_hits += 1
+            else:
+                result.update(self.download(bucket, key, head, path))
+                self.bytes_downloaded += head["ContentLength"]
+            place(path, dest)
+            self.evict(keep=path)
+
+            result["seconds"] = round(time.monotonic() - started, 3)
+            result["mb_per_s"] = round(head["ContentLength"] / 1024 / 1024 / max(result["seconds"], 1e-6), 1)
+            self.fetches += 1
+            self.last = result
+            print(f"model fetch: s3://{bucket}/{key} {result['bytes']} bytes in {result['seconds']}s "
+                f"({result['mb_per_s']} MiB/s{', cached' if (cached) else ''})")
+            return result
+
+    def upload_part_size(self, bucket, key, head):
+        #an ETag ending in -N is the MD5 of the part MD5s, it can only be checked with the same part boundaries
+        etag = head["ETag"].strip('"')
+        if ("-" not in etag):
+            return None
+        try:
+            part = self.s3.head_object(Bucket=bucket, Key=key, PartNumber=1)
+        except Exception:
+            return None
+        size = part.get("ContentLength")
+        parts = int(etag.rsplit("-", 1)[1])
+        if (not size or -(-head["ContentLength"] // size) != parts):
+            return None
+        return size
+
+    def download(self, bucket, key, head, path):
+        size = head["ContentLength"]
+        etag = head["ETag"].strip('"')
+        #ETags of objects encrypted with KMS are not an MD5 of their content
+        check_etag = head.get("ServerSideEncryption") != "aws:kms"
+        part_size = self.part_size
+        multipart = self.upload_part_size(bucket, key, head) if (check_etag) else None
+        if (multipart):
+            part_size = multipart
+        ranges = [(start, min(start + part_size, size)) for start in range(0, size, part_size)] or [(0, 0)]
+        extra = {"IfMatch": head["ETag"]}
+        if (head.get("VersionId")):
+            extra = {"VersionId": head["VersionId"]}
+
+        tmp = f"{path}.part"
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            ordered = OrderedHash(fd, size) if (check_etag and not multipart and "-" not in etag) else None
+
+            def get_range(part):
+                start, end = part
+                for attempt in range(self.retries + 1):
+                    try:
+                        md5 = hashlib.md5()
+                        offset = start
+                        if (end > start):
+                            body = self.s3.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}", **extra)["Body"]
+                            for chunk in body.iter_chunks(1024 * 1024):
+                                os.pwrite(fd, chunk, offset)
+                                md5.update(chunk)
+                                offset += len(chunk)
+                        if (offset != end):
+                            raise FetchError(f"range {start}-{end - 1} returned {offset - start} bytes")
+                        break
+                    except Exception as e:
+                        code = getattr(e, "response", {}).get("Error", {}).get("Code")
+                        if (code in ("PreconditionFailed", "412")):
+                            raise FetchError(f"s3://{bucket}/{key} changed during the download")
+                        if (attempt == self.retries or code in ("NoSuchKey", "NoSuchVersion", "AccessDenied")):
+                            raise
+                        print(f"model fetch: retrying range {start}-{end - 1} after {e}")
+                        time.sleep(2 ** attempt)
+                if (ordered is not None):
+                    ordered.part_done(start, end)
+                return md5.digest()
+
+            with concurrent.futures.ThreadPoolExecutor(self.concurrency) as pool:
+                digests = list(pool.map(get_range, ranges))
+
+            verified = False
+            if (multipart):
+                composite = f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+                if (composite != etag):
+                    raise FetchError(f"checksum mismatch for s3://{bucket}/{key}: {composite} != {etag}")
+                verified = True
+            elif (ordered is not None):
+                if (ordered.hexdigest() != etag):
+                    raise FetchError(f"checksum mismatch for s3://{bucket}/{key}: {ordered.hexdigest()} != {etag}")
+                verified = True
+            os.fsync(fd)
+        except BaseException:
+            os.close(fd)
+            os.remove(tmp)
+            raise
+        os.close(fd)
+        os.replace(tmp, path)
+        return {"parts": len(ranges), "part_size": part_size, "verified": verified}
+
+    def evict(self, keep):
+        if (self.max_bytes == 0):
+            return
+        #room for the model just fetched and one more of its size, e.g. the one a swap replaces
+        limit = self.max_bytes if (self.max_bytes > 0) else 2 * os.path.getsize(keep)
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if (os.path.isfile(path) and not name.endswith(".part")):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, stat.st_nlink, path))
+        total = sum(size for _, size, _, _ in files)
+        for _, size, links, path in sorted(files):
+            if (total <= limit):
+                break
+            #a file still linked to a model in use frees no space
+            if (path != keep and links == 1):
+                os.remove(path)
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            "fetches": self.fetches,
+            "cache_hits": self.cache_hits,
+            "bytes_downloaded": self.bytes_downloaded,
+            "evictions": self.evictions,
+            "last": self.last
+        }
@@ -0,0 +1,303 @@
+import asyncio
+import collections
+import fcntl
+import glob
+import os
+import signal
+import socket
+import tempfile
+import time
+
+
+class ModelError(Exception):
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_draft(path):
+    return "draft" in os.path.basename(path).lower()
+
+
+def find_gguf(url):
+    #SageMaker passes the directory the model archive was extracted to
+    if (os.path.isfile(url)):
+        return url
+    files = sorted(path for path in glob.glob(os.path.join(url, "**", "*.gguf"), recursive=True) if not is_draft(path))
+    if (not files):
+        raise ModelError(404, f"no .gguf file found in {url}")
+    return files[0]
+
+
+def find_draft(url):
+    #a .gguf file with draft in its name next to the model is the draft model for speculative decoding
+    if (os.path.isfile(url)):
+        return None
+    files = sorted(path for path in glob.glob(os.path.join(url, "**", "*.gguf"), recursive=True) if is_draft(path))
+    return files[0] if (files) else None
+
+
+def server_env(draft=None):
+    #server.sh adds the draft model to the server.cpp arguments, an empty value starts server.cpp without one
+    return {**os.environ, "LLAMA_DRAFT_MODEL": draft or ""}
+
+
+async def start_server(launcher, path, port, backend, timeout, env=None):
+    #runs server.sh in the foreground on port and waits until server.cpp answers /health
+    process = await asyncio.create_subprocess_exec(launcher, path, str(port), env=env)
+    healthy = asyncio.ensure_future(backend.wait_healthy(timeout))
+    exited = asyncio.ensure_future(process.wait())
+    await asyncio.wait([healthy, exited], return_when=asyncio.FIRST_COMPLETED)
+    exited.cancel()
+    if (not healthy.done() or not healthy.result()):
+        healthy.cancel()
+        await stop_process(process)
+        raise ModelError(500, f"server.cpp for {path} did not become healthy")
+    await backend.refresh_slots()
+    return process
+
+
+async def stop_process(process, timeout=30):
+    if (process.returncode is None):
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+
+def stop_server_on_port(port):
+    #server.cpp started in the background by server.sh is not a child of the gateway
+    for pid in os.listdir("/proc"):
+        if (not pid.isdigit()):
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read().split(b"\0")
+        except OSError:
+            continue
+        if (not cmdline[0].endswith(b"llama-server") or b"--port" not in cmdline[:-1]):
+            continue
+        if (cmdline[cmdline.index(b"--port") + 1] == str(port).encode()):
+            os.kill(int(pid), signal.SIGTERM)
+
+
+def port_free(port):
+    #a port anything else listens on, e.g. a server.cpp of another gateway worker, cannot be bound
+    with socket.socket() as s:
+        try:
+            s.bind(("127.0.0.1", port))
+        except OSError:
+            return False
+    return True
+
+
+def backend_port(backend):
+    return int(backend.url.rsplit(":", 1)[1])
+
+
+class Model:
+    def __init__(self, name, url, path, size, backend, process):
+        self.name = name
+        self.url = url
+        self.path = path
+        self.size = size
+        self.backend = backend
+        self.process = process
+        self.loaded_at = time.time()
+
+
+class ModelManager:
+    """Models loaded through the SageMaker multi-model endpoint API.
+
+    Every model runs in its own server.cpp process on its own port. Loading a
+    model that does not fit into the memory budget unloads the least recently
+    used idle models first. With a coordinator client the models of all
+    gateway workers are kept in the coordinator, and every worker serves the
+    models the others loaded.
+    """
+
+    def __init__(self, budget, base_port, overhead, make_backend, load_timeout=600, launcher="/app/server.sh", lock_dir=None, shared=None):
+        self.budget = budget
+        self.shared = shared
+        self.base_port = base_port
+        self.lock_dir = lock_dir or tempfile.gettempdir()
+        #lock files of the ports this worker uses, held until the model is stopped
+        self.ports = {}
+        self.overhead = overhead
+        self.make_backend = make_backend
+        self.load_timeout = load_timeout
+        self.launcher = launcher
+        self.models = collections.OrderedDict()
+        self.lock = asyncio.Lock()
+        self.evictions = 0
+
+    @property
+    def used(self):
+        return sum(model.size for model in self.models.values())
+
+    def get(self, name):
+        model = self.models.get(name)
+        if (model is not None):
+            self.models.move_to_end(name)
+        return model
+
+    def find(self, target):
+        #TargetModel is the archive path relative to the S3 prefix, model names are chosen by SageMaker
+        model = self.get(target)
+        if (model is None):
+            for candidate in self.models.values():
+                if (candidate.url.rstrip("/").endswith(target) or os.path.basename(candidate.path) == target):
+                    return self.get(candidate.name)
+        return model
+
+    def free_port(self):
+        #the lock file keeps the port of a model that is still loading from the other gateway workers
+        for port in range(self.base_port, 65536):
+            if (port in self.ports):
+                continue
+            lock = open(os.path.join(self.lock_dir, f"llama-port-{port}.lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            if (port_free(port)):
+                self.ports[port] = lock
+                return port
+            lock.close()
+        raise ModelError(507, f"no free port from {self.base_port}")
+
+    def release_port(self, port):
+        lock = self.ports.pop(port, None)
+        if (lock is not None):
+            lock.close()
+
+    async def load(self, name, url):
+        async with self.lock:
+            if (name in self.models):
+                raise ModelError(409, f"model {name} is already loaded")
+            path = find_gguf(url)
+            draft = find_draft(url)
+            size = os.path.getsize(path) + (os.path.getsize(draft) if (draft) else 0) + self.overhead
+            if (size > self.budget):
+                raise ModelError(507, f"model {name} needs {size} bytes, the memory budget is {self.budget}")
+            if (self.shared is not None):
+                await self.reserve(name, size)
+            else:
+                await self.make_room(size)
+
+            port, backend = None, None
+            try:
+                port = self.free_port()
+                backend = self.make_backend(name, f"http://127.0.0.1:{port}")
+                #every loaded model gets a single server.cpp on its own port, its KV cache has to fit into the overhead counted for it
+                env = {**server_env(draft), "LLAMA_INSTANCES": "1", "LLAMA_KV_MEMORY_MB": os.environ.get("LLAMA_KV_MEMORY_MB", str(self.overhead // (1024 * 1024)))}
+                process = await start_server(self.launcher, path, port, backend, self.load_timeout, env=env)
+            except Exception:
+                if (backend is not None):
+                    await backend.aclose()
+                if (port is not None):
+                    self.release_port(port)
+                if (self.shared is not None):
+                    self.shared.send("model_unload", name=name)
+                raise
+            model = self.models[name] = Model(name, url, path, size, backend, process)
+            if (self.shared is not None):
+                self.shared.announce(f"model:{name}", {"op": "model_loaded", "model": self.record(model)})
+            print(f"loaded model {name} from {path} on port {port}")
+
+    def record(self, model):
+        #what the other workers need to serve a model
+        return {"name": model.name, "url": model.url, "path": model.path, "size": model.size, "backend": model.backend.url}
+
+    async def reserve(self, name, size):
+        #the coordinator checks the name and the memory budget against the models of all workers
+        reply = await self.shared.call("model_reserve", name=name, size=size, budget=self.budget)
+        if (reply.get("error") == "exists"):
+            raise ModelError(409, f"model {name} is already loaded")
+        if (reply.get("error") == "no_memory"):
+            raise ModelError(507, "not enough memory and every loaded model is busy")
+        if ("error" in reply):
+            raise ConnectionError(f"coordinator: {reply['error']}")
+        for victim in reply["victims"]:
+            self.evictions += 1
+            print(f"evicting model {victim['name']} to free memory")
+            await self.drop(victim)
+
+    async def adopt(self, record):
+        #a model another worker loaded, its server.cpp is used directly
+        if (record["name"] in self.models):
+            return
+        backend = self.make_backend(record["name"], record["backend"])
+        self.models[record["name"]] = Model(record["name"], record["url"], record["path"], record["size"], backend, None)
+        await backend.refresh_slots()
+
+    async def drop(self, record):
+        #a model unloaded through the coordinator, only the worker that started its server.cpp stops it
+        model = self.models.pop(record["name"], None)
+        if (self.shared is not None):
+            self.shared.unregister(f"model:{record['name']}")
+        if (model is not None):
+            await self.stop(model)
+        if ((model is None or model.process is None) and record.get("orphaned") and record.get("backend")):
+            #the worker that started it is gone
+            stop_server_on_port(int(record["backend"].rsplit(":", 1)[1]))
+
+    async def sync(self):
+        #the coordinator has the models of all workers, events keep this copy current between syncs
+        if (self.shared is None):
+            return
+        records = {record["name"]: record for record in (await self.shared.call("models"))["models"]}
+        for name in [name for name in self.models if (name not in records)]:
+            await self.drop({"name": name})
+        for record in records.values():
+            await self.adopt(record)
+
+    async def make_room(self, size):
+        while (self.used + size > self.budget):
+            victim = next((model for model in self.models.values() if model.backend.idle), None)
+            if (victim is None):
+                raise ModelError(507, "not enough memory and every loaded model is busy")
+            del self.models[victim.name]
+            self.evictions += 1
+            print(f"evicting model {victim.name} to free memory")
+            await self.stop(victim)
+
+    async def unload(self, name):
+        if (self.shared is not None):
+            reply = await self.shared.call("model_unload", name=name)
+            if ("error" in reply):
+                raise ModelError(404, f"model {name} is not loaded")
+            await self.drop(reply["model"])
+            return
+        async with self.lock:
+            model = self.models.pop(name, None)
+        if (model is None):
+            raise ModelError(404, f"model {name} is not loaded")
+        await self.stop(model)
+
+    async def stop(self, model):
+        if (model.process is not None):
+            await stop_process(model.process)
+        await model.backend.aclose()
+        self.release_port(backend_port(model.backend))
+
+    async def close(self):
+        for name in list(self.models):
+            model = self.models.pop(name)
+            if (self.shared is not None and model.process is not None):
+                self.shared.send("model_unload", name=name)
+            await self.stop(model)
+
+    def describe(self, model):
+        return {"modelName": model.name, "modelUrl": model.url}
+
+    def stats(self):
+        return {
+            "budget_bytes": self.budget,
+            "used_bytes": self.used,
+            "evictions": self.evictions,
+            "models": {name: model.backend.stats() for name, model in self.models.items()}
+        }
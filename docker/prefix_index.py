@@ -0,0 +1,79 @@
+import hashlib
+
+
+def prefix_hashes(text, block_size):
+    #chained hashes of the full blocks of text, equal chains mean equal prefixes
+    data = text.encode("utf-8")
+    hashes = []
+    digest = b""
+    for end in range(block_size, len(data) + 1, block_size):
+        digest = hashlib.blake2b(digest + data[end - block_size:end], digest_size=8).digest()
+        hashes.append(digest)
+    return hashes
+
+
+class PrefixIndex:
+    """Remembers which prompt prefix each server.cpp slot holds in its KV cache."""
+
+    def __init__(self):
+        self.slots = {}
+        self.lookups = 0
+        self.routed_hits = 0
+        self.requests = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.prefill_tokens_saved = 0
+
+    def match(self, slot, hashes):
+        #number of leading blocks cached in slot, chaining makes the matches contiguous
+        cached = self.slots.get(slot)
+        if (not cached or not hashes):
+            return 0
+        low, high = 0, len(hashes)
+        while (low < high):
+            mid = (low + high + 1) // 2
+            if (hashes[mid - 1] in cached):
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def best_slot(self, slots, hashes):
+        self.lookups += 1
+        best, best_len = None, 0
+        for slot in slots:
+            length = self.match(slot, hashes)
+            if (length > best_len):
+                best, best_len = slot, length
+        if (best is not None):
+            self.routed_hits += 1
+        return best
+
+    def update(self, slot, hashes):
+        self.slots[slot] = set(hashes)
+
+    def forget(self, slot=None):
+        if (slot is None):
+            self.slots.clear()
+        else:
+            self.slots.pop(slot, None)
+
+    def record(self, tokens_evaluated, tokens_processed):
+        #server.cpp only runs prefill for the prompt tokens it did not find in the slot cache
+        self.requests += 1
+        self.prompt_tokens += tokens_evaluated
+        saved = max(0, tokens_evaluated - tokens_processed)
+        if (saved > 0):
+            self.cache_hits += 1
+            self.prefill_tokens_saved += saved
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "routed_hits": self.routed_hits,
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "cache_hit_rate": self.cache_hits / self.requests if (self.requests) else 0.0,
+            "prompt_tokens": self.prompt_tokens,
+            "prefill_tokens_saved": self.prefill_tokens_saved
+        }
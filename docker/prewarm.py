@@ -0,0 +1,46 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+
+def prewarm(path, threads=8, block_mb=8):
+    """Reads a model file in parallel blocks so its pages are in the page cache before server.cpp touches them.
+
+    server.cpp maps the model and faults its pages in one at a time, from a
+    single thread and in the order of the layers. Reading the blocks with
+    several threads keeps more requests in flight on EBS and NVMe volumes.
+    Returns the bytes read and the seconds it took.
+    """
+    started = time.monotonic()
+    size = os.path.getsize(path)
+    block = max(1, int(block_mb * 1024 * 1024))
+    local = threading.local()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if (hasattr(os, "posix_fadvise")):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+
+        def read_block(offset):
+            #one buffer per thread, the data itself is not needed
+            if (not hasattr(local, "buffer")):
+                local.buffer = bytearray(block)
+            return os.preadv(fd, [local.buffer], offset)
+
+        with concurrent.futures.ThreadPoolExecutor(max(1, threads)) as executor:
+            read = sum(executor.map(read_block, range(0, size, block)))
+    finally:
+        os.close(fd)
+    return read, time.monotonic() - started
+
+
+def process_age(pid="self"):
+    #seconds since the process started, pid 1 started with the container
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return round(uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"), 3)
@@ -0,0 +1,120 @@
+import asyncio
+import collections
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class QueueTimeoutError(Exception):
+    pass
+
+
+def worker_share(total, workers):
+    #the part of a container-wide limit each of several gateway workers enforces on its own
+    if (workers <= 1 or total <= 0):
+        return total
+    return max(1, total // workers)
+
+
+class SlotScheduler:
+    """Admission control for the parallel slots of one server.cpp process.
+
+    Requests take a free slot right away, otherwise wait in a bounded FIFO
+    queue for at most max_wait seconds. With a prefix index, a request is
+    given the free slot caching the longest part of its prompt, or else the
+    least recently used one.
+    """
+
+    def __init__(self, n_slots, max_queue, max_wait, index=None):
+        self.n_slots = n_slots
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.index = index
+        self.free = list(range(n_slots))
+        self.waiters = collections.deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def queue_depth(self):
+        return len(self.waiters)
+
+    @property
+    def busy(self):
+        return self.n_slots - len(self.free)
+
+    def pick(self, prefix):
+        slot = None
+        if (self.index is not None and prefix):
+            slot = self.index.best_slot(self.free, prefix)
+        if (slot is None):
+            return self.free.pop(0)
+        self.free.remove(slot)
+        return slot
+
+    async def acquire(self, prefix=None, timeout=None):
+        if (self.free and not self.waiters):
+            self.admitted += 1
+            return self.pick(prefix)
+        if (len(self.waiters) >= self.max_queue):
+            self.rejected += 1
+            raise QueueFullError()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        #a request with a deadline waits no longer than its remaining time
+        wait = self.max_wait if (self.max_wait > 0) else None
+        if (timeout is not None):
+            wait = max(0, timeout) if (wait is None) else min(wait, max(0, timeout))
+        try:
+            slot = await asyncio.wait_for(waiter, wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if (waiter in self.waiters):
+                self.waiters.remove(waiter)
+            #the slot may have been handed over just as the wait ended
+            if (waiter.done() and not waiter.cancelled()):
+                self.release(waiter.result())
+            if (isinstance(e, asyncio.TimeoutError)):
+                self.timed_out += 1
+                raise QueueTimeoutError()
+            raise
+        self.admitted += 1
+        return slot
+
+    def release(self, slot):
+        if (slot >= self.n_slots):
+            return
+        while (self.waiters):
+            waiter = self.waiters.popleft()
+            if (not waiter.done()):
+                waiter.set_result(slot)
+                return
+        self.free.append(slot)
+
+    def resize(self, n_slots):
+        if (n_slots == self.n_slots or n_slots <= 0):
+            return
+        busy = set(range(self.n_slots)) - set(self.free)
+        self.free = [slot for slot in self.free if slot < n_slots]
+        if (self.index is not None):
+            for slot in range(n_slots, self.n_slots):
+                self.index.forget(slot)
+        for slot in range(self.n_slots, n_slots):
+            if (slot not in busy):
+                self.free.append(slot)
+        self.n_slots = n_slots
+        while (self.free and self.waiters):
+            self.release(self.free.pop(0))
+
+    def stats(self):
+        return {
+            "slots_total": self.n_slots,
+            "slots_busy": self.busy,
+            "queue_depth": self.queue_depth,
+            "queue_max": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out
+        }
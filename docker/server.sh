@@ -1,6 +1,6 @@
 #!/bin/sh
 echo "server.sh"
-echo "args: $1"
+echo "args: $1 $2"
 
 # Check if NVIDIA GPU is available
 if lspci | grep -i nvidia &> /dev/null; then
@@ -13,5 +13,116 @@ else
   CPU_PER_SLOT=4
 fi
 
-killall llama-server
-/app/llama-server -m "$1" -c 2048 -t $(nproc --all) --host 0.0.0.0 --port 8081 -cb -np $(($(nproc --all) / $CPU_PER_SLOT)) -ngl $NGL &
+# Launch profile: LLAMA_* variables from config.yaml, overridden by the profile the tuner wrote on this host
+PROFILE=${LLAMA_PROFILE:-/app/profile.env}
+if [ -f "$PROFILE" ]; then
+  echo "Using launch profile $PROFILE"
+  . "$PROFILE"
+fi
+
+# Partitioned mode: LLAMA_INSTANCES servers on consecutive ports, each pinned to its own NUMA node or core range
+NUMA_NODES=$(ls -d /sys/devices/system/node/node[0-9]* 2>/dev/null | wc -l)
+INSTANCES=${LLAMA_INSTANCES:-1}
+if [ "$INSTANCES" = "numa" ]; then
+  INSTANCES=$(( NUMA_NODES > 0 ? NUMA_NODES : 1 ))
+fi
+PIN_NUMA=0
+if [ "$INSTANCES" -gt 1 ] && [ "$NUMA_NODES" -eq "$INSTANCES" ] && command -v numactl > /dev/null; then
+  PIN_NUMA=1
+fi
+# Threads, slots and context size are per server
+CORES=$(( $(nproc --all) / INSTANCES ))
+PIN_CORES=1
+if [ "$CORES" -lt 1 ]; then
+  # more servers than cores, they share all of them
+  CORES=1
+  PIN_CORES=0
+fi
+N_SLOTS=${LLAMA_SLOTS:-$(( CORES / CPU_PER_SLOT > 0 ? CORES / CPU_PER_SLOT : 1 ))}
+# Context size: the trained context of the model for every slot up to LLAMA_MAX_CTX_PER_SLOT, as far as the KV cache fits next to the model with headroom
+CTX_SIZE=$LLAMA_CTX_SIZE
+if [ -z "$CTX_SIZE" ]; then
+  if [ "${LLAMA_N_GPU_LAYERS:-$NGL}" -gt 0 ] && command -v nvidia-smi > /dev/null; then
+    MEMORY_MB=$(nvidia-smi --query-gpu=memory.total --format=csv,noheader,nounits | head -1)
+  else
+    MEMORY_MB=$(awk '/^MemAvailable:/ { print int($2 / 1024) }' /proc/meminfo)
+  fi
+  CTX_SIZE=$(python3 "$(dirname "$0")/gguf.py" "$1" --ctx-size --slots $N_SLOTS --memory-mb $(( ${MEMORY_MB:-0} / INSTANCES )) --kv-memory-mb ${LLAMA_KV_MEMORY_MB:-0} || echo 2048)
+  echo "Context size $CTX_SIZE for $N_SLOTS slot(s) from the model metadata"
+fi
+LLAMA_ARGS="-c $CTX_SIZE -t ${LLAMA_THREADS:-$CORES} --host 0.0.0.0 -cb -np $N_SLOTS -ngl ${LLAMA_N_GPU_LAYERS:-$NGL}"
+[ -n "$LLAMA_THREADS_BATCH" ] && LLAMA_ARGS="$LLAMA_ARGS -tb $LLAMA_THREADS_BATCH"
+[ -n "$LLAMA_BATCH_SIZE" ] && LLAMA_ARGS="$LLAMA_ARGS -b $LLAMA_BATCH_SIZE"
+[ -n "$LLAMA_UBATCH_SIZE" ] && LLAMA_ARGS="$LLAMA_ARGS -ub $LLAMA_UBATCH_SIZE"
+[ "$LLAMA_MLOCK" = "1" ] && LLAMA_ARGS="$LLAMA_ARGS --mlock"
+[ "$LLAMA_MMAP" = "0" ] && LLAMA_ARGS="$LLAMA_ARGS --no-mmap"
+# Embedding models: server.cpp then only answers embedding requests
+[ "$LLAMA_EMBEDDINGS" = "1" ] && LLAMA_ARGS="$LLAMA_ARGS --embeddings"
+[ -n "$LLAMA_POOLING" ] && LLAMA_ARGS="$LLAMA_ARGS --pooling $LLAMA_POOLING"
+
+# Speculative decoding: the gateway sets LLAMA_DRAFT_MODEL, started by hand the draft is looked for next to the model
+DRAFT=${LLAMA_DRAFT_MODEL-$1.draft}
+if [ -n "$DRAFT" ] && [ -f "$DRAFT" ]; then
+  echo "Using draft model $DRAFT"
+  LLAMA_ARGS="$LLAMA_ARGS -md $DRAFT -ngld ${LLAMA_N_GPU_LAYERS_DRAFT:-${LLAMA_N_GPU_LAYERS:-$NGL}}"
+  [ -n "$LLAMA_DRAFT_MAX" ] && LLAMA_ARGS="$LLAMA_ARGS --draft-max $LLAMA_DRAFT_MAX"
+  [ -n "$LLAMA_DRAFT_MIN" ] && LLAMA_ARGS="$LLAMA_ARGS --draft-min $LLAMA_DRAFT_MIN"
+  [ -n "$LLAMA_DRAFT_P_MIN" ] && LLAMA_ARGS="$LLAMA_ARGS --draft-p-min $LLAMA_DRAFT_P_MIN"
+  [ -n "$LLAMA_CTX_SIZE_DRAFT" ] && LLAMA_ARGS="$LLAMA_ARGS -cd $LLAMA_CTX_SIZE_DRAFT"
+  [ -n "$LLAMA_THREADS_DRAFT" ] && LLAMA_ARGS="$LLAMA_ARGS -td $LLAMA_THREADS_DRAFT"
+fi
+echo "llama-server args: $LLAMA_ARGS, $INSTANCES instance(s)"
+
+# model, port, partition
+launch() {
+  if [ "$INSTANCES" -le 1 ]; then
+    exec /app/llama-server -m "$1" $LLAMA_ARGS --port $2
+  elif [ "$PIN_NUMA" = "1" ]; then
+    # threads and memory of the server stay on its node
+    exec numactl --cpunodebind=$3 --membind=$3 /app/llama-server -m "$1" $LLAMA_ARGS --numa numactl --port $2
+  elif [ "$PIN_CORES" = "1" ]; then
+    exec taskset -c $(( $3 * CORES ))-$(( $3 * CORES + CORES - 1 )) /app/llama-server -m "$1" $LLAMA_ARGS --port $2
+  else
+    exec /app/llama-server -m "$1" $LLAMA_ARGS --port $2
+  fi
+}
+
+# With a port the server runs in the foreground next to the others, e.g. for multi-model endpoints
+if [ -n "$2" ]; then
+  if [ "$INSTANCES" -le 1 ]; then
+    launch "$1" $2 0
+  fi
+  PIDS=""
+  for i in $(seq 0 $(( INSTANCES - 1 ))); do
+    launch "$1" $(( $2 + i )) $i &
+    PIDS="$PIDS $!"
+  done
+  trap 'kill $PIDS 2> /dev/null; wait; exit 0' TERM INT
+  wait
+  exit 0
+fi
+
+# Stops only the servers on the default ports, multi-model and swap servers on other ports keep running
+stop_port() {
+  for CMDLINE in /proc/[0-9]*/cmdline; do
+    case "$(tr '\0' ' ' < "$CMDLINE" 2> /dev/null)" in
+      *llama-server\ *" --port $1 ")
+        PID=${CMDLINE#/proc/}
+        PID=${PID%/cmdline}
+        kill $PID 2> /dev/null
+        # the new server binds the same port
+        for _ in $(seq 300); do
+          kill -0 $PID 2> /dev/null || break
+          sleep 0.1
+        done
+        ;;
+    esac
+  done
+}
+
+for i in $(seq 0 $(( INSTANCES - 1 ))); do
+  stop_port $(( 8081 + i ))
+done
+for i in $(seq 0 $(( INSTANCES - 1 ))); do
+  launch "$1" $(( 8081 + i )) $i &
+done
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import time
+import httpx
+
+parser = argparse.ArgumentParser(description="Finds the server.cpp launch profile with the best throughput or latency on this host and writes it for server.sh.")
+parser.add_argument("--model", type=str, help="Model file to tune with(default: MODELPATH)", default=os.environ.get("MODELPATH", "/app/llm_model.bin"))
+parser.add_argument("--launcher", type=str, help="Script starting server.cpp for a model and port(default: /app/server.sh)", default=os.environ.get("LLAMA_SERVER_SCRIPT", "/app/server.sh"))
+parser.add_argument("--port", type=int, help="Port server.cpp is started on while tuning(default: 8099)", default=8099)
+parser.add_argument("--prompts", type=str, help="JSON Lines file of {\"prompt\": ...} used for every trial(default: a built-in prompt set)", default="")
+parser.add_argument("--n-predict", type=int, help="Tokens generated per prompt(default: 64)", default=64)
+parser.add_argument("--concurrency", type=int, help="Requests in flight during a trial, 0 uses the largest --parallel value(default: 0)", default=0)
+parser.add_argument("--objective", type=str, choices=["throughput", "latency"], help="Maximize generated tokens per second or minimize the median request latency(default: throughput)", default="throughput")
+parser.add_argument("--threads", type=str, help="Comma separated -t values to try(default: all cores, half of them)", default="")
+parser.add_argument("--parallel", type=str, help="Comma separated -np values to try(default: 1,2,4,8 up to the core count)", default="")
+parser.add_argument("--batch-size", type=str, help="Comma separated -b values to try(default: 512,2048)", default="512,2048")
+parser.add_argument("--ubatch-size", type=str, help="Comma separated -ub values to try(default: 256,512)", default="256,512")
+parser.add_argument("--ctx-per-slot", type=int, help="Context tokens per slot, -c is this times -np, 0 leaves the context to server.sh, which sizes it from the model metadata(default: 0)", default=0)
+parser.add_argument("--mlock", action="store_true", help="Lock the model in memory in the written profile")
+parser.add_argument("--no-mmap", action="store_true", help="Load the model without mmap in the written profile")
+parser.add_argument("--load-timeout", type=float, help="Seconds to wait for server.cpp to become healthy(default: 600)", default=600.0)
+parser.add_argument("--output", type=str, help="Profile file sourced by server.sh(default: LLAMA_PROFILE or /app/profile.env)", default=os.environ.get("LLAMA_PROFILE", "/app/profile.env"))
+parser.add_argument("--report", type=str, help="JSON file with the results of every trial(default: NULL)", default="")
+
+PROMPTS = [
+    "Explain the difference between a process and a thread in a few sentences.",
+    "Write a short story about a lighthouse keeper who finds a message in a bottle.",
+    "List five practical tips for reducing the memory usage of a Python program.",
+    "Summarize the main causes of the French Revolution.",
+    "What are the advantages and disadvantages of electric cars compared to petrol cars?",
+    "Describe how a hash table works and when it performs badly.",
+    "Give a recipe for a simple vegetable soup.",
+    "Translate the following sentence to French and German: The weather is nice today."
+]
+
+def int_list(value, default):
+    return [int(item) for item in value.split(",") if item.strip()] if (value) else default
+
+def load_prompts(path):
+    if (not path):
+        return PROMPTS
+    with open(path) as f:
+        return [json.loads(line)["prompt"] for line in f if line.strip()]
+
+def profile_env(profile):
+    env = {
+        "LLAMA_THREADS": str(profile["threads"]),
+        "LLAMA_SLOTS": str(profile["parallel"]),
+        "LLAMA_BATCH_SIZE": str(profile["batch_size"]),
+        "LLAMA_UBATCH_SIZE": str(profile["ubatch_size"])
+    }
+    #a fixed context would override the size server.sh derives from the model and the memory
+    if ("ctx_size" in profile):
+        env["LLAMA_CTX_SIZE"] = str(profile["ctx_size"])
+    return env
+
+async def wait_healthy(client, process, timeout):
+    deadline = time.monotonic() + timeout
+    while (time.monotonic() < deadline and process.returncode is None):
+        try:
+            if ((await client.get("/health")).status_code == 200):
+                return True
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    return False
+
+async def run_load(client, prompts, n_predict, concurrency):
+    #every prompt twice, so the trial is not over before all slots had work
+    queue = list(prompts) * 2
+    latencies = []
+    tokens = 0
+
+    async def worker():
+        nonlocal tokens
+        while (queue):
+            prompt = queue.pop()
+            started = time.monotonic()
+            data = (await client.post("/completion", json={"prompt": prompt, "n_predict": n_predict, "cache_prompt": False})).json()
+            latencies.append(time.monotonic() - started)
+            tokens += data.get("tokens_predicted", 0)
+
+    started = time.monotonic()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    return {"tokens_per_s": tokens / elapsed, "p50_latency_s": latencies[len(latencies) // 2], "seconds": elapsed}
+
+async def trial(args, profile, prompts, concurrency):
+    #the old profile file must not override the values under test
+    env = {**os.environ, **profile_env(profile), "LLAMA_PROFILE": "/dev/null"}
+    process = await asyncio.create_subprocess_exec(args.launcher, args.model, str(args.port), env=env)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=httpx.Timeout(None, connect=10.0)) as client:
+            if (not await wait_healthy(client, process, args.load_timeout)):
+                return None
+            await client.post("/completion", json={"prompt": prompts[0], "n_predict": 4})
+            return await run_load(client, prompts, args.n_predict, concurrency)
+    except (httpx.HTTPError, ValueError) as e:
+        print(f"trial failed: {e}")
+        return None
+    finally:
+        if (process.returncode is None):
+            process.terminate()
+            await process.wait()
+
+def better(objective, result, best):
+    if (best is None):
+        return True
+    if (objective == "throughput"):
+        return result["tokens_per_s"] > best["tokens_per_s"]
+    return result["p50_latency_s"] < best["p50_latency_s"]
+
+async def tune(args):
+    cores = os.cpu_count() or 1
+    space = {
+        "parallel": int_list(args.parallel, [n for n in (1, 2, 4, 8) if n <= cores]),
+        "threads": int_list(args.threads, sorted({cores, max(1, cores // 2)}, reverse=True)),
+        "batch_size": int_list(args.batch_size, [512, 2048]),
+        "ubatch_size": int_list(args.ubatch_size, [256, 512])
+    }
+    concurrency = args.concurrency or max(space["parallel"])
+    prompts = load_prompts(args.prompts)
+    #one setting at a time, keeping the best value of the ones tuned before
+    profile = {name: values[0] for name, values in space.items()}
+    trials = []
+    best, best_result = None, None
+    for name, values in space.items():
+        for value in values:
+            candidate = {**profile, name: value}
+            if (candidate["ubatch_size"] > candidate["batch_size"]):
+                continue
+            if (args.ctx_per_slot > 0):
+                candidate["ctx_size"] = args.ctx_per_slot * candidate["parallel"]
+            if (any(done["profile"] == candidate for done in trials)):
+                continue
+            result = await trial(args, candidate, prompts, concurrency)
+            trials.append({"profile": candidate, "result": result})
+            print(f"{candidate}: {result}")
+            if (result is not None and better(args.objective, result, best_result)):
+                best, best_result = candidate, result
+        if (best is not None):
+            profile = {name: best[name] for name in space}
+    if (best is None):
+        raise SystemExit("no trial succeeded")
+
+    env = profile_env(best)
+    if (args.mlock):
+        env["LLAMA_MLOCK"] = "1"
+    if (args.no_mmap):
+        env["LLAMA_MMAP"] = "0"
+    with open(args.output, "w") as f:
+        f.write(f"# written by tune.py for {os.path.basename(args.model)} on {cores} cores, objective {args.objective}: {json.dumps(best_result)}\n")
+        for key, value in env.items():
+            f.write(f"{key}={value}\n")
+    print(f"best profile written to {args.output}: {best} {best_result}")
+    #the same values for config.yaml, so other instances of this type start with them
+    print("launch_profiles entry for config.yaml:")
+    print(json.dumps({**best, **({"mlock": True} if (args.mlock) else {}), **({"mmap": False} if (args.no_mmap) else {})}))
+    if (args.report):
+        with open(args.report, "w") as f:
+            json.dump({"objective": args.objective, "concurrency": concurrency, "best": best, "best_result": best_result, "trials": trials}, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(tune(parser.parse_args()))
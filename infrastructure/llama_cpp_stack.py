@@ -19,154 +19,235 @@ from constructs import Construct
 import json
 import os
 
-class LlamaCppStack(Stack):
-    def __init__(self, scope: Construct, construct_id: str,
-            project_name: str, 
-            model_bucket_key_full_name: str,
-            model_hugging_face_name: str,
-            image_tag: str,
-            image_platform: str,
-            model_name: str,
-            model_instance_type: str,
-            **kwargs) -> None:
-        super().__init__(scope, construct_id, **kwargs)
+#launch profile settings in config.yaml and the server.sh variables they set
+LAUNCH_PROFILE_ENV = {
+    "threads": "LLAMA_THREADS",
+    "threads_batch": "LLAMA_THREADS_BATCH",
+    "batch_size": "LLAMA_BATCH_SIZE",
+    "ubatch_size": "LLAMA_UBATCH_SIZE",
+    "parallel": "LLAMA_SLOTS",
+    "ctx_size": "LLAMA_CTX_SIZE",
+    "mlock": "LLAMA_MLOCK",
+    "mmap": "LLAMA_MMAP",
+    "n_gpu_layers": "LLAMA_N_GPU_LAYERS",
+    "instances": "LLAMA_INSTANCES",
+    "fast_start": "LLAMA_FAST_START"
+}
 
-        #============================ 
-        #       model_download
-        #============================ 
-        bucket = s3.Bucket(
-            self, 
-            f"{project_name}-bucket",
-            versioned=True,
-            removal_policy=RemovalPolicy.DESTROY,
-            enforce_ssl=True,
-            encryption=s3.BucketEncryption.S3_MANAGED,
-            auto_delete_objects=True
-        )
+#speculative decoding settings of model.draft in config.yaml and the server.sh variables they set
+DRAFT_ENV = {
+    "max": "LLAMA_DRAFT_MAX",
+    "min": "LLAMA_DRAFT_MIN",
+    "p_min": "LLAMA_DRAFT_P_MIN",
+    "ctx_size": "LLAMA_CTX_SIZE_DRAFT",
+    "threads": "LLAMA_THREADS_DRAFT",
+    "n_gpu_layers": "LLAMA_N_GPU_LAYERS_DRAFT"
+}
 
-        model_download_build_project = cb.Project(
-            self,
-            f"{project_name}-model-download",
-            build_spec=cb.BuildSpec.from_asset(os.path.join(os.path.abspath(os.curdir), "cb_buildspec/model_download_buildspec.yaml")),
-            environment=cb.BuildEnvironment(
-                privileged=True,
-                build_image=cb.LinuxBuildImage.STANDARD_6_0
-            ),
-            environment_variables={
-                "CDK_DEPLOY_ACCOUNT": cb.BuildEnvironmentVariable(value=self.account),
-                "CDK_DEPLOY_REGION": cb.BuildEnvironmentVariable(value=self.region),
-                "MODEL_BUCKET_NAME": cb.BuildEnvironmentVariable(value=bucket.bucket_name),
-                "MODEL_BUCKET_KEY_FULL_NAME": cb.BuildEnvironmentVariable(value=model_bucket_key_full_name),
-                "MODEL_HUGGING_FACE_NAME": cb.BuildEnvironmentVariable(value=model_hugging_face_name),
-                "TAG": cb.BuildEnvironmentVariable(value='cdk')
-            },
-            description='Download Large Language Model files to object store',
-            timeout=Duration.minutes(60),
-        )
-        
-        bucket.grant_read_write(model_download_build_project)
+def model_download_task(scope, project_name, bucket, model_bucket_key_full_name, model_hugging_face_name, draft):
+    #CodeBuild project downloading the model, and its draft model, from Hugging Face into the bucket
+    model_download_build_project = cb.Project(
+        scope,
+        f"{project_name}-model-download",
+        build_spec=cb.BuildSpec.from_asset(os.path.join(os.path.abspath(os.curdir), "cb_buildspec/model_download_buildspec.yaml")),
+        environment=cb.BuildEnvironment(
+            privileged=True,
+            build_image=cb.LinuxBuildImage.STANDARD_6_0
+        ),
+        environment_variables={
+            "CDK_DEPLOY_ACCOUNT": cb.BuildEnvironmentVariable(value=scope.account),
+            "CDK_DEPLOY_REGION": cb.BuildEnvironmentVariable(value=scope.region),
+            "MODEL_BUCKET_NAME": cb.BuildEnvironmentVariable(value=bucket.bucket_name),
+            "MODEL_BUCKET_KEY_FULL_NAME": cb.BuildEnvironmentVariable(value=model_bucket_key_full_name),
+            "MODEL_HUGGING_FACE_NAME": cb.BuildEnvironmentVariable(value=model_hugging_face_name),
+            "MODEL_DRAFT_BUCKET_KEY_FULL_NAME": cb.BuildEnvironmentVariable(value=draft.get("full_name", "")),
+            "MODEL_DRAFT_HUGGING_FACE_NAME": cb.BuildEnvironmentVariable(value=draft.get("hf_name", model_hugging_face_name)),
+            "TAG": cb.BuildEnvironmentVariable(value='cdk')
+        },
+        description='Download Large Language Model files to object store',
+        timeout=Duration.minutes(60),
+    )
 
-        sfn_model_download_task = tasks.CodeBuildStartBuild(
-            self,
-            f"{project_name}-start-model-download",
-            project=model_download_build_project,
-            integration_pattern=sfn.IntegrationPattern.RUN_JOB
-        )
+    bucket.grant_read_write(model_download_build_project)
 
+    return tasks.CodeBuildStartBuild(
+        scope,
+        f"{project_name}-start-model-download",
+        project=model_download_build_project,
+        integration_pattern=sfn.IntegrationPattern.RUN_JOB
+    )
 
-        #============================ 
-        #       model_build
-        #============================
-        model_image_repo = ecr.Repository(
-            self, 
-            f"{project_name}-model-image-repo",
-            removal_policy=RemovalPolicy.DESTROY,
-            auto_delete_images=True
-        )
+def image_build_task(scope, project_name, image_platform, image_tag, repository_name=None):
+    #ECR repository and the CodeBuild project building the inference image into it
+    model_image_repo = ecr.Repository(
+        scope, 
+        f"{project_name}-model-image-repo",
+        repository_name=repository_name,
+        removal_policy=RemovalPolicy.DESTROY,
+        auto_delete_images=True
+    )
 
-        model_asset_bucket = s3_assets.Asset(
-            self, 
-            f"{project_name}-model-build-docker-assets",
-            path = os.path.join(os.path.abspath(os.curdir), "docker"),
-        )
+    model_asset_bucket = s3_assets.Asset(
+        scope, 
+        f"{project_name}-model-build-docker-assets",
+        path = os.path.join(os.path.abspath(os.curdir), "docker"),
+    )
 
-        model_build_cb_project = cb.Project(
-            self, 
-            f"{project_name}-model-build",
-            source=cb.Source.s3(
-                bucket=model_asset_bucket.bucket,
-                path=model_asset_bucket.s3_object_key
-            ),
-            build_spec=cb.BuildSpec.from_asset(os.path.join(os.path.abspath(os.curdir), "cb_buildspec/model_build_docker_buildspec.yaml")),
-            environment=cb.BuildEnvironment(
-                privileged=True,
-                build_image=cb.LinuxBuildImage.STANDARD_6_0,
-                compute_type=cb.ComputeType.X2_LARGE # to decrease wait time
-            ),
-            environment_variables={
-                "CDK_DEPLOY_ACCOUNT": cb.BuildEnvironmentVariable(value=self.account),
-                "CDK_DEPLOY_REGION": cb.BuildEnvironmentVariable(value=self.region),
-                "REPOSITORY_NAME": cb.BuildEnvironmentVariable(value=model_image_repo.repository_name),
-                "PLATFORM": cb.BuildEnvironmentVariable(value=image_platform),
-                "IMAGE_TAG": cb.BuildEnvironmentVariable(value=image_tag),
-                "ECR": cb.BuildEnvironmentVariable(value=model_image_repo.repository_uri),
-                "TAG": cb.BuildEnvironmentVariable(value='cdk')
-            },
-            description='Project to build and push images to container registry',
-            timeout=Duration.minutes(60),
-        )
-        model_image_repo.grant_pull_push(model_build_cb_project)
+    model_build_cb_project = cb.Project(
+        scope, 
+        f"{project_name}-model-build",
+        source=cb.Source.s3(
+            bucket=model_asset_bucket.bucket,
+            path=model_asset_bucket.s3_object_key
+        ),
+        build_spec=cb.BuildSpec.from_asset(os.path.join(os.path.abspath(os.curdir), "cb_buildspec/model_build_docker_buildspec.yaml")),
+        environment=cb.BuildEnvironment(
+            privileged=True,
+            build_image=cb.LinuxBuildImage.STANDARD_6_0,
+            compute_type=cb.ComputeType.X2_LARGE # to decrease wait time
+        ),
+        environment_variables={
+            "CDK_DEPLOY_ACCOUNT": cb.BuildEnvironmentVariable(value=scope.account),
+            "CDK_DEPLOY_REGION": cb.BuildEnvironmentVariable(value=scope.region),
+            "REPOSITORY_NAME": cb.BuildEnvironmentVariable(value=model_image_repo.repository_name),
+            "PLATFORM": cb.BuildEnvironmentVariable(value=image_platform),
+            "IMAGE_TAG": cb.BuildEnvironmentVariable(value=image_tag),
+            "ECR": cb.BuildEnvironmentVariable(value=model_image_repo.repository_uri),
+            "TAG": cb.BuildEnvironmentVariable(value='cdk')
+        },
+        description='Project to build and push images to container registry',
+        timeout=Duration.minutes(60),
+    )
+    model_image_repo.grant_pull_push(model_build_cb_project)
 
-        sfn_model_build_task = tasks.CodeBuildStartBuild(
-            self,
-            f"{project_name}-start-model-docker-build",
-            project=model_build_cb_project,
-            integration_pattern=sfn.IntegrationPattern.RUN_JOB
-        )
+    return model_image_repo, tasks.CodeBuildStartBuild(
+        scope,
+        f"{project_name}-start-model-docker-build",
+        project=model_build_cb_project,
+        integration_pattern=sfn.IntegrationPattern.RUN_JOB
+    )
 
-        #==========================================
-        #       model_download_build_deployment
-        #==========================================
-        # llama-cpp-sm
-        chain = sfn_model_download_task.next(
-            sfn_model_build_task
-        )
+def run_at_deploy(scope, project_name, chain):
+    #runs the state machine during the deployment, the custom resource completes once the execution did
+    state_machine = sfn.StateMachine(
+        scope,
+        f"{project_name}-llama-cpp-statemachine",
+        definition_body=sfn.DefinitionBody.from_chainable(chain)
+    )
 
-        state_machine = sfn.StateMachine(
-            self,
-            f"{project_name}-llama-cpp-statemachine",
-            definition_body=sfn.DefinitionBody.from_chainable(chain)
-        )
+    trigger_lambda = lambda_.Function(
+        scope,
+        f"{project_name}-trigger-llama-cpp-sm",
+        runtime=lambda_.Runtime.PYTHON_3_12,
+        handler="trigger_build.lambda_handler",
+        code=lambda_.Code.from_asset(os.path.join(os.path.abspath(os.curdir), "lambda/trigger_build")),
+        environment={
+            "STATE_MACHINE_ARN": state_machine.state_machine_arn
+        }
+    )
 
-        trigger_lambda = lambda_.Function(
-            self,
-            f"{project_name}-trigger-llama-cpp-sm",
-            runtime=lambda_.Runtime.PYTHON_3_12,
-            handler="trigger_build.lambda_handler",
-            code=lambda_.Code.from_asset(os.path.join(os.path.abspath(os.curdir), "lambda/trigger_build")),
-            environment={
-                "STATE_MACHINE_ARN": state_machine.state_machine_arn
-            }
-        )
+    trigger_lambda.add_to_role_policy(iam.PolicyStatement(
+        actions=["states:StartExecution","states:ListExecutions"],
+        resources=[state_machine.state_machine_arn]
+    ))
 
-        trigger_lambda.add_to_role_policy(iam.PolicyStatement(
-            actions=["states:StartExecution","states:ListExecutions"],
-            resources=[state_machine.state_machine_arn]
-        ))
+    cr_provider = cr.Provider(
+        scope,
+        f"{project_name}-trigger-resource-provider",
+        on_event_handler=trigger_lambda,
+        is_complete_handler=trigger_lambda,
+        query_interval=Duration.seconds(30)
+    )
 
-        cr_provider = cr.Provider(
-            self,
-            f"{project_name}-trigger-resource-provider",
-            on_event_handler=trigger_lambda,
-            is_complete_handler=trigger_lambda,
-            query_interval=Duration.seconds(30)
-        )
+    return CustomResource(
+        scope,
+        f"{project_name}-trigger-resource",
+        service_token=cr_provider.service_token
+    )
 
-        trigger_resource_cr = CustomResource(
-            self,
-            f"{project_name}-trigger-resource",
-            service_token=cr_provider.service_token
-        )
+def model_bucket(scope, project_name):
+    return s3.Bucket(
+        scope, 
+        f"{project_name}-bucket",
+        versioned=True,
+        removal_policy=RemovalPolicy.DESTROY,
+        enforce_ssl=True,
+        encryption=s3.BucketEncryption.S3_MANAGED,
+        auto_delete_objects=True
+    )
+
+class LlamaCppModelStack(Stack):
+    """Downloads a model, and its draft model, once for every endpoint stack serving it."""
+
+    def __init__(self, scope: Construct, construct_id: str,
+            project_name: str,
+            model_bucket_key_full_name: str,
+            model_hugging_face_name: str,
+            draft: dict = None,
+            **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        bucket = model_bucket(self, project_name)
+        run_at_deploy(self, project_name, model_download_task(self, project_name, bucket, model_bucket_key_full_name, model_hugging_face_name, draft or {}))
+        CfnOutput(self, "bucket", value=bucket.bucket_name)
+
+class LlamaCppImageStack(Stack):
+    """Builds the inference image of a platform once for every endpoint stack using it."""
+
+    def __init__(self, scope: Construct, construct_id: str,
+            project_name: str,
+            image_tag: str,
+            image_platform: str,
+            **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+
+        model_image_repo, task = image_build_task(self, project_name, image_platform, image_tag, repository_name=project_name)
+        run_at_deploy(self, project_name, task)
+        CfnOutput(self, "repository", value=model_image_repo.repository_name)
+
+class LlamaCppStack(Stack):
+    def __init__(self, scope: Construct, construct_id: str,
+            project_name: str, 
+            model_bucket_key_full_name: str,
+            model_hugging_face_name: str,
+            image_tag: str,
+            image_platform: str,
+            model_name: str,
+            model_instance_type: str,
+            launch_profile: dict = None,
+            draft: dict = None,
+            embeddings: bool = False,
+            chat_template: str = None,
+            shared: dict = None,
+            **kwargs) -> None:
+        super().__init__(scope, construct_id, **kwargs)
+        draft = draft or {}
+
+        trigger_resource_cr = None
+        if shared:
+            #bucket and image come from a LlamaCppModelStack and LlamaCppImageStack deployed before
+            bucket = s3.Bucket.from_bucket_name(self, f"{project_name}-bucket", shared["bucket"])
+            model_image_repo = ecr.Repository.from_repository_name(self, f"{project_name}-model-image-repo", shared["repository"])
+        else:
+            #============================ 
+            #       model_download
+            #============================ 
+            bucket = model_bucket(self, project_name)
+            sfn_model_download_task = model_download_task(self, project_name, bucket, model_bucket_key_full_name, model_hugging_face_name, draft)
+
+            #============================ 
+            #       model_build
+            #============================
+            model_image_repo, sfn_model_build_task = image_build_task(self, project_name, image_platform, image_tag)
+
+            #==========================================
+            #       model_download_build_deployment
+            #==========================================
+            # llama-cpp-sm
+            chain = sfn_model_download_task.next(
+                sfn_model_build_task
+            )
+            trigger_resource_cr = run_at_deploy(self, project_name, chain)
 
         #============================ 
         #       model_serve
@@ -239,13 +320,21 @@ class LlamaCppStack(Stack):
                         "SAGEMAKER_CONTAINER_LOG_LEVEL": "20",
                         "SAGEMAKER_PROGRAM": "inference.py",
                         "SAGEMAKER_REGION": f"{self.region}",
-                        "SAGEMAKER_SUBMIT_DIRECTORY": "/opt/ml/model/code"            
+                        "SAGEMAKER_SUBMIT_DIRECTORY": "/opt/ml/model/code",
+                        #the container downloads and starts the model itself, so autoscaled instances serve it too
+                        "LLAMA_MODEL_S3_URI": f"s3://{bucket.bucket_name}/{model_bucket_key_full_name}",
+                        **{LAUNCH_PROFILE_ENV[key]: str(int(value)) if isinstance(value, bool) else str(value) for key, value in (launch_profile or {}).items()},
+                        **({"LLAMA_DRAFT_S3_URI": f"s3://{bucket.bucket_name}/{draft['full_name']}"} if draft else {}),
+                        **{DRAFT_ENV[key]: str(value) for key, value in draft.items() if key in DRAFT_ENV},
+                        **({"LLAMA_EMBEDDINGS": "1"} if embeddings else {}),
+                        **({"LLAMA_CHAT_TEMPLATE": chat_template} if chat_template else {})
                     }
                 )
             ],
             model_name=f"{project_name}-{model_name}-Model"
         )
-        model.node.add_dependency(trigger_resource_cr)
+        if trigger_resource_cr is not None:
+            model.node.add_dependency(trigger_resource_cr)
         
         model_config = sagemaker.CfnEndpointConfig(
             self,
@@ -257,7 +346,9 @@ class LlamaCppStack(Stack):
                     variant_name="AllTraffic",
                     initial_instance_count=1,
                     initial_variant_weight=1,
-                    instance_type=model_instance_type
+                    instance_type=model_instance_type,
+                    #/ping only succeeds once the model is downloaded and loaded
+                    container_startup_health_check_timeout_in_seconds=1800
                 )
             ]
         )
@@ -288,7 +379,8 @@ class LlamaCppStack(Stack):
             environment={
                 "SAGEMAKER_ENDPOINT_NAME": model_endpoint.attr_endpoint_name,
                 "MODEL_BUCKET_NAME": bucket.bucket_name,
-                "MODEL_BUCKET_KEY_NAME": model_bucket_key_full_name
+                "MODEL_BUCKET_KEY_NAME": model_bucket_key_full_name,
+                "MODEL_DRAFT_BUCKET_KEY_NAME": draft.get("full_name", "")
             },
         )
         sagemaker_endpoint_configure_lambda.node.add_dependency(model_endpoint)
@@ -14,6 +14,8 @@ def lambda_handler(event, context):
             "key": environ['MODEL_BUCKET_KEY_NAME']
         }
     }
+    if environ.get('MODEL_DRAFT_BUCKET_KEY_NAME'):
+        payload["configure"]["draft"] = {"key": environ['MODEL_DRAFT_BUCKET_KEY_NAME']}
     print(f' payload : {json.dumps(payload, default=str)}')
 
     if event_type in ['Create']:
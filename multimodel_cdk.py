@@ -1,70 +1,153 @@
-import subprocess
-from concurrent.futures import ThreadPoolExecutor
-import yaml
-import tempfile
+import asyncio
+import hashlib
+import json
 import os
+import re
+import time
+import yaml
 import argparse
 
-def execute_command(command):
-    try:
-        # Execute the command and capture its output
-        output = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT, universal_newlines=True)
-        return command, output
-    except subprocess.CalledProcessError as e:
-        # Capture error output if the command fails
-        return command, e.output
+class Node:
+    """One cdk deploy or destroy of the plan, run once the nodes it depends on succeeded."""
+
+    def __init__(self, name, stack, config, deps=()):
+        self.name = name
+        self.stack = stack
+        self.config = config
+        self.deps = list(deps)
+        self.outputs = {}
+        self.state = "pending"
+        self.seconds = None
+
+def name_part(value):
+    return re.sub(r"[^a-z0-9]+", "-", str(value).lower()).strip("-")
+
+def plan(projects, shared_name):
+    # one image stack per platform and tag, one download stack per model, then the endpoint stacks using them
+    images, models, endpoints = {}, {}, []
+    for project in projects:
+        platform, image_tag = project['image']['platform'].lower(), project['image']['image_tag']
+        if (platform, image_tag) not in images:
+            name = f"{shared_name}-{name_part(platform)}-{name_part(image_tag)}"
+            images[(platform, image_tag)] = Node(name, f"{name}-LlamaCppImageStack", {'image_build': {'name': name, 'platform': platform, 'image_tag': image_tag}})
+
+        # only the files decide what is downloaded, the speculative decoding settings stay with the endpoint
+        model = {key: project['model'][key] for key in ('hf_name', 'full_name')}
+        if project['model'].get('draft'):
+            model['draft'] = {key: value for key, value in project['model']['draft'].items() if key in ('hf_name', 'full_name')}
+        key = json.dumps(model, sort_keys=True)
+        if key not in models:
+            name = f"{shared_name}-model-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:10]}"
+            models[key] = Node(name, f"{name}-LlamaCppModelStack", {'model_download': {'name': name, 'model': model}})
+
+        endpoints.append(Node(project['name'], f"{project['name']}-LlamaCppStack", {'project': project}, deps=[images[(platform, image_tag)], models[key]]))
+    return list(images.values()) + list(models.values()) + endpoints
+
+def print_plan(nodes):
+    for node in nodes:
+        after = f" after {', '.join(dep.name for dep in node.deps)}" if node.deps else ""
+        print(f"{node.stack}{after}")
+
+def read_outputs(path, stack):
+    # cdk deploy --outputs-file writes {stack name: {output id: value}}
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get(stack, {})
+
+async def run_node(node, args, action, semaphore):
+    async with semaphore:
+        config = node.config
+        if action == "deploy" and 'project' in config:
+            # the endpoint stack imports the bucket and repository its shared stacks created
+            shared = {}
+            for dep in node.deps:
+                shared.update(dep.outputs)
+            config = {'project': {**config['project'], 'shared': shared}}
+        config_file = os.path.join(args.output_dir, f".{node.name}.yaml")
+        with open(config_file, 'w') as f:
+            yaml.dump(config, f)
+        outputs_file = os.path.join(args.output_dir, f"{node.name}.outputs.json")
+        command = [args.cdk, action, "--context", f"config_file={config_file}", f"--output={os.path.join(args.output_dir, node.name)}", "--require-approval=never"]
+        if action == "deploy":
+            command += ["--progress=events", f"--outputs-file={outputs_file}"]
+        else:
+            command += ["--force"]
+
+        print(f"==> {node.stack}: {action} started", flush=True)
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+        # every line as it arrives, prefixed with its stack, so parallel deployments can be told apart
+        async for line in process.stdout:
+            print(f"[{node.name}] {line.decode('utf-8', 'replace').rstrip()}", flush=True)
+        code = await process.wait()
+        node.seconds = time.monotonic() - started
+        node.state = "done" if code == 0 else "failed"
+        if action == "deploy" and code == 0:
+            node.outputs = read_outputs(outputs_file, node.stack)
+        print(f"==> {node.stack}: {action} {node.state} after {node.seconds:.0f}s" + (f" (exit code {code})" if code else ""), flush=True)
+
+async def run(nodes, args, action):
+    # a deploy waits for the stacks a node depends on, a destroy for the stacks depending on it
+    waits_for = {node.name: node.deps for node in nodes}
+    if action == "destroy":
+        waits_for = {node.name: [other for other in nodes if node in other.deps] for node in nodes}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    tasks = {}
+
+    async def run_after(node):
+        for other in waits_for[node.name]:
+            await tasks[other.name]
+        failed = [other.name for other in waits_for[node.name] if other.state != "done"]
+        if failed:
+            node.state = "skipped"
+            print(f"==> {node.stack}: skipped, {', '.join(failed)} did not succeed", flush=True)
+            return
+        await run_node(node, args, action, semaphore)
+
+    for node in nodes:
+        tasks[node.name] = asyncio.ensure_future(run_after(node))
+    await asyncio.gather(*tasks.values())
 
 def main():
     parser = argparse.ArgumentParser(description="LlamaCpp Multimodel Deploy utility")
     parser.add_argument("--deploy", action="store_true", help="Deploy model stacks")
     parser.add_argument("--destroy", action="store_true", help="Destroy model stacks")
+    parser.add_argument("--plan", action="store_true", help="Print the stacks and their dependencies without deploying")
     parser.add_argument("--config",help="Multimodel config file", default="multimodel_config.yaml" )
     parser.add_argument("--output-dir", help="Output directory for model deployment assets", default="./cdk.out/.multimodel_deploy")
+    parser.add_argument("--concurrency", type=int, help="Stacks deployed at the same time(default: 5)", default=5)
+    parser.add_argument("--shared-name", help="Name prefix of the image and model download stacks shared by the projects(default: llmcpp-shared)", default="llmcpp-shared")
+    parser.add_argument("--cdk", help="CDK CLI command(default: cdk)", default="cdk")
     args = parser.parse_args()
 
-    # list of cdk stacks
-    dotfiles_dir = args.output_dir
     with open(args.config, 'r') as f:
         project_config = yaml.safe_load(f)
+    nodes = plan(project_config['project'], name_part(args.shared_name))
 
-        os.makedirs(dotfiles_dir, exist_ok=True)
-
-        dotfiles = []
-        for idx, project in enumerate(project_config['project']):
-            dotfile = tempfile.NamedTemporaryFile(prefix='.', suffix='.yaml', delete=False, dir=dotfiles_dir)
-            dotfiles.append(dotfile.name)
-            with open(dotfile.name, 'w') as f:
-                yaml.dump({'project': project}, f)
-
-    # List of commands to execute
-    commands = []
-    print('Running following in parallel : ')
-    for idx, config_file in enumerate(dotfiles):
-        output_dir_name = os.path.splitext(config_file)[0]
-        if args.deploy:
-            commands.append(f"cdk deploy --context config_file='{config_file}' --output='{output_dir_name}' --require-approval=never")
-        elif args.destroy:
-            commands.append(f"cdk destroy --context config_file='{config_file}' --output='{output_dir_name}' --require-approval=never --force")
-        else:
-            parser.print_help()
-            return
-        print(commands[idx])
-    
-    
-    # Maximum number of threads to use
-    max_threads = 5
-
-    # Execute commands in parallel using a ThreadPoolExecutor
-    with ThreadPoolExecutor(max_threads) as executor:
-        # Submit each command to the executor
-        futures = [executor.submit(execute_command, cmd) for cmd in commands]
-    
-        # Wait for all commands to complete and collect results
-        for future in futures:
-            command, result = future.result()
-            print(f"Output of command '{command}':")
-            print(result)
-            print("=" * 50)
+    if args.plan:
+        print_plan(nodes)
+        return
+    if args.deploy:
+        action = "deploy"
+    elif args.destroy:
+        action = "destroy"
+    else:
+        parser.print_help()
+        return
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    print_plan(nodes)
+    started = time.monotonic()
+    asyncio.run(run(nodes, args, action))
+
+    print("=" * 50)
+    for node in nodes:
+        seconds = f"{node.seconds:.0f}s" if node.seconds is not None else "-"
+        print(f"{node.stack:60} {node.state:8} {seconds}")
+    print(f"total {time.monotonic() - started:.0f}s")
+    if any(node.state != "done" for node in nodes):
+        raise SystemExit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
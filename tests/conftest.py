@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#the gateway modules import each other by name, the way they run in the image
+for directory in ("docker", "benchmark", "client"):
+    path = os.path.join(ROOT, directory)
+    if (path not in sys.path):
+        sys.path.insert(0, path)
@@ -0,0 +1,121 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+
+from tests.conftest import ROOT
+
+DOCKER = os.path.join(ROOT, "docker")
+BENCHMARK = os.path.join(ROOT, "benchmark")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, process=None, timeout=30, status=200):
+    deadline = time.monotonic() + timeout
+    while (time.monotonic() < deadline):
+        if (process is not None and process.poll() is not None):
+            raise RuntimeError(f"{process.args} exited with {process.returncode} before {url} answered")
+        try:
+            if (httpx.get(url, timeout=2).status_code == status):
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f"{url} did not answer {status} within {timeout}s")
+
+
+@pytest.fixture
+def processes(tmp_path):
+    #started processes log to tmp_path and are stopped after the test
+    started = []
+
+    def start(name, command, cwd, env=None):
+        log = open(tmp_path / f"{name}.log", "ab")
+        process = subprocess.Popen(command, cwd=cwd, env={**os.environ, **(env or {})}, stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        started.append(process)
+        return process
+
+    yield start
+    for process in started:
+        if (process.poll() is None):
+            process.terminate()
+    for process in started:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+@pytest.fixture
+def mock_server(processes):
+    #benchmark/mock_server.py on a free port, returns the port
+    def start(*extra):
+        port = free_port()
+        process = processes(f"mock-{port}", [sys.executable, "mock_server.py", "--port", str(port), *extra], BENCHMARK)
+        wait_for(f"http://127.0.0.1:{port}/health", process)
+        return port
+    return start
+
+
+@pytest.fixture
+def gateway_env(tmp_path):
+    #no startup model, no launch profile, lock and ready files kept inside the test
+    return {
+        "TMPDIR": str(tmp_path),
+        "SM_MODEL_DIR": str(tmp_path / "no-model"),
+        "MODELPATH": str(tmp_path / "llm_model.bin"),
+        "LLAMA_PROFILE": str(tmp_path / "no-profile.env"),
+        "LLAMA_METRICS_DIR": str(tmp_path / "metrics"),
+        "PYTHONUNBUFFERED": "1"
+    }
+
+
+@pytest.fixture
+def gateway(processes, gateway_env):
+    #one gateway worker talking to server.cpp on llama_port, returns its base URL
+    def start(llama_port, env=None, args=(), ping_status=200):
+        port = free_port()
+        argv = ["--llama-api", f"http://127.0.0.1:{llama_port}", *args]
+        code = f"import sys, uvicorn; sys.argv += {argv!r}; uvicorn.run('main:asgi_app', port={port}, log_level='warning')"
+        process = processes(f"gateway-{port}", [sys.executable, "-c", code], DOCKER, {**gateway_env, **(env or {})})
+        url = f"http://127.0.0.1:{port}"
+        wait_for(f"{url}/ping", process, status=ping_status)
+        return url
+    return start
+
+
+@pytest.fixture
+def launcher(tmp_path):
+    #stands in for server.sh: runs the mock server in the foreground on the port it is given
+    path = tmp_path / "server.sh"
+    path.write_text(f'#!/bin/sh\n#$1 is the model, $2 the port\nsleep "${{MOCK_LOAD_SECONDS:-0}}"\nexec "{sys.executable}" "{os.path.join(BENCHMARK, "mock_server.py")}" --port "$2" $MOCK_SERVER_ARGS\n')
+    path.chmod(0o755)
+    return str(path)
+
+
+@pytest.fixture
+def s3(processes):
+    #a moto S3 server, returns a client for it and the environment pointing boto3 at it
+    boto3 = pytest.importorskip("boto3")
+    pytest.importorskip("moto.server")
+    port = free_port()
+    process = processes(f"moto-{port}", [sys.executable, "-m", "moto.server", "-p", str(port)], ROOT)
+    wait_for(f"http://127.0.0.1:{port}/moto-api/", process)
+    env = {
+        "AWS_ENDPOINT_URL": f"http://127.0.0.1:{port}",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_DEFAULT_REGION": "us-east-1"
+    }
+    client = boto3.client("s3", endpoint_url=env["AWS_ENDPOINT_URL"], region_name="us-east-1", aws_access_key_id="testing", aws_secret_access_key="testing")
+    return client, env
@@ -0,0 +1,26 @@
+import json
+
+import httpx
+
+
+def test_prompt_list_is_answered_in_order(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "1"))
+    response = httpx.post(f"{url}/invocations", json={"prompt": ["one", "two two", "three three three"], "max_tokens": 2}, timeout=30)
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["usage"]["prompt_tokens"] for result in results] == [1, 2, 3]
+    assert all(result["choices"][0]["text"] == " tok0 tok1" for result in results)
+
+
+def test_jsonlines_batch_reports_bad_items_in_place(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "1"))
+    lines = "\n".join([json.dumps({"prompt": "a", "max_tokens": 1}), "not json", json.dumps({"max_tokens": 1}), json.dumps({"prompt": "b c", "max_tokens": 1})])
+    response = httpx.post(f"{url}/invocations", content=lines, headers={"content-type": "application/jsonlines"}, timeout=30)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/jsonlines")
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert len(results) == 4
+    assert results[0]["usage"]["prompt_tokens"] == 1
+    assert results[1]["error"]["code"] == 400
+    assert results[2]["error"]["code"] == 400
+    assert results[3]["usage"]["prompt_tokens"] == 2
@@ -0,0 +1,25 @@
+import json
+
+import httpx
+
+
+def test_chat_completion(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "1"))
+    body = {"messages": [{"role": "user", "content": "Hello"}], "max_tokens": 2}
+    for path in ("/invocations", "/v1/chat/completions"):
+        response = httpx.post(f"{url}{path}", json=body, timeout=30)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["object"] == "chat.completion"
+        assert data["choices"][0]["message"] == {"role": "assistant", "content": " tok0 tok1"}
+
+
+def test_streaming_chat_completion(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "1"))
+    body = {"messages": [{"role": "user", "content": "Hello"}], "max_tokens": 2, "stream": True}
+    with httpx.stream("POST", f"{url}/v1/chat/completions", json=body, timeout=30) as response:
+        lines = [line[6:] for line in response.iter_lines() if line.startswith("data: ")]
+    assert lines[-1] == "[DONE]"
+    events = [json.loads(line) for line in lines[:-1]]
+    assert events[0]["choices"][0]["delta"] == {"role": "assistant"}
+    assert "".join(event["choices"][0]["delta"].get("content", "") for event in events) == " tok0 tok1"
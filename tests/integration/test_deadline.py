@@ -0,0 +1,30 @@
+import json
+
+import httpx
+
+
+def test_completion_stops_at_its_deadline(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "50"))
+    response = httpx.post(f"{url}/invocations", json={"prompt": "Hello there", "max_tokens": 200, "timeout": 0.5}, timeout=30)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["choices"][0]["finish_reason"] == "length"
+    assert 0 < data["usage"]["completion_tokens"] < 200
+    assert data["usage"]["prompt_tokens"] == 2
+
+
+def test_stream_stops_at_its_deadline(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "50"))
+    with httpx.stream("POST", f"{url}/invocations", json={"prompt": "Hello", "max_tokens": 200, "timeout": 0.5, "stream": True}, timeout=30) as response:
+        events = [json.loads(line[6:]) for line in response.iter_lines() if line.startswith("data: ")]
+    assert 0 < len(events) < 200
+    assert events[-1]["choices"][0]["finish_reason"] == "length"
+
+
+def test_client_disconnect_frees_the_slot(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "50", "--slots", "1"))
+    with httpx.stream("POST", f"{url}/invocations", json={"prompt": "Hello", "max_tokens": 200, "stream": True}, timeout=30) as response:
+        next(response.iter_lines())
+    #the next request gets the only slot instead of waiting for 200 tokens
+    response = httpx.post(f"{url}/invocations", json={"prompt": "Hello", "max_tokens": 1}, timeout=5)
+    assert response.status_code == 200
@@ -0,0 +1,80 @@
+import base64
+import json
+
+import httpx
+
+
+def test_ping_without_model(mock_server, gateway):
+    url = gateway(mock_server())
+    assert httpx.get(f"{url}/ping").status_code == 200
+
+
+def test_completion(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "1"))
+    response = httpx.post(f"{url}/invocations", json={"prompt": "Hello there", "max_tokens": 4}, timeout=30)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["choices"][0]["text"] == " tok0 tok1 tok2 tok3"
+    assert data["choices"][0]["finish_reason"] == "length"
+    assert data["usage"] == {"prompt_tokens": 2, "completion_tokens": 4, "total_tokens": 6}
+
+
+def test_streaming_completion(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "1"))
+    with httpx.stream("POST", f"{url}/invocations", json={"prompt": "Hello", "max_tokens": 3, "stream": True}, timeout=30) as response:
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = [json.loads(line[6:]) for line in response.iter_lines() if line.startswith("data: ")]
+    assert "".join(event["choices"][0]["text"] for event in events) == " tok0 tok1 tok2"
+    assert events[-1]["choices"][0]["finish_reason"] == "length"
+    assert all(event["choices"][0]["finish_reason"] is None for event in events[:-1])
+
+
+def test_completion_does_not_log_the_response(mock_server, gateway, tmp_path):
+    url = gateway(mock_server("--token-ms", "1"))
+    httpx.post(f"{url}/invocations", json={"prompt": "a private prompt", "max_tokens": 2}, timeout=30)
+    logs = "".join(path.read_text() for path in tmp_path.glob("gateway-*.log"))
+    assert "tok0" not in logs
+
+
+def test_completion_with_prompt_tokens(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "1"))
+    response = httpx.post(f"{url}/invocations", json={"prompt": "one two three", "max_tokens": 2, "tokenize": True}, timeout=30)
+    data = response.json()
+    assert len(data["promptToken"]) == 3
+    assert data["choices"][0]["text"] == " tok0 tok1"
+
+
+def test_tokenize_only(mock_server, gateway):
+    url = gateway(mock_server("--token-ms", "1"))
+    response = httpx.post(f"{url}/invocations", json={"prompt": "one two three", "max_tokens": 0, "tokenize": True}, timeout=30)
+    data = response.json()
+    assert len(data["promptToken"]) == 3
+    assert data["usage"] == {"prompt_tokens": 3}
+    assert "choices" not in data
+
+
+def test_embeddings(mock_server, gateway):
+    url = gateway(mock_server("--embedding-dim", "8"))
+    response = httpx.post(f"{url}/v1/embeddings", json={"input": ["one", "two three"]}, timeout=30)
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["index"] for item in data["data"]] == [0, 1]
+    assert all(len(item["embedding"]) == 8 for item in data["data"])
+    encoded = httpx.post(f"{url}/invocations", json={"input": "one", "encoding_format": "base64"}, timeout=30).json()
+    assert len(base64.b64decode(encoded["data"][0]["embedding"])) == 8 * 4
+    assert httpx.post(f"{url}/v1/embeddings", json={"input": []}, timeout=30).status_code == 400
+
+
+def test_streaming_error_is_not_relayed_as_events(mock_server, gateway):
+    url = gateway(mock_server("--slots", "1", "--ctx-size", "8", "--token-ms", "1"))
+    response = httpx.post(f"{url}/invocations", json={"prompt": "a prompt longer than the context of the slot", "max_tokens": 3, "stream": True}, timeout=30)
+    assert response.status_code == 400
+    assert response.headers["content-type"] == "application/json"
+    assert response.json()["error"]["type"] == "exceed_context_size_error"
+    metrics = httpx.get(f"{url}/metrics", timeout=30).text
+    assert 'llama_upstream_errors_total{mode="stream",model="default",reason="http_400"' in metrics
+    assert 'llama_request_duration_seconds_count{mode="stream",model="default"' in metrics
+    #the only slot was released
+    with httpx.stream("POST", f"{url}/invocations", json={"prompt": "Hello", "max_tokens": 2, "stream": True}, timeout=30) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
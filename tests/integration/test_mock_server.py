@@ -0,0 +1,27 @@
+import time
+
+import httpx
+import pytest
+
+
+def assert_slot_free(url):
+    started = time.monotonic()
+    response = httpx.post(url, json={"prompt": "short", "n_predict": 1}, timeout=30)
+    assert response.status_code == 200
+    assert time.monotonic() - started < 5
+
+
+def test_disconnect_frees_the_slot(mock_server):
+    port = mock_server("--slots", "1", "--token-ms", "20")
+    url = f"http://127.0.0.1:{port}/completion"
+    with pytest.raises(httpx.ReadTimeout):
+        httpx.post(url, json={"prompt": "long", "n_predict": 1000}, timeout=httpx.Timeout(30, read=0.3))
+    assert_slot_free(url)
+
+
+def test_closed_stream_frees_the_slot(mock_server):
+    port = mock_server("--slots", "1", "--token-ms", "20")
+    url = f"http://127.0.0.1:{port}/completion"
+    with httpx.stream("POST", url, json={"prompt": "long", "n_predict": 1000, "stream": True}, timeout=30) as response:
+        next(response.iter_lines())
+    assert_slot_free(url)
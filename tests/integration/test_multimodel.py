@@ -0,0 +1,42 @@
+import sys
+import time
+
+import httpx
+
+from tests.integration.conftest import DOCKER, free_port, wait_for
+
+
+def test_models_are_shared_between_workers(mock_server, gateway, launcher, processes, tmp_path):
+    socket_path = str(tmp_path / "coordinator.sock")
+    coordinator = processes("coordinator", [sys.executable, "coordinator.py", "--socket", socket_path], DOCKER)
+    model_dir = tmp_path / "models" / "tiny"
+    model_dir.mkdir(parents=True)
+    (model_dir / "tiny.gguf").write_bytes(b"GGUF" + bytes(1024))
+    llama_port = mock_server("--token-ms", "1")
+    env = {"LLAMA_COORDINATOR_SOCKET": socket_path, "GATEWAY_WORKERS": "2", "LLAMA_SERVER_SCRIPT": launcher, "MOCK_SERVER_ARGS": "--token-ms 1"}
+    args = ("--model-base-port", str(free_port()))
+    first, second = gateway(llama_port, env=env, args=args), gateway(llama_port, env=env, args=args)
+    assert coordinator.poll() is None
+
+    response = httpx.post(f"{first}/models", json={"model_name": "tiny", "url": str(model_dir)}, timeout=60)
+    assert response.status_code == 200
+    #loaded through one worker, served, listed and unloaded through the other
+    response = httpx.post(f"{second}/models/tiny/invoke", json={"prompt": "Hello", "max_tokens": 2}, timeout=30)
+    assert response.status_code == 200
+    assert response.json()["choices"][0]["text"] == " tok0 tok1"
+    assert httpx.get(f"{second}/models", timeout=30).json() == {"models": [{"modelName": "tiny", "modelUrl": str(model_dir)}]}
+    assert httpx.post(f"{second}/models", json={"model_name": "tiny", "url": str(model_dir)}, timeout=30).status_code == 409
+    model_url = httpx.post(f"{second}/invocations", json={"stats": True}, timeout=30).json()["coordinator"]["models"]["tiny"]["backend"]
+    wait_for(f"{model_url}/health")
+    assert httpx.delete(f"{second}/models/tiny", timeout=30).status_code == 200
+    assert httpx.get(f"{first}/models/tiny", timeout=30).status_code == 404
+    assert httpx.post(f"{first}/models/tiny/invoke", json={"prompt": "Hello", "max_tokens": 2}, timeout=30).status_code == 404
+    #the worker that started the model's server stops it
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            httpx.get(f"{model_url}/health", timeout=2)
+        except httpx.HTTPError:
+            break
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
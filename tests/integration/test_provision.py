@@ -0,0 +1,34 @@
+import httpx
+
+from tests.integration.conftest import free_port, wait_for
+
+
+def test_ping_waits_for_the_startup_model(gateway, launcher, tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    (model_dir / "model.gguf").write_bytes(b"GGUF")
+    env = {"SM_MODEL_DIR": str(model_dir), "LLAMA_SERVER_SCRIPT": launcher, "MOCK_LOAD_SECONDS": "1", "MOCK_SERVER_ARGS": "--token-ms 1"}
+    url = gateway(free_port(), env=env, ping_status=503)
+    state = httpx.post(f"{url}/invocations", json={"stats": True}, timeout=30).json()["provision"]
+    assert state["state"] in ("starting", "waiting")
+    wait_for(f"{url}/ping")
+    assert httpx.post(f"{url}/invocations", json={"stats": True}, timeout=30).json()["provision"]["state"] == "done"
+    response = httpx.post(f"{url}/invocations", json={"prompt": "hi", "max_tokens": 2}, timeout=30)
+    assert response.json()["choices"][0]["text"] == " tok0 tok1"
+
+
+def test_fast_start_prewarms_and_warms_up_before_ping(gateway, launcher, tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    (model_dir / "model.gguf").write_bytes(b"GGUF" + bytes(3 * 1024 * 1024))
+    env = {"SM_MODEL_DIR": str(model_dir), "LLAMA_SERVER_SCRIPT": launcher, "LLAMA_FAST_START": "1", "MOCK_LOAD_SECONDS": "1", "MOCK_SERVER_ARGS": "--token-ms 1"}
+    url = gateway(free_port(), env=env, ping_status=503)
+    wait_for(f"{url}/ping")
+    state = httpx.post(f"{url}/invocations", json={"stats": True}, timeout=30).json()["provision"]
+    assert state["state"] == "done"
+    assert state["prewarm_bytes"] == 3 * 1024 * 1024 + 4
+    assert {"starting", "prewarm", "warmup"} <= set(state["phases"])
+    #the other workers learn from the ready file that the warmup is done
+    assert (tmp_path / "llama-ready").exists()
+    metrics = httpx.get(f"{url}/metrics", timeout=30).text
+    assert 'llama_startup_phase_seconds{phase="warmup"' in metrics
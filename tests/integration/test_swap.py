@@ -0,0 +1,67 @@
+import sys
+import time
+
+import httpx
+
+from tests.integration.conftest import DOCKER, free_port
+
+
+def test_swap_moves_traffic_without_failed_requests(mock_server, gateway, launcher, s3):
+    client, s3_env = s3
+    client.create_bucket(Bucket="models")
+    client.put_object(Bucket="models", Key="next.gguf", Body=b"GGUF" + bytes(1024))
+    llama_port = mock_server("--token-ms", "1")
+    swap_port = free_port()
+    while (swap_port <= llama_port):
+        swap_port = free_port()
+    env = {**s3_env, "LLAMA_SERVER_SCRIPT": launcher, "MOCK_SERVER_ARGS": "--slots 3 --token-ms 1"}
+    url = gateway(llama_port, env=env, args=("--swap-port", str(swap_port)))
+    assert httpx.post(f"{url}/invocations", json={"prompt": "hi", "max_tokens": 1}, timeout=30).headers["X-Slots-Total"] == "4"
+
+    response = httpx.post(f"{url}/invocations", json={"configure": {"bucket": "models", "key": "next.gguf", "swap": True}}, timeout=30)
+    assert response.status_code == 202
+    deadline = time.monotonic() + 60
+    while True:
+        #requests keep being served while the new server loads and the old one drains
+        response = httpx.post(f"{url}/invocations", json={"prompt": "hi", "max_tokens": 1}, timeout=30)
+        assert response.status_code == 200
+        state = httpx.post(f"{url}/invocations", json={"stats": True}, timeout=30).json()["swap"]
+        if (state["state"] in ("done", "failed")):
+            break
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+    assert state["state"] == "done"
+    response = httpx.post(f"{url}/invocations", json={"prompt": "hi", "max_tokens": 1}, timeout=30)
+    assert response.status_code == 200
+    assert response.headers["X-Slots-Total"] == "3"
+
+
+
+def test_swap_state_is_shared_between_workers(mock_server, gateway, launcher, processes, s3, tmp_path):
+    client, s3_env = s3
+    client.create_bucket(Bucket="models")
+    client.put_object(Bucket="models", Key="next.gguf", Body=b"GGUF" + bytes(1024))
+    socket_path = str(tmp_path / "coordinator.sock")
+    processes("coordinator", [sys.executable, "coordinator.py", "--socket", socket_path], DOCKER)
+    llama_port = mock_server("--token-ms", "1")
+    swap_port = free_port()
+    while (swap_port <= llama_port):
+        swap_port = free_port()
+    env = {**s3_env, "LLAMA_COORDINATOR_SOCKET": socket_path, "GATEWAY_WORKERS": "2", "LLAMA_SERVER_SCRIPT": launcher, "MOCK_LOAD_SECONDS": "2", "MOCK_SERVER_ARGS": "--slots 3 --token-ms 1"}
+    first, second = [gateway(llama_port, env=env, args=("--swap-port", str(swap_port))) for _ in range(2)]
+
+    configure = {"configure": {"bucket": "models", "key": "next.gguf", "swap": True}}
+    assert httpx.post(f"{first}/invocations", json=configure, timeout=30).status_code == 202
+    #the other worker reports the swap and refuses to start a second one
+    assert httpx.post(f"{second}/invocations", json={"stats": True}, timeout=30).json()["swap"]["state"] not in ("idle", "done", "failed")
+    assert httpx.post(f"{second}/invocations", json=configure, timeout=30).status_code == 409
+    deadline = time.monotonic() + 60
+    while True:
+        state = httpx.post(f"{second}/invocations", json={"stats": True}, timeout=30).json()["swap"]
+        if (state["state"] in ("done", "failed")):
+            break
+        assert time.monotonic() < deadline
+        time.sleep(0.1)
+    assert state["state"] == "done"
+    assert state["port"] == swap_port
+    assert httpx.post(f"{second}/invocations", json={"prompt": "hi", "max_tokens": 1}, timeout=30).headers["X-Slots-Total"] == "3"
@@ -0,0 +1,35 @@
+import json
+import subprocess
+import sys
+
+from tests.integration.conftest import DOCKER, free_port
+
+
+def tune(launcher, tmp_path, *extra):
+    output, report = tmp_path / "profile.env", tmp_path / "tune.json"
+    command = [sys.executable, "tune.py", "--launcher", launcher, "--model", str(tmp_path / "model.gguf"), "--port", str(free_port()),
+        "--parallel", "1,2", "--threads", "2,1", "--batch-size", "512", "--ubatch-size", "256", "--n-predict", "2", "--load-timeout", "30",
+        "--output", str(output), "--report", str(report), *extra]
+    result = subprocess.run(command, cwd=DOCKER, env={"MOCK_SERVER_ARGS": "--token-ms 1", "PATH": "/usr/bin:/bin"}, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stdout + result.stderr
+    entry = json.loads(result.stdout.splitlines()[result.stdout.splitlines().index("launch_profiles entry for config.yaml:") + 1])
+    return output.read_text(), entry, json.loads(report.read_text())
+
+
+def test_tuned_profile_leaves_the_context_to_server_sh(launcher, tmp_path):
+    profile, entry, report = tune(launcher, tmp_path)
+    assert "LLAMA_CTX_SIZE" not in profile
+    assert "LLAMA_SLOTS=" in profile
+    assert "ctx_size" not in entry
+    assert set(entry) == {"threads", "parallel", "batch_size", "ubatch_size"}
+    #one setting at a time, so two values each of parallel and threads are three trials
+    assert len(report["trials"]) == 3
+    assert all(trial["result"] is not None for trial in report["trials"])
+
+
+def test_pinned_context_is_written(launcher, tmp_path):
+    profile, entry, _ = tune(launcher, tmp_path, "--ctx-per-slot", "1024", "--mlock")
+    assert entry["ctx_size"] == 1024 * entry["parallel"]
+    assert f"LLAMA_CTX_SIZE={entry['ctx_size']}" in profile
+    assert "LLAMA_MLOCK=1" in profile
+    assert entry["mlock"] is True
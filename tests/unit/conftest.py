@@ -0,0 +1,27 @@
+import importlib
+import os
+import sys
+import tempfile
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def main():
+    #the gateway module with no startup model, no launch profile and no command line
+    directory = tempfile.mkdtemp()
+    env = {
+        "SM_MODEL_DIR": os.path.join(directory, "no-model"),
+        "MODELPATH": os.path.join(directory, "llm_model.bin"),
+        "LLAMA_PROFILE": os.path.join(directory, "no-profile.env"),
+        "LLAMA_METRICS_DIR": os.path.join(directory, "metrics")
+    }
+    saved_env, saved_argv = dict(os.environ), sys.argv
+    os.environ.update(env)
+    sys.argv = ["main.py"]
+    try:
+        yield importlib.import_module("main")
+    finally:
+        sys.argv = saved_argv
+        os.environ.clear()
+        os.environ.update(saved_env)
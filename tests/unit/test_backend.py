@@ -0,0 +1,87 @@
+import asyncio
+
+import httpx
+
+from backend import Backend, BackendPool
+
+
+def backend(port=1, slots=2):
+    return Backend("default", f"http://127.0.0.1:{port}", slots, 8, 0)
+
+
+def pool_of(n):
+    members = [backend(8081 + i) for i in range(n)]
+    for member in members:
+        member.health = True
+    return BackendPool(members)
+
+
+def test_least_outstanding_member_is_picked():
+    async def main():
+        pool = pool_of(3)
+        await pool.backends[0].scheduler.acquire()
+        await pool.backends[0].scheduler.acquire()
+        await pool.backends[1].scheduler.acquire()
+        assert pool.pick() is pool.backends[2]
+        await pool.backends[2].scheduler.acquire()
+        assert pool.pick() in (pool.backends[1], pool.backends[2])
+        assert pool.pick() is not pool.backends[0]
+    asyncio.run(main())
+
+
+def test_ties_go_round_robin():
+    pool = pool_of(3)
+    picked = [pool.backends.index(pool.pick()) for _ in range(6)]
+    assert sorted(picked) == [0, 0, 1, 1, 2, 2]
+    assert picked[:3] != [picked[0]] * 3
+    assert pool.stats()["instances"][0]["picked"] == 2
+
+
+def test_unhealthy_members_are_skipped_until_all_are():
+    pool = pool_of(2)
+    pool.backends[0].failed()
+    assert {pool.pick() for _ in range(4)} == {pool.backends[1]}
+    pool.backends[1].failed()
+    assert {pool.pick() for _ in range(4)} == set(pool.backends)
+
+
+def test_health_checks_are_cached():
+    async def main():
+        calls = []
+
+        def handler(request):
+            calls.append(request.url.path)
+            return httpx.Response(200)
+
+        member = backend()
+        member.client = httpx.AsyncClient(base_url=member.url, transport=httpx.MockTransport(handler))
+        assert await member.healthy(60)
+        assert await member.healthy(60)
+        assert calls == ["/health"]
+        #a failed request counts as a failed health check until the next one
+        member.failed()
+        assert not await member.healthy(60)
+        assert await member.healthy(0)
+        await member.aclose()
+    asyncio.run(main())
+
+
+def test_speeds_are_smoothed_and_ignore_tiny_samples():
+    member = backend()
+    member.record_timings({"timings": {"prompt_per_second": 100.0, "prompt_n": 20, "predicted_per_second": 10.0, "predicted_n": 5}})
+    member.record_timings({"timings": {"prompt_per_second": 200.0, "prompt_n": 20, "predicted_per_second": 20.0, "predicted_n": 5}})
+    member.record_timings({"timings": {"prompt_per_second": 5000.0, "prompt_n": 2, "predicted_per_second": 900.0, "predicted_n": 1}})
+    assert member.prompt_speed == 120.0
+    assert member.generation_speed == 12.0
+
+
+def test_tokens_within():
+    member = backend()
+    assert member.tokens_within(10, "prompt") is None
+    member.generation_speed = 20.0
+    assert member.tokens_within(10, "prompt", margin=1) == 200
+    member.prompt_speed = 100.0
+    #400 bytes are about 100 prompt tokens, one second of prefill
+    assert member.tokens_within(10, "x" * 400, margin=1) == 180
+    assert member.tokens_within(10, list(range(500)), margin=1) == 100
+    assert member.tokens_within(1, "x" * 4000) == 1
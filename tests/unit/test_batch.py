@@ -0,0 +1,35 @@
+import pytest
+
+
+class FakeRequest:
+    def __init__(self, content_type=""):
+        self.headers = {"content-type": content_type}
+
+
+def test_jsonlines_keep_bad_lines_in_place(main):
+    items = main.parse_jsonlines('{"prompt": "a"}\n\nnot json\n{"prompt": "b"}\n')
+    assert items[0] == {"prompt": "a"}
+    assert isinstance(items[1], ValueError)
+    assert items[2] == {"prompt": "b"}
+
+
+def test_body_by_content_type(main):
+    assert main.parse_body(FakeRequest("application/json"), '{"prompt": "a"}') == ({"prompt": "a"}, False)
+    assert main.parse_body(FakeRequest("application/json"), '[{"prompt": "a"}]') == ([{"prompt": "a"}], False)
+    assert main.parse_body(FakeRequest("application/jsonlines"), '{"prompt": "a"}') == ([{"prompt": "a"}], True)
+
+
+def test_unlabelled_jsonlines_are_detected(main):
+    items, jsonlines = main.parse_body(FakeRequest("application/json"), '{"prompt": "a"}\n{"prompt": "b"}')
+    assert jsonlines
+    assert items == [{"prompt": "a"}, {"prompt": "b"}]
+
+
+def test_invalid_single_document_is_an_error(main):
+    with pytest.raises(ValueError):
+        main.parse_body(FakeRequest("application/json"), "{not json")
+
+
+def test_request_deadline(main):
+    assert main.request_deadline({"timeout": 5}, 100) == 105
+    assert main.request_deadline({"timeout": 0}, 100) is None
@@ -0,0 +1,86 @@
+from cache import LRUCache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = LRUCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_size_bound():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", "x", size=4)
+    cache.put("b", "y", size=4)
+    cache.put("c", "z", size=4)
+    assert len(cache) == 2
+    assert cache.bytes == 8
+    #an entry larger than the whole cache is not stored
+    cache.put("d", "w", size=11)
+    assert cache.get("d") is None
+    assert cache.bytes == 8
+
+
+def test_replacing_an_entry_updates_the_size():
+    cache = LRUCache(max_bytes=10)
+    cache.put("a", "x", size=6)
+    cache.put("a", "y", size=3)
+    assert cache.bytes == 3
+    cache.drop("a")
+    assert cache.bytes == 0
+
+
+def test_expired_entries_are_misses(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("cache.time.monotonic", lambda: now[0])
+    cache = LRUCache(ttl=10)
+    cache.put("a", 1)
+    now[0] += 5
+    assert cache.get("a") == 1
+    now[0] += 6
+    assert cache.get("a") is None
+    assert len(cache) == 0
+    stats = cache.stats()
+    assert stats["expirations"] == 1
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_rate"] == 0.5
+
+
+def test_clear():
+    cache = LRUCache()
+    cache.put("a", 1, size=5)
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.bytes == 0
+
+
+class FakeBackend:
+    name = "default"
+
+
+def test_only_deterministic_requests_get_a_key(main, monkeypatch):
+    monkeypatch.setattr(main.response_cache, "max_bytes", 1024)
+    backend = FakeBackend()
+    assert main.response_cache_key(backend, {}, {"prompt": "hi", "temperature": 0.8}) is None
+    assert main.response_cache_key(backend, {}, {"prompt": "hi", "temperature": 0}) is not None
+    assert main.response_cache_key(backend, {}, {"prompt": "hi", "seed": 7}) is not None
+    assert main.response_cache_key(backend, {"cache": False}, {"prompt": "hi", "temperature": 0}) is None
+
+
+def test_key_ignores_fields_that_do_not_change_the_text(main, monkeypatch):
+    monkeypatch.setattr(main.response_cache, "max_bytes", 1024)
+    backend = FakeBackend()
+    key = main.response_cache_key(backend, {}, {"prompt": "hi", "temperature": 0, "n_predict": 8})
+    assert key == main.response_cache_key(backend, {}, {"n_predict": 8, "temperature": 0, "prompt": "hi", "stream": True, "id_slot": 3})
+    assert key != main.response_cache_key(backend, {}, {"prompt": "hi", "temperature": 0, "n_predict": 9})
+
+
+def test_disabled_cache_gives_no_key(main, monkeypatch):
+    monkeypatch.setattr(main.response_cache, "max_bytes", 0)
+    assert main.response_cache_key(FakeBackend(), {}, {"prompt": "hi", "temperature": 0}) is None
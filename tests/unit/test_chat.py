@@ -0,0 +1,59 @@
+FORMAT = {
+    "name": "test",
+    "preamble": "<s>",
+    "system": ("[SYS]", "\n"),
+    "user": ("[USER]", "\n"),
+    "assistant": ("[BOT]", "</s>"),
+    "generation": "[BOT]",
+    "stop": ["</s>"]
+}
+
+
+def test_messages_are_rendered_in_the_prompt_format(main):
+    messages = [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello"},
+        {"role": "tool", "content": "ignored"},
+        {"role": "user", "content": "Bye"}
+    ]
+    assert main.convert_chat(messages, FORMAT) == "<s>[SYS]Be brief.\n[USER]Hi\n[BOT]Hello</s>[USER]Bye\n[BOT]"
+
+
+def test_rendered_prefix_is_reused(main):
+    messages = [{"role": "user", "content": "first question"}]
+    main.convert_chat(messages, FORMAT)
+    hits = main.chat_prefixes.hits
+    prompt = main.convert_chat(messages + [{"role": "assistant", "content": "answer"}, {"role": "user", "content": "second"}], FORMAT)
+    assert main.chat_prefixes.hits == hits + 1
+    assert prompt == "<s>[USER]first question\n[BOT]answer</s>[USER]second\n[BOT]"
+
+
+def test_prefix_depends_on_the_format(main):
+    messages = [{"role": "user", "content": "same"}]
+    other = {**FORMAT, "name": "other", "user": ("U: ", "\n")}
+    assert main.convert_chat(messages, FORMAT) != main.convert_chat(messages, other)
+
+
+def test_chat_request_adds_the_format_stop_words(main):
+    postData = main.make_postData({"messages": [{"role": "user", "content": "Hi"}], "stop": ["\n\n"], "max_tokens": 5}, chat=True, fmt=FORMAT)
+    assert postData["prompt"] == "<s>[USER]Hi\n[BOT]"
+    assert postData["stop"] == ["</s>", "\n\n"]
+    assert postData["n_predict"] == 5
+    assert FORMAT["stop"] == ["</s>"]
+
+
+def test_chat_response(main):
+    data = {"content": "Hello", "truncated": False, "stopped_eos": True, "stopped_word": False, "tokens_evaluated": 3, "tokens_predicted": 1}
+    result = main.make_resData(data, chat=True)
+    assert result["object"] == "chat.completion"
+    assert result["choices"][0]["message"] == {"role": "assistant", "content": "Hello"}
+    assert result["choices"][0]["finish_reason"] == "stop"
+    assert result["usage"]["total_tokens"] == 4
+
+
+def test_chat_stream_starts_with_the_role(main):
+    first = main.make_resData_stream({}, chat=True, start=True)
+    assert first["choices"][0]["delta"] == {"role": "assistant"}
+    last = main.make_resData_stream({"content": "", "stop": True, "stopped_eos": False, "stopped_word": False}, chat=True)
+    assert last["choices"][0]["finish_reason"] == "length"
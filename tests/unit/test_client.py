@@ -0,0 +1,156 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from llamacpp_client import AsyncClient, Backoff, Client, EndpointError, SSEParser, parse_events
+
+
+def feed_all(pieces):
+    parser = SSEParser()
+    events = []
+    for piece in pieces:
+        events += parser.feed(piece)
+    return events + parser.flush()
+
+
+STREAM = 'data: {"text": "héllo"}\n\n: keep-alive\n\ndata: {"text": "wörld"}\n\ndata: [DONE]\n\n'.encode("utf-8")
+
+
+def test_events_split_anywhere():
+    expected = ['{"text": "héllo"}', '{"text": "wörld"}', "[DONE]"]
+    assert feed_all([STREAM]) == expected
+    #every split point, including inside the two-byte characters
+    for i in range(1, len(STREAM)):
+        assert feed_all([STREAM[:i], STREAM[i:]]) == expected
+    assert feed_all([STREAM[i:i + 1] for i in range(len(STREAM))]) == expected
+
+
+def test_crlf_line_endings():
+    stream = STREAM.replace(b"\n", b"\r\n")
+    expected = ['{"text": "héllo"}', '{"text": "wörld"}', "[DONE]"]
+    for i in range(1, len(stream)):
+        assert feed_all([stream[:i], stream[i:]]) == expected
+    assert feed_all([STREAM.replace(b"\n", b"\r")]) == expected
+
+
+def test_multiline_data_and_missing_final_blank_line():
+    assert feed_all([b"data: one\ndata:two\n\nevent: x\ndata: three"]) == ["one\ntwo", "three"]
+
+
+def test_done_is_not_a_chunk():
+    assert parse_events(['{"a": 1}', "[DONE]"]) == [{"a": 1}]
+
+
+def http_client(handler, client_class=Client, max_retries=3):
+    client = client_class(url="http://endpoint", backoff=Backoff(max_retries=max_retries, base_delay=0))
+    transport = httpx.MockTransport(handler)
+    client.transport.client = httpx.Client(transport=transport) if (client_class is Client) else httpx.AsyncClient(transport=transport)
+    return client
+
+
+def flaky(statuses, calls):
+    #answers the statuses in turn, then echoes the request
+    def handler(request):
+        calls.append(request)
+        if (len(calls) <= len(statuses)):
+            return httpx.Response(statuses[len(calls) - 1], text="busy")
+        return httpx.Response(200, json={"echo": json.loads(request.content)})
+    return handler
+
+
+def test_throttled_requests_are_retried():
+    calls = []
+    client = http_client(flaky([429, 503], calls))
+    assert client.invoke({"prompt": "hi"}, target_model="a.tar.gz") == {"echo": {"prompt": "hi"}}
+    assert len(calls) == 3
+    assert client.retries == 2
+    assert calls[0].headers["X-Amzn-SageMaker-Target-Model"] == "a.tar.gz"
+
+
+def test_retries_are_limited():
+    calls = []
+    client = http_client(flaky([503] * 10, calls), max_retries=2)
+    with pytest.raises(EndpointError) as error:
+        client.invoke({"prompt": "hi"})
+    assert error.value.status_code == 503
+    assert error.value.retryable
+    assert len(calls) == 3
+
+
+def test_client_errors_are_not_retried():
+    calls = []
+    client = http_client(flaky([400], calls))
+    with pytest.raises(EndpointError) as error:
+        client.invoke({"prompt": "hi"})
+    assert error.value.status_code == 400 and not error.value.retryable
+    assert len(calls) == 1
+
+
+def test_backoff_has_full_jitter():
+    backoff = Backoff(base_delay=1, max_delay=5)
+    assert all(0 <= backoff.delay(0) <= 1 for _ in range(100))
+    assert all(0 <= backoff.delay(10) <= 5 for _ in range(100))
+
+
+def test_stream_is_parsed_across_chunks():
+    calls = []
+
+    def handler(request):
+        calls.append(json.loads(request.content))
+        return httpx.Response(200, content=iter([STREAM[:7], STREAM[7:20], STREAM[20:]]))
+
+    client = http_client(handler)
+    assert list(client.stream({"prompt": "hi"})) == [{"text": "héllo"}, {"text": "wörld"}]
+    assert calls == [{"prompt": "hi", "stream": True}]
+
+
+def echo_or_fail(request):
+    payload = json.loads(request.content)
+    if (payload["i"] == 2):
+        return httpx.Response(400, text="bad")
+    return httpx.Response(200, json={"i": payload["i"]})
+
+
+def test_invoke_many_keeps_the_order():
+    results = http_client(echo_or_fail).invoke_many([{"i": i} for i in range(6)], concurrency=3)
+    assert [result["i"] for result in results if (not isinstance(result, EndpointError))] == [0, 1, 3, 4, 5]
+    assert isinstance(results[2], EndpointError)
+    with pytest.raises(EndpointError):
+        http_client(echo_or_fail).invoke_many([{"i": i} for i in range(4)], return_exceptions=False)
+
+
+def test_async_invoke_many_matches_the_sync_client():
+    async def scenario():
+        client = http_client(echo_or_fail, AsyncClient)
+        results = await client.invoke_many([{"i": i} for i in range(6)], concurrency=3)
+        assert [result["i"] for result in results if (not isinstance(result, EndpointError))] == [0, 1, 3, 4, 5]
+        assert isinstance(results[2], EndpointError)
+        with pytest.raises(EndpointError):
+            await client.invoke_many([{"i": i} for i in range(4)], return_exceptions=False)
+
+        #anything but an EndpointError is a bug and raised, not returned
+        def broken(request):
+            return httpx.Response(200, content=b"not json")
+
+        with pytest.raises(ValueError):
+            await http_client(broken, AsyncClient).invoke_many([{"i": 0}])
+        await client.aclose()
+    asyncio.run(scenario())
+
+
+def test_async_retries_and_stream():
+    async def scenario():
+        calls = []
+        client = http_client(flaky([429], calls), AsyncClient)
+        assert await client.invoke({"prompt": "hi"}) == {"echo": {"prompt": "hi"}}
+        assert client.retries == 1
+
+        async def chunks():
+            for i in range(0, len(STREAM), 5):
+                yield STREAM[i:i + 5]
+
+        stream_client = http_client(lambda request: httpx.Response(200, content=chunks()), AsyncClient)
+        assert [event async for event in stream_client.stream({"prompt": "hi"})] == [{"text": "héllo"}, {"text": "wörld"}]
+    asyncio.run(scenario())
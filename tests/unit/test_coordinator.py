@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+
+from backend import Backend
+from cache import LRUCache
+from coordinator import Coordinator, CoordinatorClient, SharedScheduler
+from models import ModelError, ModelManager
+
+
+def run(tmp_path, scenario, workers=2):
+    #a coordinator on a socket in tmp_path and one client per worker, each collecting the events it gets
+    async def main():
+        path = str(tmp_path / "coordinator.sock")
+        coordinator = Coordinator(LRUCache())
+        server = asyncio.create_task(coordinator.serve(path))
+        clients = []
+        for _ in range(workers):
+            events = []
+            client = CoordinatorClient(path, on_event=events.append)
+            client.events = events
+            await client.connect(timeout=5)
+            clients.append(client)
+        try:
+            return await scenario(coordinator, *clients)
+        finally:
+            server.cancel()
+    return asyncio.run(main())
+
+
+def record(name, size, port):
+    return {"name": name, "url": f"/opt/ml/models/{name}", "path": f"/opt/ml/models/{name}/model.gguf", "size": size, "backend": f"http://127.0.0.1:{port}"}
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0.01)
+
+
+def test_loaded_models_are_seen_by_every_worker(tmp_path):
+    async def scenario(coordinator, first, second):
+        assert (await first.call("model_reserve", name="a", size=10, budget=100))["victims"] == []
+        #a model that is still loading is neither listed nor loadable twice
+        assert (await second.call("models"))["models"] == []
+        assert (await second.call("model_reserve", name="a", size=10, budget=100))["error"] == "exists"
+        first.announce("model:a", {"op": "model_loaded", "model": record("a", 10, 9001)})
+        assert (await second.call("models"))["models"] == [record("a", 10, 9001)]
+        await settle()
+        assert second.events == [{"type": "model_loaded", "model": record("a", 10, 9001)}]
+        assert first.events == []
+    run(tmp_path, scenario)
+
+
+def test_least_recently_used_idle_models_make_room(tmp_path):
+    async def scenario(coordinator, first, second):
+        for name, port in (("a", 9001), ("b", 9002)):
+            await first.call("model_reserve", name=name, size=40, budget=100)
+            first.announce(f"model:{name}", {"op": "model_loaded", "model": record(name, 40, port)})
+        #a request on a makes b the least recently used model
+        await SharedScheduler(first, "http://127.0.0.1:9001", 1, 1, 0).acquire()
+        reply = await second.call("model_reserve", name="c", size=40, budget=100)
+        assert [victim["name"] for victim in reply["victims"]] == ["b"]
+        assert reply["victims"][0]["orphaned"] is False
+        await settle()
+        assert first.events[-1]["type"] == "model_unloaded"
+        assert first.events[-1]["model"]["name"] == "b"
+        #a holds its slot and is not idle
+        assert (await second.call("model_reserve", name="d", size=40, budget=100))["error"] == "no_memory"
+    run(tmp_path, scenario)
+
+
+def test_models_of_a_worker_that_exited_are_unloaded_by_another(tmp_path):
+    async def scenario(coordinator, first, second):
+        await first.call("model_reserve", name="a", size=10, budget=100)
+        first.announce("model:a", {"op": "model_loaded", "model": record("a", 10, 9001)})
+        await first.call("model_reserve", name="b", size=10, budget=100)
+        first.writer.close()
+        await settle()
+        #the loaded model keeps serving, the one still loading is gone
+        assert [model["name"] for model in (await second.call("models"))["models"]] == ["a"]
+        assert list(coordinator.models) == ["a"]
+        reply = await second.call("model_unload", name="a")
+        assert reply["model"]["orphaned"] is True
+        assert (await second.call("model_unload", name="a"))["error"] == "not_loaded"
+    run(tmp_path, scenario)
+
+
+def test_models_loaded_by_another_worker_are_served_and_unloaded(tmp_path):
+    class FakeBackend:
+        def __init__(self, name, url):
+            self.name, self.url = name, url
+            self.closed = False
+
+        async def refresh_slots(self, timeout=0):
+            pass
+
+        async def aclose(self):
+            self.closed = True
+
+    async def scenario(coordinator, first, second):
+        models = ModelManager(100, 9001, 0, FakeBackend, lock_dir=str(tmp_path), shared=second)
+        await first.call("model_reserve", name="a", size=10, budget=100)
+        first.announce("model:a", {"op": "model_loaded", "model": record("a", 10, 9001)})
+        await models.sync()
+        backend = models.get("a").backend
+        assert backend.url == "http://127.0.0.1:9001"
+        assert models.get("a").process is None
+        await models.unload("a")
+        assert models.get("a") is None
+        assert backend.closed
+        await settle()
+        assert first.events[-1]["type"] == "model_unloaded"
+        with pytest.raises(ModelError) as error:
+            await models.unload("a")
+        assert error.value.status_code == 404
+    run(tmp_path, scenario)
+
+
+def test_an_unavailable_coordinator_is_a_connection_error(tmp_path):
+    async def scenario():
+        client = CoordinatorClient(str(tmp_path / "missing.sock"))
+        with pytest.raises(ConnectionError):
+            await client.call("models")
+    asyncio.run(scenario())
+
+
+def test_requests_get_503_while_the_coordinator_is_unavailable(main):
+    class DownScheduler:
+        busy = queue_depth = n_slots = 0
+
+        async def acquire(self, prefix=None, timeout=None):
+            raise ConnectionError("coordinator unavailable")
+
+    async def scenario():
+        backend = Backend("default", "http://127.0.0.1:1", 1, 1, 0)
+        backend.scheduler = DownScheduler()
+        slot, response = await main.acquire_slot(backend, None, main.metrics.request("non_stream", "default"))
+        assert slot is None
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+        limit = asyncio.Semaphore(1)
+        assert (await main.complete_item(backend, {"prompt": "hi"}, limit))["error"]["code"] == 503
+    asyncio.run(scenario())
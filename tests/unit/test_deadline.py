@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import pytest
+from starlette.requests import ClientDisconnect
+
+from backend import Backend
+from scheduler import SlotScheduler
+
+
+def test_race_returns_the_result(main):
+    async def scenario():
+        async def answer():
+            return 42
+        assert await main.race(answer()) == 42
+        assert await main.race(answer(), asyncio.get_running_loop().create_future(), time.monotonic() + 10) == 42
+    asyncio.run(scenario())
+
+
+def test_race_cancels_the_work_when_the_client_disconnects(main):
+    async def scenario():
+        cancelled = []
+
+        async def work():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        disconnected = asyncio.get_running_loop().create_future()
+        asyncio.get_running_loop().call_later(0.01, disconnected.set_result, None)
+        with pytest.raises(ClientDisconnect):
+            await main.race(work(), disconnected)
+        assert cancelled == [True]
+    asyncio.run(scenario())
+
+
+def test_race_times_out_at_the_deadline(main):
+    async def scenario():
+        started = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await main.race(asyncio.sleep(10), deadline=started + 0.05)
+        assert time.monotonic() - started < 1
+    asyncio.run(scenario())
+
+
+def test_disconnected_waiter_leaves_the_queue(main):
+    async def scenario():
+        backend = Backend("default", "http://127.0.0.1:1", 1, 4, 0)
+        backend.scheduler = SlotScheduler(1, 4, 0)
+        await backend.scheduler.acquire()
+        disconnected = asyncio.get_running_loop().create_future()
+        asyncio.get_running_loop().call_later(0.01, disconnected.set_result, None)
+        slot, response = await main.acquire_slot(backend, None, main.metrics.request("non_stream", "default"), disconnected=disconnected)
+        assert slot is None
+        assert response.status_code == 499
+        assert backend.scheduler.queue_depth == 0
+    asyncio.run(scenario())
+
+
+def test_deadline_result_looks_like_a_length_stop(main):
+    result = main.deadline_result(" partial", 3)
+    assert result["content"] == " partial"
+    assert result["stopped_limit"] and result["stopped_deadline"]
+    #the prompt tokens are counted afterwards, server.cpp never sent them
+    assert result["tokens_evaluated"] is None
+    assert main.make_resData({**result, "tokens_evaluated": 2})["choices"][0]["finish_reason"] == "length"
+
+
+def test_n_predict_is_capped_to_the_time_left(main):
+    backend = Backend("default", "http://127.0.0.1:1", 1, 4, 0)
+    postData = {"prompt": "hi", "n_predict": 1000}
+    #no speed measured yet
+    assert not main.fit_budget(backend, postData, time.monotonic() + 1)
+    backend.generation_speed = 100.0
+    assert not main.fit_budget(backend, postData, None)
+    assert main.fit_budget(backend, postData, time.monotonic() + 1)
+    assert 80 <= postData["n_predict"] <= 90
+    #a smaller limit is kept, an unlimited one is capped
+    small = {"prompt": "hi", "n_predict": 5}
+    assert not main.fit_budget(backend, small, time.monotonic() + 1) and small["n_predict"] == 5
+    unlimited = {"prompt": "hi"}
+    assert main.fit_budget(backend, unlimited, time.monotonic() + 1) and unlimited["n_predict"] > 0
+
+
+def test_request_deadline(main):
+    assert main.request_deadline({"timeout": 2}, 100.0) == 102.0
+    assert main.request_deadline({"timeout": 0}, 100.0) is None
+    if (main.args.request_timeout > 0):
+        assert main.request_deadline({}, 100.0) == 100.0 + main.args.request_timeout
+    else:
+        assert main.request_deadline({}, 100.0) is None
@@ -0,0 +1,87 @@
+import asyncio
+import base64
+import json
+
+import httpx
+import pytest
+
+from backend import Backend
+from cache import LRUCache
+from embeddings import EmbeddingBatcher, EmbeddingError, encode, pack, unpack
+
+
+def embedding_backend(requests, slots=1, status_code=200, drop=0):
+    #server.cpp /v1/embeddings answering [len(text), index] for every text
+    def handler(request):
+        texts = json.loads(request.content)["input"]
+        requests.append(texts)
+        if (status_code != 200):
+            return httpx.Response(status_code, text="failed")
+        data = [{"index": i, "embedding": [float(len(text)), float(i)]} for i, text in enumerate(texts)][drop:]
+        return httpx.Response(200, json={"data": list(reversed(data)), "usage": {"prompt_tokens": sum(len(text) for text in texts)}})
+
+    backend = Backend("default", "http://127.0.0.1:1", slots, 8, 0)
+    backend.client = httpx.AsyncClient(base_url=backend.url, transport=httpx.MockTransport(handler))
+    return backend
+
+
+def test_vectors_are_packed_as_little_endian_float32():
+    packed = pack([1.0, -2.5])
+    assert len(packed) == 8
+    assert unpack(packed) == [1.0, -2.5]
+    assert encode(packed, "float") == [1.0, -2.5]
+    assert base64.b64decode(encode(packed, "base64")) == b"\x00\x00\x80\x3f\x00\x00\x20\xc0"
+
+
+def test_concurrent_requests_share_a_batch():
+    async def scenario():
+        requests = []
+        backend = embedding_backend(requests)
+        batcher = EmbeddingBatcher(LRUCache(max_bytes=1 << 20), window_ms=20)
+        first, second = await asyncio.gather(batcher.embed(backend, ["a", "bb"]), batcher.embed(backend, ["ccc"]))
+        assert requests == [["a", "bb", "ccc"]]
+        #results follow the order of the texts, not the order server.cpp answered in
+        assert [unpack(packed) for packed, _ in first] == [[1.0, 0.0], [2.0, 1.0]]
+        assert [tokens for _, tokens in first] == [1, 2]
+        assert unpack(second[0][0]) == [3.0, 2.0]
+        assert backend.scheduler.busy == 0
+        assert batcher.stats()["mean_batch_size"] == 3.0
+    asyncio.run(scenario())
+
+
+def test_repeated_texts_are_embedded_once():
+    async def scenario():
+        requests = []
+        backend = embedding_backend(requests)
+        batcher = EmbeddingBatcher(LRUCache(max_bytes=1 << 20), window_ms=1)
+        await asyncio.gather(batcher.embed(backend, ["same"]), batcher.embed(backend, ["same"]))
+        assert requests == [["same"]]
+        #then it comes from the cache
+        await batcher.embed(backend, ["same"])
+        assert requests == [["same"]]
+        assert batcher.stats()["cache"]["hits"] == 1
+    asyncio.run(scenario())
+
+
+def test_batches_are_limited_in_size():
+    async def scenario():
+        requests = []
+        backend = embedding_backend(requests, slots=2)
+        batcher = EmbeddingBatcher(LRUCache(), window_ms=50, max_batch=2)
+        results = await batcher.embed(backend, ["a", "b", "c", "d", "e"])
+        assert len(results) == 5
+        assert sorted(len(texts) for texts in requests) == [1, 2, 2]
+    asyncio.run(scenario())
+
+
+def test_errors_reach_every_waiting_request():
+    async def scenario():
+        batcher = EmbeddingBatcher(LRUCache(), window_ms=1)
+        with pytest.raises(EmbeddingError) as error:
+            await batcher.embed(embedding_backend([], status_code=500), ["a"])
+        assert error.value.status_code == 500
+        with pytest.raises(EmbeddingError) as error:
+            await batcher.embed(embedding_backend([], drop=1), ["a", "b"])
+        assert error.value.status_code == 502
+        assert batcher.waiting == {}
+    asyncio.run(scenario())
@@ -0,0 +1,135 @@
+import os
+import struct
+import subprocess
+import sys
+
+import pytest
+
+from gguf import GGUFError, chat_format, detect_chat_format, kv_budget, pick_ctx_size, read_metadata
+from tests.conftest import ROOT
+
+
+def gguf_value(value):
+    #(type, encoded value) of the GGUF key/value section
+    if (isinstance(value, bool)):
+        return 7, struct.pack("<?", value)
+    if (isinstance(value, int)):
+        return 4, struct.pack("<I", value)
+    if (isinstance(value, float)):
+        return 6, struct.pack("<f", value)
+    if (isinstance(value, str)):
+        encoded = value.encode("utf-8")
+        return 8, struct.pack("<Q", len(encoded)) + encoded
+    item_type = gguf_value(value[0])[0]
+    return 9, struct.pack("<IQ", item_type, len(value)) + b"".join(gguf_value(item)[1] for item in value)
+
+
+def write_gguf(path, metadata, version=3, tail=b"\0" * 64):
+    data = b"GGUF" + struct.pack("<IQQ", version, 0, len(metadata))
+    for key, value in metadata.items():
+        type, encoded = gguf_value(value)
+        encoded_key = key.encode("utf-8")
+        data += struct.pack("<Q", len(encoded_key)) + encoded_key + struct.pack("<I", type) + encoded
+    path.write_bytes(data + tail)
+    return str(path)
+
+
+LLAMA = {
+    "general.architecture": "llama",
+    "general.name": "tiny",
+    "general.file_type": 15,
+    "llama.context_length": 4096,
+    "llama.block_count": 2,
+    "llama.embedding_length": 64,
+    "llama.attention.head_count": 8,
+    "llama.attention.head_count_kv": 2,
+    "tokenizer.chat_template": "{% for m in messages %}<|start_header_id|>{{ m.role }}<|end_header_id|>{% endfor %}",
+    "tokenizer.ggml.eos_token_id": 2,
+    "tokenizer.ggml.bos_token_id": 1
+}
+
+
+def test_metadata_is_read(tmp_path):
+    info = read_metadata(write_gguf(tmp_path / "model.gguf", {**LLAMA, "tokenizer.ggml.tokens": ["<unk>", "<s>", "</s>"]}))
+    assert info.version == 3
+    assert info.architecture == "llama"
+    assert info.name == "tiny"
+    assert info.quantization == "Q4_K_M"
+    assert info.context_length == 4096
+    assert (info.bos_token, info.eos_token) == ("<s>", "</s>")
+    #2 layers of 2 KV heads, keys and values of 64 / 8 in f16
+    assert info.kv_bytes_per_token() == 2 * 2 * (8 + 8) * 2
+
+
+def test_special_tokens_of_a_large_vocabulary(tmp_path):
+    tokens = [f"t{i}" for i in range(3000)]
+    info = read_metadata(write_gguf(tmp_path / "model.gguf", {**LLAMA, "tokenizer.ggml.tokens": tokens, "tokenizer.ggml.eos_token_id": 2999}))
+    assert info.eos_token == "t2999"
+    assert info.bos_token == "t1"
+    #the vocabulary itself is not kept
+    assert "tokenizer.ggml.tokens" not in info.metadata
+
+
+def test_invalid_files(tmp_path):
+    (tmp_path / "empty.gguf").write_bytes(b"")
+    (tmp_path / "other.bin").write_bytes(b"PK\x03\x04" + bytes(64))
+    truncated = tmp_path / "truncated.gguf"
+    truncated.write_bytes(open(write_gguf(tmp_path / "full.gguf", LLAMA, tail=b""), "rb").read()[:60])
+    for name in ("empty.gguf", "other.bin", "truncated.gguf"):
+        with pytest.raises(GGUFError):
+            read_metadata(str(tmp_path / name))
+    with pytest.raises(GGUFError):
+        read_metadata(write_gguf(tmp_path / "v1.gguf", LLAMA, version=1))
+
+
+def test_context_fits_the_memory(tmp_path):
+    info = read_metadata(write_gguf(tmp_path / "model.gguf", LLAMA))
+    per_token = info.kv_bytes_per_token()
+    #the trained context for every slot when the memory allows it
+    assert pick_ctx_size(info, 2) == 8192
+    assert pick_ctx_size(info, 2, kv_memory_bytes=per_token * 3000) == 2560
+    #never less than min_per_slot for every slot
+    assert pick_ctx_size(info, 4, kv_memory_bytes=per_token) == 2048
+    assert pick_ctx_size(None, 2) == 2048
+    assert pick_ctx_size(read_metadata(write_gguf(tmp_path / "bare.gguf", {"general.architecture": "llama"})), 1) == 2048
+
+
+def test_kv_cache_stays_within_the_memory_budget(tmp_path):
+    #Llama 3.1 8B: 128k trained context, 32 layers of 8 KV heads of 128
+    llama31 = {**LLAMA, "llama.context_length": 131072, "llama.block_count": 32, "llama.embedding_length": 4096, "llama.attention.head_count": 32, "llama.attention.head_count_kv": 8}
+    info = read_metadata(write_gguf(tmp_path / "model.gguf", llama31, tail=bytes(1 << 20)))
+    per_token = info.kv_bytes_per_token()
+    assert per_token == 128 * 1024
+    memory = 62 << 30
+    budget = kv_budget(memory, os.path.getsize(info.path))
+    #headroom for compute buffers and the OS
+    assert budget <= memory * 0.8 - (1 << 30)
+    ctx = pick_ctx_size(info, 8, memory)
+    assert ctx == 8 * 8192
+    assert ctx * per_token <= budget
+    #without the per-slot limit the memory still caps it
+    ctx = pick_ctx_size(info, 8, memory, max_per_slot=0)
+    assert ctx < 8 * 131072
+    assert ctx * per_token <= budget
+    #a small instance gets less than the limit
+    ctx = pick_ctx_size(info, 8, 8 << 30)
+    assert ctx * per_token <= kv_budget(8 << 30, os.path.getsize(info.path))
+    assert ctx < 8 * 8192
+
+
+def test_chat_formats_are_detected():
+    assert detect_chat_format(LLAMA["tokenizer.chat_template"]) == "llama3"
+    assert detect_chat_format("{{ '<|im_start|>' + message['role'] }}") == "chatml"
+    assert detect_chat_format("{{ message['content'] }}") is None
+    assert detect_chat_format(None) is None
+    fmt = chat_format("chatml", eos_token="</s>")
+    assert fmt["generation"] == "<|im_start|>assistant\n"
+    assert fmt["stop"] == ["<|im_end|>", "</s>"]
+
+
+def test_command_line_prints_the_context_size(tmp_path):
+    path = write_gguf(tmp_path / "model.gguf", LLAMA)
+    output = subprocess.run([sys.executable, os.path.join(ROOT, "docker", "gguf.py"), path, "--ctx-size", "--slots", "2", "--kv-memory-mb", "1"], capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "8192"
+    output = subprocess.run([sys.executable, os.path.join(ROOT, "docker", "gguf.py"), path], capture_output=True, text=True, check=True).stdout
+    assert "chat_format: llama3" in output
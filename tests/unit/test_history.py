@@ -0,0 +1,85 @@
+import asyncio
+
+from history import ChatTrimmer
+
+
+def render(message):
+    return f"{message['role']}: {message['content']}\n"
+
+
+def counter(calls):
+    #one token per word
+    async def count_tokens(text):
+        calls.append(text)
+        return len(text.split())
+    return count_tokens
+
+
+def conversation(turns, words=10):
+    messages = [{"role": "system", "content": "be brief"}]
+    for i in range(turns):
+        messages.append({"role": "user" if (i % 2 == 0) else "assistant", "content": " ".join([f"w{i}"] * words)})
+    return messages
+
+
+def trim(trimmer, messages, budget, calls=None):
+    return asyncio.run(trimmer.trim(messages, render, counter([] if (calls is None) else calls), budget))
+
+
+def test_short_histories_are_not_counted():
+    calls = []
+    messages = conversation(3, words=2)
+    assert trim(ChatTrimmer(), messages, 1000, calls) == (messages, None)
+    assert calls == []
+    #no budget or a single message are left alone
+    assert trim(ChatTrimmer(), messages, 0) == (messages, None)
+    assert trim(ChatTrimmer(), messages[:1], 1)[1] is None
+
+
+def test_oldest_turns_are_dropped():
+    #system 3 tokens, every turn 11
+    messages = conversation(5)
+    trimmer = ChatTrimmer()
+    result, trimmed = trim(trimmer, messages, 3 + 11 * 3)
+    assert result == [messages[0]] + messages[3:]
+    assert trimmed == {"dropped_messages": 2, "collapsed_messages": 0, "prompt_tokens_before": 58, "prompt_tokens_after": 36, "budget": 36}
+    assert trimmer.stats() == {"trimmed_requests": 1, "dropped_messages": 2, "collapsed_messages": 0}
+
+
+def test_kept_history_starts_with_a_user_turn():
+    messages = conversation(5)
+    result, trimmed = trim(ChatTrimmer(), messages, 3 + 11 * 4)
+    #the fourth newest turn is an assistant turn, it goes too
+    assert result == [messages[0]] + messages[3:]
+    assert result[1]["role"] == "user"
+    assert trimmed["prompt_tokens_after"] == 36
+
+
+def test_latest_message_is_kept_even_over_budget():
+    messages = conversation(3, words=50)
+    result, trimmed = trim(ChatTrimmer(), messages, 10)
+    assert result == [messages[0], messages[-1]]
+    assert trimmed["prompt_tokens_after"] > trimmed["budget"]
+
+
+def test_collapse_shortens_dropped_turns_that_still_fit():
+    messages = conversation(5, words=100)
+    trimmer = ChatTrimmer("collapse", collapse_chars=20)
+    #a collapsed turn is 9 tokens
+    result, trimmed = trim(trimmer, messages, 3 + 101 + 18)
+    assert len(result) == len(messages) - 2
+    assert result[-1] == messages[-1]
+    assert result[-2]["content"].endswith(" ...")
+    assert len(result[-2]["content"]) <= 24
+    assert trimmed["collapsed_messages"] == 2
+    assert trimmed["dropped_messages"] == 2
+    assert trimmer.stats()["collapsed_messages"] == 2
+
+
+def test_collapsed_history_starts_with_a_user_turn():
+    messages = conversation(5, words=100)
+    #room for one collapsed turn, the assistant turn before the latest message
+    result, trimmed = trim(ChatTrimmer("collapse", collapse_chars=20), messages, 3 + 101 + 10)
+    assert result == [messages[0], messages[-1]]
+    assert trimmed["collapsed_messages"] == 0
+    assert trimmed["prompt_tokens_after"] == 104
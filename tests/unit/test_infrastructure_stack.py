@@ -1,15 +1,90 @@
-import aws_cdk as core
-import aws_cdk.assertions as assertions
+import os
 
-from infrastructure.infrastructure_stack import InfrastructureStack
+import pytest
+import yaml
 
-# example tests. To run these tests, uncomment this file along with the example
-# resource in infrastructure/infrastructure_stack.py
-def test_sqs_queue_created():
+from tests.conftest import ROOT
+
+
+def enable_launch_profiles(text):
+    #the commented-out example launch profiles of a shipped config, enabled the way a user would
+    lines, enabled = [], False
+    for line in text.splitlines():
+        indent, _, rest = line.partition("# ")
+        if (not indent.strip() and rest.startswith("launch_profiles:")):
+            enabled = True
+        elif (enabled and (indent.strip() or not rest.startswith("  "))):
+            enabled = False
+        lines.append(indent + rest if (enabled) else line)
+    return "\n".join(lines)
+
+
+@pytest.mark.parametrize("name", ["config.yaml", "multimodel_config.yaml"])
+def test_shipped_launch_profiles_leave_the_context_to_the_model(name, monkeypatch):
+    core = pytest.importorskip("aws_cdk")
+    from aws_cdk import assertions
+    from infrastructure.llama_cpp_stack import LlamaCppStack, LAUNCH_PROFILE_ENV
+
+    with open(os.path.join(ROOT, name)) as f:
+        config = yaml.safe_load(enable_launch_profiles(f.read()))
+    projects = config["project"] if (isinstance(config["project"], list)) else [config["project"]]
+    monkeypatch.chdir(ROOT)
+    for project in projects:
+        #the same settings app.py reads from the config
+        launch_profile = project["launch_profiles"][project["inference"]["instance_type"]]
+        assert set(launch_profile) <= set(LAUNCH_PROFILE_ENV)
+        app = core.App()
+        stack = LlamaCppStack(app, f"{project['name']}-LlamaCppStack",
+            project_name=project["name"],
+            model_bucket_key_full_name=project["model"]["full_name"],
+            model_hugging_face_name=project["model"]["hf_name"],
+            image_tag=project["image"]["image_tag"],
+            image_platform=project["image"]["platform"].lower(),
+            model_name=project["inference"]["sagemaker_model_name"],
+            model_instance_type=project["inference"]["instance_type"],
+            launch_profile=launch_profile,
+            shared={"bucket": "models", "repository": "images"},
+            env=core.Environment(account="123456789012", region="us-east-1")
+        )
+        models = assertions.Template.from_stack(stack).find_resources("AWS::SageMaker::Model")
+        [container] = [container for model in models.values() for container in model["Properties"]["Containers"]]
+        #the profile only reaches server.sh through the environment, the container takes no arguments
+        assert "Command" not in container and "Arguments" not in container
+        environment = container["Environment"]
+        assert {key: value for key, value in environment.items() if key in LAUNCH_PROFILE_ENV.values()} == {LAUNCH_PROFILE_ENV[key]: str(value) for key, value in launch_profile.items()}
+        assert environment["LLAMA_MODEL_S3_URI"] == f"s3://models/{project['model']['full_name']}"
+        assert "LLAMA_CTX_SIZE" not in environment
+
+
+def test_launch_profile_reaches_the_container(monkeypatch):
+    core = pytest.importorskip("aws_cdk")
+    from aws_cdk import assertions
+    from infrastructure.llama_cpp_stack import LlamaCppStack
+
+    #assets such as the lambda code are found relative to the project directory
+    monkeypatch.chdir(ROOT)
     app = core.App()
-    stack = InfrastructureStack(app, "infrastructure")
+    stack = LlamaCppStack(app, "test-LlamaCppStack",
+        project_name="test",
+        model_bucket_key_full_name="model.gguf",
+        model_hugging_face_name="org/model-GGUF",
+        image_tag="arm-latest",
+        image_platform="arm",
+        model_name="model",
+        model_instance_type="ml.c7g.8xlarge",
+        launch_profile={"threads": 16, "parallel": 4, "mlock": True},
+        shared={"bucket": "models", "repository": "images"},
+        env=core.Environment(account="123456789012", region="us-east-1")
+    )
     template = assertions.Template.from_stack(stack)
-
-#     template.has_resource_properties("AWS::SQS::Queue", {
-#         "VisibilityTimeout": 300
-#     })
+    template.has_resource_properties("AWS::SageMaker::Model", {
+        "Containers": [assertions.Match.object_like({
+            "Environment": assertions.Match.object_like({
+                "LLAMA_MODEL_S3_URI": "s3://models/model.gguf",
+                "LLAMA_THREADS": "16",
+                "LLAMA_SLOTS": "4",
+                "LLAMA_MLOCK": "1",
+                "LLAMA_CTX_SIZE": assertions.Match.absent()
+            })
+        })]
+    })
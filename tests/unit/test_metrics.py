@@ -0,0 +1,81 @@
+import json
+import os
+import subprocess
+import sys
+
+from metrics import Metrics
+
+
+def lines(text, prefix):
+    return [line for line in text.splitlines() if line.startswith(prefix)]
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics()
+    labels = {"mode": "stream", "model": "default"}
+    for value in (0.003, 0.04, 0.04, 100):
+        metrics.observe("llama_request_duration_seconds", value, labels)
+    text = metrics.render()
+    assert 'llama_request_duration_seconds_bucket{mode="stream",model="default",le="0.005"} 1' in text
+    assert 'llama_request_duration_seconds_bucket{mode="stream",model="default",le="0.05"} 3' in text
+    assert 'llama_request_duration_seconds_bucket{mode="stream",model="default",le="60.0"} 3' in text
+    assert 'llama_request_duration_seconds_bucket{mode="stream",model="default",le="+Inf"} 4' in text
+    assert 'llama_request_duration_seconds_count{mode="stream",model="default"} 4' in text
+
+
+def test_workers_are_added_up(tmp_path):
+    metrics = Metrics(str(tmp_path))
+    labels = {"mode": "non_stream", "model": "default"}
+    metrics.inc("llama_generated_tokens_total", labels, 10)
+    metrics.observe("llama_queue_wait_seconds", 0.2, labels)
+    metrics.set("llama_slots_busy", labels, 3)
+    #the file another live worker wrote, our parent process stands in for it
+    other = Metrics()
+    other.inc("llama_generated_tokens_total", labels, 5)
+    other.observe("llama_queue_wait_seconds", 0.2, labels)
+    other.set("llama_slots_busy", labels, 1)
+    (tmp_path / f"worker-{os.getppid()}.json").write_text(json.dumps(other.snapshot()))
+    text = metrics.render()
+    assert 'llama_generated_tokens_total{mode="non_stream",model="default"} 15' in text
+    assert 'llama_queue_wait_seconds_count{mode="non_stream",model="default"} 2' in text
+    assert len(lines(text, "llama_slots_busy{")) == 2
+
+
+def test_exited_workers_keep_counters_but_not_gauges(tmp_path):
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    labels = {"mode": "stream", "model": "default"}
+    dead = Metrics()
+    dead.inc("llama_requests_total", labels, 7)
+    dead.set("llama_queue_depth", labels, 2)
+    (tmp_path / f"worker-{process.pid}.json").write_text(json.dumps(dead.snapshot()))
+    text = Metrics(str(tmp_path)).render()
+    assert 'llama_requests_total{mode="stream",model="default"} 7' in text
+    assert lines(text, "llama_queue_depth{") == []
+
+
+def test_flush_only_writes_changes(tmp_path):
+    metrics = Metrics(str(tmp_path))
+    metrics.flush()
+    assert os.listdir(tmp_path) == []
+    metrics.inc("llama_requests_total", {"mode": "stream", "model": "default"})
+    metrics.flush()
+    assert os.listdir(tmp_path) == [f"worker-{os.getpid()}.json"]
+
+
+def test_request_without_stream_takes_its_timings_from_server_cpp(capsys):
+    metrics = Metrics(emf=True)
+    timer = metrics.request("non_stream", "default")
+    timer.finished({"tokens_evaluated": 10, "tokens_predicted": 4, "timings": {"prompt_n": 6, "prompt_ms": 50, "prompt_per_second": 120.0,
+        "predicted_n": 4, "predicted_ms": 80, "predicted_per_second": 50.0, "draft_n": 8, "draft_n_accepted": 6}})
+    text = metrics.render()
+    labels = '{mode="non_stream",model="default"}'
+    assert f"llama_prompt_tokens_cached_total{labels} 4" in text
+    assert f"llama_generated_tokens_total{labels} 4" in text
+    assert f"llama_time_to_first_token_seconds_count{labels} 1" in text
+    assert f"llama_inter_token_latency_seconds_sum{labels} 0.02" in text
+    assert f"llama_draft_tokens_accepted_total{labels} 6" in text
+    emf = json.loads(capsys.readouterr().out)
+    assert emf["GeneratedTokens"] == 4
+    assert emf["DraftAcceptanceRate"] == 0.75
+    assert emf["_aws"]["CloudWatchMetrics"][0]["Namespace"] == "LlamaCpp"
@@ -0,0 +1,131 @@
+import hashlib
+import os
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto = pytest.importorskip("moto")
+
+from model_fetch import FetchError, ModelFetcher
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.delenv("AWS_ENDPOINT_URL", raising=False)
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="models")
+        yield client
+
+
+def count_ranges(client):
+    #the Range headers of the GetObject calls the client makes
+    ranges = []
+    client.meta.events.register("before-call.s3.GetObject", lambda params, **kwargs: ranges.append(params["headers"].get("Range")))
+    return ranges
+
+
+def test_object_is_downloaded_in_ranges(s3, tmp_path):
+    data = os.urandom(10000)
+    s3.put_object(Bucket="models", Key="model.gguf", Body=data)
+    ranges = count_ranges(s3)
+    fetcher = ModelFetcher(str(tmp_path / "cache"), s3=s3, part_size=4096, concurrency=3)
+    result = fetcher.fetch("models", "model.gguf", str(tmp_path / "model.gguf"))
+    assert (tmp_path / "model.gguf").read_bytes() == data
+    assert result["parts"] == 3
+    assert result["verified"]
+    assert sorted(ranges) == ["bytes=0-4095", "bytes=4096-8191", "bytes=8192-9999"]
+
+
+def test_multipart_etag_is_checked_with_the_upload_parts(s3, tmp_path):
+    part = 5 * 1024 * 1024
+    data = os.urandom(part) + os.urandom(1000)
+    upload = s3.create_multipart_upload(Bucket="models", Key="model.gguf")
+    parts = []
+    for number, start in enumerate(range(0, len(data), part), 1):
+        etag = s3.upload_part(Bucket="models", Key="model.gguf", UploadId=upload["UploadId"], PartNumber=number, Body=data[start:start + part])["ETag"]
+        parts.append({"ETag": etag, "PartNumber": number})
+    s3.complete_multipart_upload(Bucket="models", Key="model.gguf", UploadId=upload["UploadId"], MultipartUpload={"Parts": parts})
+    fetcher = ModelFetcher(str(tmp_path / "cache"), s3=s3, part_size=1024 * 1024)
+    result = fetcher.fetch("models", "model.gguf", str(tmp_path / "model.gguf"))
+    assert result["part_size"] == part
+    assert result["parts"] == 2
+    assert result["verified"]
+    assert hashlib.sha256((tmp_path / "model.gguf").read_bytes()).digest() == hashlib.sha256(data).digest()
+
+
+class WrongETag:
+    #reports an ETag that does not match the content of the object
+    def __init__(self, client):
+        self.client = client
+
+    def head_object(self, **kwargs):
+        return {**self.client.head_object(**kwargs), "ETag": '"' + "0" * 32 + '"'}
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def test_checksum_mismatch_fails_and_removes_the_download(s3, tmp_path):
+    s3.put_bucket_versioning(Bucket="models", VersioningConfiguration={"Status": "Enabled"})
+    s3.put_object(Bucket="models", Key="model.gguf", Body=os.urandom(5000))
+    cache = tmp_path / "cache"
+    fetcher = ModelFetcher(str(cache), s3=WrongETag(s3), part_size=1024)
+    with pytest.raises(FetchError, match="checksum mismatch"):
+        fetcher.fetch("models", "model.gguf", str(tmp_path / "model.gguf"))
+    assert os.listdir(cache) == []
+    assert not (tmp_path / "model.gguf").exists()
+
+
+def test_changed_object_fails_the_download(s3, tmp_path):
+    s3.put_object(Bucket="models", Key="model.gguf", Body=os.urandom(5000))
+    fetcher = ModelFetcher(str(tmp_path / "cache"), s3=WrongETag(s3), part_size=1024, retries=0)
+    with pytest.raises(FetchError, match="changed during the download"):
+        fetcher.fetch("models", "model.gguf", str(tmp_path / "model.gguf"))
+
+
+def test_cached_model_is_linked_without_downloading(s3, tmp_path):
+    s3.put_object(Bucket="models", Key="model.gguf", Body=os.urandom(5000))
+    fetcher = ModelFetcher(str(tmp_path / "cache"), s3=s3, part_size=1024)
+    fetcher.fetch("models", "model.gguf", str(tmp_path / "first.gguf"))
+    ranges = count_ranges(s3)
+    result = fetcher.fetch("models", "model.gguf", str(tmp_path / "second.gguf"))
+    assert result["cached"]
+    assert ranges == []
+    assert os.stat(tmp_path / "first.gguf").st_ino == os.stat(tmp_path / "second.gguf").st_ino
+    assert fetcher.stats()["cache_hits"] == 1
+
+
+def test_cache_keeps_twice_the_last_model_by_default(s3, tmp_path):
+    cache = tmp_path / "cache"
+    fetcher = ModelFetcher(str(cache), s3=s3, part_size=4096)
+    for name in ("a", "b", "c"):
+        s3.put_object(Bucket="models", Key=f"{name}.gguf", Body=os.urandom(5000))
+        #every fetch replaces the served model, so the earlier files are no longer linked
+        fetcher.fetch("models", f"{name}.gguf", str(tmp_path / "model.gguf"))
+    assert len(os.listdir(cache)) == 2
+    assert fetcher.stats()["evictions"] == 1
+
+
+def test_files_in_use_are_not_evicted(s3, tmp_path):
+    cache = tmp_path / "cache"
+    fetcher = ModelFetcher(str(cache), s3=s3, part_size=4096)
+    for name in ("a", "b", "c"):
+        s3.put_object(Bucket="models", Key=f"{name}.gguf", Body=os.urandom(5000))
+        fetcher.fetch("models", f"{name}.gguf", str(tmp_path / f"{name}.gguf"))
+    assert len(os.listdir(cache)) == 3
+    os.remove(tmp_path / "a.gguf")
+    s3.put_object(Bucket="models", Key="d.gguf", Body=os.urandom(5000))
+    fetcher.fetch("models", "d.gguf", str(tmp_path / "d.gguf"))
+    assert len(os.listdir(cache)) == 3
+
+
+def test_zero_keeps_every_model(s3, tmp_path):
+    cache = tmp_path / "cache"
+    fetcher = ModelFetcher(str(cache), s3=s3, max_bytes=0)
+    for name in ("a", "b", "c"):
+        s3.put_object(Bucket="models", Key=f"{name}.gguf", Body=os.urandom(5000))
+        fetcher.fetch("models", f"{name}.gguf", str(tmp_path / "model.gguf"))
+    assert len(os.listdir(cache)) == 3
@@ -0,0 +1,94 @@
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from models import ModelError, ModelManager, find_draft, find_gguf
+
+
+def manager(tmp_path, base_port):
+    return ModelManager(1 << 30, base_port, 0, None, lock_dir=str(tmp_path))
+
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_ports_are_not_shared_between_workers(tmp_path):
+    base = unused_port()
+    first, second = manager(tmp_path, base), manager(tmp_path, base)
+    port = first.free_port()
+    assert port == base
+    assert second.free_port() == base + 1
+    first.release_port(port)
+    assert second.free_port() == base
+
+
+def test_ports_in_use_are_skipped(tmp_path):
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+        assert manager(tmp_path, port).free_port() > port
+
+
+def test_gguf_files_are_found_next_to_their_draft(tmp_path):
+    (tmp_path / "nested").mkdir()
+    (tmp_path / "nested" / "model.Q4_K_M.gguf").write_bytes(b"")
+    (tmp_path / "model-draft.gguf").write_bytes(b"")
+    assert find_gguf(str(tmp_path)) == str(tmp_path / "nested" / "model.Q4_K_M.gguf")
+    assert find_draft(str(tmp_path)) == str(tmp_path / "model-draft.gguf")
+    assert find_gguf(str(tmp_path / "model-draft.gguf")) == str(tmp_path / "model-draft.gguf")
+    assert find_draft(str(tmp_path / "model-draft.gguf")) is None
+
+
+def test_directory_without_a_model(tmp_path):
+    with pytest.raises(ModelError) as error:
+        find_gguf(str(tmp_path))
+    assert error.value.status_code == 404
+    assert find_draft(str(tmp_path)) is None
+
+
+class FakeModel:
+    def __init__(self, name, url, path):
+        self.name, self.url, self.path = name, url, path
+
+
+def test_models_are_found_by_name_url_or_file(tmp_path):
+    models = manager(tmp_path, 8090)
+    models.models["a"] = FakeModel("a", "s3://bucket/prefix/llama.tar.gz", "/opt/ml/models/a/llama.gguf")
+    models.models["b"] = FakeModel("b", "s3://bucket/prefix/mistral.tar.gz/", "/opt/ml/models/b/mistral.gguf")
+    assert models.find("b").name == "b"
+    assert models.find("llama.tar.gz").name == "a"
+    assert models.find("mistral.tar.gz").name == "b"
+    assert models.find("llama.gguf").name == "a"
+    assert models.find("other.tar.gz") is None
+    #lookups keep the least recently used model first
+    assert list(models.models) == ["b", "a"]
+
+
+def test_model_ports_follow_the_swap_ports(main):
+    assert main.model_manager.base_port >= main.swap_base_port() + main.args.instances
+
+
+def test_a_restart_stops_only_the_default_servers(main, tmp_path):
+    #stand-ins for server.cpp, named like it so they are found by their port
+    server = tmp_path / "llama-server"
+    server.symlink_to(os.path.realpath(sys.executable))
+    default_port, model_port = unused_port(), unused_port()
+    default, model = [subprocess.Popen([str(server), "-c", "import time; time.sleep(60)", "--port", str(port)]) for port in (default_port, model_port)]
+    old_backend = main.default_backend
+    main.default_backend = main.make_default_backend(default_port)
+    try:
+        main.stop_default_servers()
+        assert default.wait(10) != 0
+        assert model.poll() is None
+    finally:
+        main.default_backend = old_backend
+        default.kill()
+        model.kill()
+        model.wait()
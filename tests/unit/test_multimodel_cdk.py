@@ -0,0 +1,108 @@
+import argparse
+import asyncio
+import json
+import sys
+
+import multimodel_cdk
+
+
+def project(name, platform="arm", image_tag="arm-latest", hf_name="org/model-GGUF", full_name="model.Q4_K_M.gguf", draft=None):
+    model = {"hf_name": hf_name, "full_name": full_name, "instance_type": "ml.c7g.8xlarge"}
+    if (draft is not None):
+        model["draft"] = draft
+    return {"name": name, "image": {"platform": platform, "image_tag": image_tag}, "model": model}
+
+
+def test_images_and_models_are_shared_between_projects():
+    nodes = multimodel_cdk.plan([
+        project("a"),
+        project("b", platform="ARM"),
+        project("c", platform="amd", image_tag="amd-latest"),
+        project("d", full_name="other.gguf")
+    ], "shared")
+    names = [node.name for node in nodes]
+    assert names[:2] == ["shared-arm-arm-latest", "shared-amd-amd-latest"]
+    assert len([name for name in names if (name.startswith("shared-model-"))]) == 2
+    assert names[-4:] == ["a", "b", "c", "d"]
+    a, b, c, d = nodes[-4:]
+    assert a.deps == b.deps
+    assert c.deps[1] is a.deps[1] and c.deps[0] is not a.deps[0]
+    assert d.deps[0] is a.deps[0] and d.deps[1] is not a.deps[1]
+    assert nodes[0].config == {"image_build": {"name": "shared-arm-arm-latest", "platform": "arm", "image_tag": "arm-latest"}}
+
+
+def test_draft_files_decide_the_download_but_not_its_settings():
+    draft = {"hf_name": "org/draft-GGUF", "full_name": "draft.gguf"}
+    nodes = multimodel_cdk.plan([
+        project("a", draft={**draft, "max": 8}),
+        project("b", draft={**draft, "max": 16}),
+        project("c")
+    ], "shared")
+    a, b, c = nodes[-3:]
+    assert a.deps[1] is b.deps[1] and a.deps[1] is not c.deps[1]
+    assert a.deps[1].config["model_download"]["model"]["draft"] == draft
+
+
+def fake_cdk(tmp_path):
+    #records every call, fails the stacks whose config names "broken" and writes the outputs of the others
+    path = tmp_path / "cdk"
+    path.write_text(f'''#!{sys.executable}
+import json, sys, yaml
+args = sys.argv[1:]
+config_file = next(arg.split("=", 1)[1] for arg in args if arg.startswith("config_file="))
+with open(config_file) as f:
+    config = yaml.safe_load(f)
+with open({str(tmp_path / "calls.jsonl")!r}, "a") as f:
+    f.write(json.dumps([args[0], config]) + "\\n")
+if "broken" in json.dumps(config):
+    sys.exit(1)
+outputs = next((arg.split("=", 1)[1] for arg in args if arg.startswith("--outputs-file=")), None)
+if outputs:
+    kind, settings = next(iter(config.items()))
+    stack = settings["name"] + {{"image_build": "-LlamaCppImageStack", "model_download": "-LlamaCppModelStack", "project": "-LlamaCppStack"}}[kind]
+    with open(outputs, "w") as f:
+        json.dump({{stack: {{"from": settings["name"]}}}}, f)
+''')
+    path.chmod(0o755)
+    return str(path)
+
+
+def calls(tmp_path):
+    return [json.loads(line) for line in (tmp_path / "calls.jsonl").read_text().splitlines()]
+
+
+def run(tmp_path, nodes, action):
+    args = argparse.Namespace(output_dir=str(tmp_path), concurrency=2, cdk=fake_cdk(tmp_path))
+    asyncio.run(multimodel_cdk.run(nodes, args, action))
+
+
+def test_deploy_skips_dependents_of_failed_stacks(tmp_path):
+    nodes = multimodel_cdk.plan([project("a"), project("b", full_name="broken.gguf")], "shared")
+    run(tmp_path, nodes, "deploy")
+    states = {node.name: node.state for node in nodes}
+    assert states["a"] == "done"
+    assert states["b"] == "skipped"
+    assert sorted(states.values()) == ["done", "done", "done", "failed", "skipped"]
+    #stacks ran after the stacks they depend on
+    order = [next(iter(config.values()))["name"] for _, config in calls(tmp_path)]
+    assert order.index("shared-arm-arm-latest") < order.index("a")
+    assert order.index(nodes[1].name) < order.index("a")
+    assert "b" not in order
+
+
+def test_outputs_reach_the_endpoint_stack(tmp_path):
+    nodes = multimodel_cdk.plan([project("a")], "shared")
+    run(tmp_path, nodes, "deploy")
+    endpoint = [config for _, config in calls(tmp_path) if ("project" in config)]
+    assert len(endpoint) == 1
+    assert endpoint[0]["project"]["shared"] == {"from": nodes[1].name}
+
+
+def test_destroy_runs_in_reverse_order(tmp_path):
+    nodes = multimodel_cdk.plan([project("a"), project("b")], "shared")
+    run(tmp_path, nodes, "destroy")
+    recorded = calls(tmp_path)
+    assert all(action == "destroy" for action, _ in recorded)
+    kinds = ["project" in config for _, config in recorded]
+    #both endpoint stacks go before the image and model stacks they use
+    assert kinds == [True, True, False, False]
@@ -0,0 +1,78 @@
+import asyncio
+
+from prefix_index import PrefixIndex, prefix_hashes
+from scheduler import SlotScheduler
+
+
+def test_hashes_cover_full_blocks_only():
+    assert len(prefix_hashes("abcdefghij", 4)) == 2
+    assert prefix_hashes("abc", 4) == []
+
+
+def test_hashes_chain_on_the_prefix():
+    first = prefix_hashes("aaaabbbbcccc", 4)
+    second = prefix_hashes("aaaaxxxxcccc", 4)
+    assert first[0] == second[0]
+    #the same last block after a different prefix hashes differently
+    assert first[2] != second[2]
+    assert prefix_hashes("aaaabbbbccccdd", 4) == first
+
+
+def test_match_counts_leading_blocks():
+    index = PrefixIndex()
+    cached = prefix_hashes("system prompt, then a question", 4)
+    index.update(0, cached)
+    assert index.match(0, cached) == len(cached)
+    assert index.match(0, prefix_hashes("system prompt, other question", 4)) == 3
+    assert index.match(0, prefix_hashes("unrelated", 4)) == 0
+    assert index.match(1, cached) == 0
+
+
+def test_best_slot_prefers_the_longest_match():
+    index = PrefixIndex()
+    index.update(0, prefix_hashes("shared preamble one", 4))
+    index.update(1, prefix_hashes("shared preamble two and more", 4))
+    hashes = prefix_hashes("shared preamble two and something else", 4)
+    assert index.best_slot([0, 1, 2], hashes) == 1
+    assert index.best_slot([0, 2], hashes) == 0
+    assert index.best_slot([2], hashes) is None
+    assert index.stats()["lookups"] == 3
+    assert index.stats()["routed_hits"] == 2
+
+
+def test_forget():
+    index = PrefixIndex()
+    hashes = prefix_hashes("abcdefgh", 4)
+    index.update(0, hashes)
+    index.update(1, hashes)
+    index.forget(0)
+    assert index.match(0, hashes) == 0
+    assert index.match(1, hashes) == 2
+    index.forget()
+    assert index.slots == {}
+
+
+def test_record_counts_saved_prefill():
+    index = PrefixIndex()
+    index.record(100, 100)
+    index.record(100, 20)
+    stats = index.stats()
+    assert stats["requests"] == 2
+    assert stats["cache_hits"] == 1
+    assert stats["cache_hit_rate"] == 0.5
+    assert stats["prompt_tokens"] == 200
+    assert stats["prefill_tokens_saved"] == 80
+
+
+def test_scheduler_gives_the_slot_holding_the_prefix():
+    async def main():
+        index = PrefixIndex()
+        scheduler = SlotScheduler(3, max_queue=4, max_wait=0, index=index)
+        hashes = prefix_hashes("You are a helpful assistant. Hi", 4)
+        index.update(2, hashes)
+        assert await scheduler.acquire(hashes) == 2
+        #without a match the least recently used free slot is taken
+        assert await scheduler.acquire(prefix_hashes("zzzzzzzz", 4)) == 0
+        scheduler.resize(2)
+        assert 2 not in index.slots
+    asyncio.run(main())
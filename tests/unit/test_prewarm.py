@@ -0,0 +1,35 @@
+import os
+
+from prewarm import prewarm, process_age
+
+
+def test_every_block_is_read(tmp_path):
+    path = tmp_path / "model.gguf"
+    path.write_bytes(os.urandom(3 * 1024 * 1024 + 5))
+    read, seconds = prewarm(str(path), threads=4, block_mb=1)
+    assert read == 3 * 1024 * 1024 + 5
+    assert seconds >= 0
+    assert prewarm(str(path), threads=1, block_mb=64)[0] == 3 * 1024 * 1024 + 5
+
+
+def test_empty_file(tmp_path):
+    (tmp_path / "empty.gguf").write_bytes(b"")
+    assert prewarm(str(tmp_path / "empty.gguf"))[0] == 0
+
+
+def test_process_age():
+    age = process_age()
+    assert age is not None and age >= 0
+    assert process_age(1) >= age
+    assert process_age(2 ** 30) is None
+
+
+def test_phases_are_timed(main):
+    state = {}
+    phase = main.progress(state, "test", 0)
+    phase("downloading")
+    phase("starting", model="model.gguf")
+    phase("done")
+    assert state["state"] == "done"
+    assert state["model"] == "model.gguf"
+    assert set(state["phases"]) == {"downloading", "starting"}
@@ -0,0 +1,143 @@
+import asyncio
+
+import httpx
+import pytest
+
+from backend import Backend
+from scheduler import QueueFullError, QueueTimeoutError, SlotScheduler, worker_share
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_free_slots_are_taken_in_order_and_released():
+    async def main():
+        scheduler = SlotScheduler(2, max_queue=4, max_wait=0)
+        assert await scheduler.acquire() == 0
+        assert await scheduler.acquire() == 1
+        assert scheduler.busy == 2
+        scheduler.release(0)
+        assert scheduler.busy == 1
+        assert await scheduler.acquire() == 0
+    run(main())
+
+
+def test_full_queue_is_rejected():
+    async def main():
+        scheduler = SlotScheduler(1, max_queue=1, max_wait=0)
+        await scheduler.acquire()
+        waiter = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError):
+            await scheduler.acquire()
+        assert scheduler.stats()["rejected"] == 1
+        scheduler.release(0)
+        assert await waiter == 0
+    run(main())
+
+
+def test_waiters_are_served_first_in_first_out():
+    async def main():
+        scheduler = SlotScheduler(1, max_queue=4, max_wait=0)
+        await scheduler.acquire()
+        order = []
+
+        async def wait(name):
+            slot = await scheduler.acquire()
+            order.append(name)
+            scheduler.release(slot)
+
+        tasks = [asyncio.ensure_future(wait(name)) for name in "abc"]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 3
+        scheduler.release(0)
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b", "c"]
+        assert scheduler.busy == 0
+    run(main())
+
+
+def test_wait_times_out_and_leaves_the_queue():
+    async def main():
+        scheduler = SlotScheduler(1, max_queue=4, max_wait=0.05)
+        await scheduler.acquire()
+        with pytest.raises(QueueTimeoutError):
+            await scheduler.acquire()
+        #a request deadline shorter than max_wait wins
+        scheduler.max_wait = 10
+        with pytest.raises(QueueTimeoutError):
+            await scheduler.acquire(timeout=0.01)
+        assert scheduler.queue_depth == 0
+        assert scheduler.stats()["timed_out"] == 2
+    run(main())
+
+
+def test_cancelled_waiter_does_not_keep_a_slot():
+    async def main():
+        scheduler = SlotScheduler(1, max_queue=4, max_wait=0)
+        await scheduler.acquire()
+        waiter = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        scheduler.release(0)
+        assert scheduler.busy == 0
+        assert scheduler.queue_depth == 0
+    run(main())
+
+
+def test_resize_hands_new_slots_to_waiters():
+    async def main():
+        scheduler = SlotScheduler(1, max_queue=4, max_wait=0)
+        await scheduler.acquire()
+        waiter = asyncio.ensure_future(scheduler.acquire())
+        await asyncio.sleep(0)
+        scheduler.resize(3)
+        assert await waiter == 1
+        assert scheduler.n_slots == 3
+        assert scheduler.free == [2]
+        scheduler.resize(1)
+        #slots past the new count are dropped when they are released
+        scheduler.release(1)
+        assert scheduler.free == []
+    run(main())
+
+
+def test_worker_share():
+    assert worker_share(8, 1) == 8
+    assert worker_share(8, 4) == 2
+    assert worker_share(2, 4) == 1
+    assert worker_share(64, 3) == 21
+    assert worker_share(0, 4) == 0
+
+
+def props_transport(total_slots):
+    def handler(request):
+        return httpx.Response(200, json={"total_slots": total_slots, "default_generation_settings": {"n_ctx": 4096}})
+    return httpx.MockTransport(handler)
+
+
+def test_uncoordinated_workers_split_slots_and_queue():
+    async def main():
+        backend = Backend("default", "http://127.0.0.1:1", 8, 64, 30, workers=4)
+        assert backend.scheduler.n_slots == 2
+        assert backend.scheduler.max_queue == 16
+        await backend.client.aclose()
+        backend.client = httpx.AsyncClient(base_url=backend.url, transport=props_transport(12))
+        await backend.refresh_slots()
+        assert backend.scheduler.n_slots == 3
+        assert backend.n_ctx == 4096
+        await backend.aclose()
+    run(main())
+
+
+def test_single_worker_keeps_all_slots():
+    async def main():
+        backend = Backend("default", "http://127.0.0.1:1", 8, 64, 30)
+        backend.client = httpx.AsyncClient(base_url=backend.url, transport=props_transport(12))
+        await backend.refresh_slots()
+        assert backend.scheduler.n_slots == 12
+        assert backend.scheduler.max_queue == 64
+        await backend.aclose()
+    run(main())
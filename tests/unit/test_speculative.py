@@ -0,0 +1,40 @@
+from metrics import Metrics
+from models import server_env
+
+
+def test_timings_without_a_draft_model(main):
+    assert main.make_timings({"prompt_per_second": 120.0, "predicted_per_second": 30.0}) == {
+        "prompt_tokens_per_second": 120.0,
+        "generation_tokens_per_second": 30.0
+    }
+
+
+def test_timings_report_the_draft_acceptance_rate(main):
+    timings = main.make_timings({"prompt_per_second": 120.0, "predicted_per_second": 30.0, "draft_n": 30, "draft_n_accepted": 20})
+    assert timings["draft_tokens"] == 30
+    assert timings["draft_tokens_accepted"] == 20
+    assert timings["draft_acceptance_rate"] == 0.6667
+
+
+def test_draft_tokens_are_counted():
+    metrics = Metrics()
+    timer = metrics.request("non_stream", "default")
+    timer.finished({"tokens_evaluated": 4, "tokens_predicted": 8, "timings": {"draft_n": 10, "draft_n_accepted": 7}})
+    text = metrics.render()
+    assert 'llama_draft_tokens_total{mode="non_stream",model="default"} 10' in text
+    assert 'llama_draft_tokens_accepted_total{mode="non_stream",model="default"} 7' in text
+
+
+def test_server_env_names_the_draft_model():
+    assert server_env("/opt/ml/models/a/draft.gguf")["LLAMA_DRAFT_MODEL"] == "/opt/ml/models/a/draft.gguf"
+    #empty keeps server.sh from looking for a draft next to the model
+    assert server_env()["LLAMA_DRAFT_MODEL"] == ""
+
+
+def test_downloaded_draft_is_kept_next_to_the_model(main, tmp_path):
+    model = tmp_path / "llm_model.bin"
+    model.write_bytes(b"")
+    assert main.draft_for(str(model)) is None
+    (tmp_path / "llm_model.bin.draft").write_bytes(b"")
+    assert main.draft_for(str(model)) == str(model) + ".draft"
+    assert main.draft_for(None) is None
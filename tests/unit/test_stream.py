@@ -0,0 +1,65 @@
+import asyncio
+import json
+
+
+class FakeResponse:
+    def __init__(self, *chunks):
+        self.chunks = chunks
+
+    async def aiter_bytes(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def event(content, stop=False):
+    data = {"content": content, "stop": stop}
+    if (stop):
+        data.update({"stopped_eos": True, "stopped_word": False, "tokens_predicted": 3, "tokens_evaluated": 2, "truncated": False})
+    return f"data: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+def collect(generator):
+    async def run():
+        return [item async for item in generator]
+    return asyncio.run(run())
+
+
+def payloads(events):
+    return [json.loads(item[6:]) for item in b"".join(events).split(b"\n\n") if item]
+
+
+def test_template_encoder_matches_full_serialization(main):
+    for chat in (False, True):
+        encoder = main.ChunkEncoder(chat, 123)
+        for text in ("plain", 'quo"te', "new\nline", "ünï"):
+            assert json.loads(encoder.text(text)[6:]) == json.loads(encoder.chunk({"content": text, "stop": False})[6:])
+
+
+def test_events_split_across_reads(main):
+    raw = event("a") + event("b")
+    response = FakeResponse(raw[:5], raw[5:20], raw[20:])
+    assert [json.loads(payload)["content"] for payload in collect(main.sse_events(response))] == ["a", "b"]
+
+
+def test_relay_forwards_every_token(main):
+    stops = []
+    response = FakeResponse(event("a"), event("b"), event("c"), event("", stop=True))
+    events = collect(main.relay_stream(response, main.ChunkEncoder(False, 0), stops.append))
+    assert [data["choices"][0]["text"] for data in payloads(events)] == ["a", "b", "c", ""]
+    assert stops[0]["content"] == "abc"
+
+
+def test_relay_coalesces_tokens_after_the_first(main):
+    stops = []
+    response = FakeResponse(event("a"), event("b"), event("c"), event("d"), event("e"), event("", stop=True))
+    events = collect(main.relay_stream(response, main.ChunkEncoder(False, 0), stops.append, coalesce_bytes=2))
+    texts = [data["choices"][0]["text"] for data in payloads(events)]
+    assert texts == ["a", "bc", "de", ""]
+    assert payloads(events)[-1]["choices"][0]["finish_reason"] == "stop"
+    assert stops[0]["content"] == "abcde"
+
+
+def test_pending_text_goes_out_with_the_last_event(main):
+    response = FakeResponse(event("a"), event("b"), event("c", stop=True))
+    events = collect(main.relay_stream(response, main.ChunkEncoder(False, 0), lambda chunk: None, coalesce_bytes=10))
+    assert [data["choices"][0]["text"] for data in payloads(events)] == ["a", "bc"]
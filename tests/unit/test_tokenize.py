@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+import httpx
+
+
+class FakeBackend:
+    def __init__(self, name="default"):
+        self.name = name
+        self.calls = []
+
+        def handler(request):
+            content = json.loads(request.content)["content"]
+            self.calls.append(content)
+            return httpx.Response(200, json={"tokens": list(range(len(content.split())))})
+
+        self.client = httpx.AsyncClient(base_url="http://server", transport=httpx.MockTransport(handler))
+
+
+def test_repeated_prompts_are_tokenized_once(main):
+    async def run():
+        backend = FakeBackend()
+        first = await main.tokenize_prompt(backend, "a system prompt here")
+        second = await main.tokenize_prompt(backend, "a system prompt here")
+        await backend.client.aclose()
+        return backend, first, second
+
+    main.token_cache.clear()
+    backend, first, second = asyncio.run(run())
+    assert first == second == [0, 1, 2, 3]
+    assert backend.calls == ["a system prompt here"]
+
+
+def test_tokenizations_are_kept_per_model(main):
+    async def run():
+        one, two = FakeBackend("one"), FakeBackend("two")
+        await main.tokenize_prompt(one, "same prompt")
+        await main.tokenize_prompt(two, "same prompt")
+        await one.client.aclose()
+        await two.client.aclose()
+        return one, two
+
+    main.token_cache.clear()
+    one, two = asyncio.run(run())
+    assert one.calls == two.calls == ["same prompt"]
+
+
+def test_token_prompts_are_not_tokenized(main):
+    backend = FakeBackend()
+    assert asyncio.run(main.tokenize_prompt(backend, [1, 2, 3])) == [1, 2, 3]
+    assert backend.calls == []